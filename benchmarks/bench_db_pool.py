@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+get_db() benchmark: har chaqiruvda connect/close (eski) vs ConnectionPool (WAL).
+
+Ishga tushirish:
+    python benchmarks/bench_db_pool.py [--ops 20000] [--threads 4]
+"""
+
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+TMP_DIR = tempfile.mkdtemp(prefix="territory_bench_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import territory_bot as tb  # noqa: E402
+
+USERS = 1000
+
+@contextmanager
+def legacy_get_db():
+    """Bazaviy versiyadagi get_db() — har safar yangi ulanish."""
+    conn = sqlite3.connect(tb.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def read_op(db, i):
+    with db() as conn:
+        conn.execute("SELECT * FROM users WHERE user_id=?", (i % USERS + 1,)).fetchone()
+
+def write_op(db, i):
+    with db() as conn:
+        conn.execute("UPDATE users SET total_km = total_km + 0.001 WHERE user_id=?", (i % USERS + 1,))
+
+def run_serial(db, op, ops: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(ops):
+        op(db, i)
+    return ops / (time.perf_counter() - t0)
+
+def run_mixed(db, ops: int, threads: int) -> float:
+    """`threads` ta o'quvchi + 1 ta yozuvchi parallel; o'qish ops/sec qaytadi."""
+    stop = threading.Event()
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            write_op(db, i)
+            i += 1
+
+    per_thread = ops // threads
+
+    def reader():
+        for i in range(per_thread):
+            read_op(db, i)
+
+    w = threading.Thread(target=writer)
+    w.start()
+    readers = [threading.Thread(target=reader) for _ in range(threads)]
+    t0 = time.perf_counter()
+    for r in readers:
+        r.start()
+    for r in readers:
+        r.join()
+    elapsed = time.perf_counter() - t0
+    stop.set()
+    w.join()
+    return per_thread * threads / elapsed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    tb.init_db()
+    tb.migrate_db()
+    with tb.get_db() as conn:
+        conn.executemany(
+            "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
+            [(i, f"u{i}", f"User {i}") for i in range(1, USERS + 1)],
+        )
+
+    rows = []
+    for name, op, ops in (("read", read_op, args.ops), ("write", write_op, args.ops // 4)):
+        legacy = run_serial(legacy_get_db, op, ops)
+        pooled = run_serial(tb.get_db, op, ops)
+        rows.append((name, legacy, pooled))
+    legacy = run_mixed(legacy_get_db, args.ops, args.threads)
+    pooled = run_mixed(tb.get_db, args.ops, args.threads)
+    rows.append((f"read+write x{args.threads}", legacy, pooled))
+
+    print(f"{'benchmark':<16}{'legacy ops/s':>14}{'pool ops/s':>14}{'speedup':>10}")
+    for name, legacy, pooled in rows:
+        print(f"{name:<16}{legacy:>14.0f}{pooled:>14.0f}{pooled / legacy:>9.1f}x")
+
+    tb.db_pool.close_all()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Geometriya: bazaviy sof Python funksiyalar vs TrekGeometry (NumPy va fallback).
+
+Ishga tushirish:
+    python benchmarks/bench_geometry.py [--points 5000] [--centers 200] [--repeat 20]
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="territory_bench_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import territory_bot as tb  # noqa: E402
+
+# ── Bazaviy versiyadagi implementatsiyalar ────────────
+
+def legacy_polygon_area_m2(points: list) -> float:
+    lat0, lng0 = points[0]["lat"], points[0]["lng"]
+    coords = []
+    for p in points:
+        dx = tb.haversine(lat0, lng0, lat0, p["lng"])
+        if p["lng"] < lng0:
+            dx = -dx
+        dy = tb.haversine(lat0, lng0, p["lat"], lng0)
+        if p["lat"] < lat0:
+            dy = -dy
+        coords.append((dx, dy))
+    n = len(coords)
+    area = 0
+    for i in range(n):
+        j = (i + 1) % n
+        area += coords[i][0] * coords[j][1]
+        area -= coords[j][0] * coords[i][1]
+    return abs(area) / 2
+
+def legacy_centroid(points: list) -> tuple:
+    return sum(p["lat"] for p in points) / len(points), sum(p["lng"] for p in points) / len(points)
+
+def legacy_length(points: list) -> float:
+    return sum(tb.haversine(a["lat"], a["lng"], b["lat"], b["lng"]) for a, b in zip(points, points[1:]))
+
+def legacy_contains(centers: list, points: list) -> list:
+    return [tb.point_in_polygon(lat, lng, points) for lat, lng in centers]
+
+# ── Ma'lumotlar ───────────────────────────────────────
+
+def wobbly_loop(n: int) -> list:
+    """~1 km radiusli, shovqinli yopiq trek (GPS'ga o'xshash)."""
+    lat0, lng0 = 41.2995, 69.2401
+    points = []
+    for i in range(n):
+        a = 2 * math.pi * i / n
+        r = (900 + 150 * math.sin(7 * a) + random.gauss(0, 5)) / 111320
+        points.append({"lat": lat0 + r * math.cos(a), "lng": lng0 + r * math.sin(a) / math.cos(math.radians(lat0))})
+    points.append(dict(points[0]))
+    return points
+
+def same(got, expected) -> bool:
+    """Float'lar uchun 1e-9 nisbiy farq, bool'lar uchun aniq tenglik."""
+    got = got if isinstance(got, (list, tuple)) else (got,)
+    expected = expected if isinstance(expected, (list, tuple)) else (expected,)
+    return len(got) == len(expected) and all(
+        a == b if isinstance(b, bool) else math.isclose(a, b, rel_tol=1e-9) for a, b in zip(got, expected)
+    )
+
+def bench(fn, repeat: int) -> tuple:
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - t0) / repeat * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=5000)
+    parser.add_argument("--centers", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    points = wobbly_loop(args.points)
+    centers = [(41.2995 + random.uniform(-0.012, 0.012), 69.2401 + random.uniform(-0.016, 0.016))
+               for _ in range(args.centers)]
+
+    cases = {
+        "area":     (lambda: legacy_polygon_area_m2(points), lambda: tb.polygon_area_m2(points)),
+        "centroid": (lambda: legacy_centroid(points), lambda: tb.TrekGeometry(points).centroid()),
+        "length":   (lambda: legacy_length(points), lambda: tb.path_length_m(points)),
+        f"pip x{args.centers}": (lambda: legacy_contains(centers, points),
+                                 lambda: tb.points_in_polygon(centers, points)),
+    }
+
+    def shared():
+        shape = tb.TrekGeometry(points)
+        return (shape.area_m2(), *shape.centroid(), shape.path_length_m(),
+                *shape.contains([c[0] for c in centers], [c[1] for c in centers]))
+
+    def legacy_shared():
+        return (legacy_polygon_area_m2(points), *legacy_centroid(points), legacy_length(points),
+                *legacy_contains(centers, points))
+
+    cases["all (1x)"] = (legacy_shared, shared)
+
+    numpy = tb.np
+    print(f"{args.points} nuqtali trek, {args.centers} zona markazi; "
+          f"NumPy: {numpy.__version__ if numpy is not None else 'yo`q'}")
+    print(f"{'kernel':<12}{'legacy ms':>11}{'python ms':>11}{'numpy ms':>10}{'speedup':>9}")
+    for name, (legacy, current) in cases.items():
+        legacy_ms, expected = bench(legacy, args.repeat)
+        tb.np = None
+        python_ms, fallback = bench(current, args.repeat)
+        tb.np = numpy
+        assert same(fallback, expected), f"{name}: fallback natijasi farq qildi"
+        if numpy is None:
+            print(f"{name:<12}{legacy_ms:>11.2f}{python_ms:>11.2f}{'-':>10}{legacy_ms / python_ms:>8.1f}x")
+            continue
+        numpy_ms, vectorized = bench(current, args.repeat)
+        assert same(vectorized, expected), f"{name}: NumPy natijasi farq qildi"
+        print(f"{name:<12}{legacy_ms:>11.2f}{python_ms:>11.2f}{numpy_ms:>10.2f}{legacy_ms / numpy_ms:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+initData tekshiruvi: bazaviy parse (har safar secret_key + to'liq parse) vs
+verify_init_data (oldindan hisoblangan secret + tekshirilgan satrlar keshi).
+
+Ishga tushirish:
+    python benchmarks/bench_init_data.py [--ops 50000] [--sessions 1000]
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import time
+from urllib.parse import quote, unquote
+
+TMP_DIR = tempfile.mkdtemp(prefix="territory_bench_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import territory_bot as tb  # noqa: E402
+
+def make_init_data(user_id: int, auth_date: int) -> str:
+    """Mini App yuboradigan initData (query string) — bot tokeni bilan imzolangan."""
+    params = {
+        "query_id": f"AAH{user_id:012d}",
+        "user": json.dumps({"id": user_id, "first_name": f"User {user_id}", "language_code": "uz"},
+                           separators=(",", ":")),
+        "auth_date": str(auth_date),
+    }
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    params["hash"] = hmac.new(tb.WEBAPP_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return "&".join(f"{k}={quote(v)}" for k, v in params.items())
+
+def legacy_parse_init_data(init_data: str) -> dict | None:
+    """Bazaviy versiyadagi parse_init_data() — loglarsiz."""
+    params = {}
+    for pair in init_data.split("&"):
+        idx = pair.find("=")
+        if idx == -1:
+            continue
+        params[unquote(pair[:idx])] = unquote(pair[idx + 1:])
+    hash_val = params.pop("hash", None)
+    if not hash_val or int(time.time()) - int(params["auth_date"]) > tb.INIT_DATA_MAX_AGE:
+        return None
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    secret_key = hmac.new(tb.BOT_TOKEN.encode(), b"WebAppData", hashlib.sha256).digest()
+    calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(calculated_hash, hash_val):
+        return None
+    return json.loads(params["user"])
+
+def run(fn, samples: list, ops: int) -> float:
+    t0 = time.perf_counter()
+    for i in range(ops):
+        assert fn(samples[i % len(samples)]) is not None
+    return ops / (time.perf_counter() - t0)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ops", type=int, default=50000)
+    parser.add_argument("--sessions", type=int, default=1000)
+    args = parser.parse_args()
+
+    now = int(time.time())
+    samples = [make_init_data(i, now - i % 600) for i in range(1, args.sessions + 1)]
+    fresh = [make_init_data(i, now) for i in range(1, args.ops + 1)]  # har biri yangi satr
+
+    def fast(s):
+        return tb.verify_init_data(s).user
+
+    rows = [("legacy", run(legacy_parse_init_data, fresh, args.ops))]
+    tb.init_data_cache = tb.VerifiedInitDataCache(args.ops)
+    rows.append(("verify (miss)", run(fast, fresh, args.ops)))
+    rows.append(("verify (hit)", run(fast, samples, args.ops)))
+
+    base = rows[0][1]
+    print(f"{args.sessions} sessiya, {args.ops} tekshiruv")
+    print(f"{'benchmark':<16}{'verif/s':>12}{'speedup':>10}")
+    for name, rate in rows:
+        print(f"{name:<16}{rate:>12.0f}{rate / base:>9.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Load test: territory_bot (alohida jarayon) + lokal fake Telegram Bot API.
+
+Fake API (aiohttp) getMe/getUpdates/sendMessage/getFile/getUserProfilePhotos
+so'rovlarini yozib boradi; bot BOT_API_URL orqali unga ulanadi. Sintetik
+foydalanuvchilar uchun to'g'ri HMAC imzoli initData yaratiladi va
+/api/trek_submit, /api/zones, /api/zone/action berilgan parallellikda
+so'raladi. Natija: throughput, p50/p95/p99, trek navbati bo'shash vaqti va
+DB o'sishi.
+
+Ishga tushirish:
+    python benchmarks/bench_load.py [--duration 20] [--concurrency 32] [--users 200]
+                                    [--mix trek=1,zones=8,action=1] [--seed 42]
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from urllib.parse import quote
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456789:LOADTEST-fake-token"
+TEAMS = ("red", "blue", "green", "yellow")
+CENTER = (41.2995, 69.2401)  # Toshkent
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# ── Fake Telegram Bot API ─────────────────────────────
+
+class FakeTelegramAPI:
+    """api.telegram.org o'rnida: har bir method chaqiruvini sanaydi."""
+
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        self.calls = Counter()
+        self.message_id = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.file)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = dict(await request.post()) if request.can_read_body else {}
+        if request.content_type == "application/json":
+            data = await request.json()
+        if method == "getUpdates":
+            await asyncio.sleep(min(float(data.get("timeout", 1) or 1), 1.0))
+            return self.ok([])
+        await asyncio.sleep(self.latency)
+        if method == "getMe":
+            return self.ok({"id": 123456789, "is_bot": True, "first_name": "Load", "username": "load_bot",
+                            "can_join_groups": True, "can_read_all_group_messages": False,
+                            "supports_inline_queries": False})
+        if method == "sendMessage":
+            self.message_id += 1
+            return self.ok({"message_id": self.message_id, "date": int(time.time()),
+                            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+                            "text": data.get("text", "")})
+        if method == "getUserProfilePhotos":
+            uid = int(data.get("user_id", 0))
+            photo = {"file_id": f"photo{uid}", "file_unique_id": f"u{uid}", "width": 160, "height": 160}
+            return self.ok({"total_count": 1, "photos": [[photo]]})
+        if method == "getFile":
+            fid = data.get("file_id", "")
+            return self.ok({"file_id": fid, "file_unique_id": fid, "file_size": 1024,
+                            "file_path": f"photos/{fid}.jpg"})
+        return self.ok(True)
+
+    async def file(self, request: web.Request) -> web.Response:
+        self.calls["file"] += 1
+        return web.Response(body=b"\xff\xd8\xff", content_type="image/jpeg")
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+# ── Sintetik foydalanuvchilar ─────────────────────────
+
+def make_init_data(user_id: int) -> str:
+    """territory_bot.verify_init_data() qabul qiladigan imzoli initData."""
+    params = {
+        "query_id": f"AAH{user_id:012d}",
+        "user": json.dumps({"id": user_id, "first_name": f"Load{user_id}"}, separators=(",", ":")),
+        "auth_date": str(int(time.time())),
+    }
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    secret_key = hmac.new(BOT_TOKEN.encode(), b"WebAppData", hashlib.sha256).digest()
+    params["hash"] = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    return "&".join(f"{k}={quote(v)}" for k, v in params.items())
+
+def loop_trek(rng: random.Random, n: int) -> tuple:
+    """Toshkent atrofida yopiq (boshi = oxiri) tasodifiy trek: (points, distance_m)."""
+    lat0 = CENTER[0] + rng.uniform(-0.05, 0.05)
+    lng0 = CENTER[1] + rng.uniform(-0.05, 0.05)
+    radius = rng.uniform(60, 400) / 111320
+    points = []
+    for i in range(n):
+        a = 2 * math.pi * i / n
+        r = radius * rng.uniform(0.9, 1.1)
+        points.append({"lat": round(lat0 + r * math.cos(a), 6),
+                       "lng": round(lng0 + r * math.sin(a) / math.cos(math.radians(lat0)), 6)})
+    points.append(dict(points[0]))
+    return points, 2 * math.pi * radius * 111320
+
+def random_bbox(rng: random.Random) -> str:
+    lat = CENTER[0] + rng.uniform(-0.05, 0.05)
+    lng = CENTER[1] + rng.uniform(-0.05, 0.05)
+    span = rng.choice((0.005, 0.02, 0.08))
+    return f"{lng - span:.5f},{lat - span:.5f},{lng + span:.5f},{lat + span:.5f}"
+
+# ── Yuklama ───────────────────────────────────────────
+
+class LoadRunner:
+    def __init__(self, base: str, users: int, mix: dict, points: int, seed: int):
+        self.base = base
+        self.users = [(uid, make_init_data(uid), TEAMS[uid % len(TEAMS)]) for uid in range(1, users + 1)]
+        self.mix = mix
+        self.points = points
+        self.rng = random.Random(seed)
+        self.latencies: dict = {name: [] for name in mix}
+        self.statuses: dict = {name: Counter() for name in mix}
+        self.max_zone_id = 1
+
+    async def trek(self, session):
+        uid, init_data, team = self.rng.choice(self.users)
+        points, dist = loop_trek(self.rng, self.points)
+        body = {"init_data": init_data, "team": team, "points": points, "distance": dist, "closed": True}
+        async with session.post(f"{self.base}/api/trek_submit", json=body) as r:
+            await r.read()
+            return r.status
+
+    async def zones(self, session):
+        query = f"bbox={random_bbox(self.rng)}&zoom={self.rng.choice((12, 14, 16, 17))}"
+        async with session.get(f"{self.base}/api/zones?{query}") as r:
+            data = await r.json()
+            if r.status == 200 and data:
+                self.max_zone_id = max(self.max_zone_id, max(z["id"] for z in data))
+            return r.status
+
+    async def action(self, session):
+        uid, init_data, _ = self.rng.choice(self.users)
+        body = {"init_data": init_data, "zone_id": self.rng.randint(1, self.max_zone_id),
+                "coins": self.rng.choice((10, 15, 30)), "action": self.rng.choice(("strengthen", "weaken"))}
+        async with session.post(f"{self.base}/api/zone/action", json=body) as r:
+            await r.read()
+            return r.status
+
+    async def worker(self, session, deadline: float):
+        names, weights = zip(*self.mix.items())
+        while time.perf_counter() < deadline:
+            name = self.rng.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                status = await getattr(self, name)(session)
+            except Exception as e:
+                status = type(e).__name__
+            self.latencies[name].append(time.perf_counter() - t0)
+            self.statuses[name][status] += 1
+
+    async def run(self, concurrency: int, duration: float) -> float:
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            t0 = time.perf_counter()
+            deadline = t0 + duration
+            await asyncio.gather(*(self.worker(session, deadline) for _ in range(concurrency)))
+            return time.perf_counter() - t0
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def db_footprint(path: str) -> dict:
+    size = sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    counts = {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0]
+              for t in ("users", "zones", "treks", "zone_history", "trek_jobs", "outbox")}
+    conn.close()
+    return {"bytes": size, **counts}
+
+async def wait_http(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url) as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} javob bermadi")
+
+async def wait_drain(base: str, timeout: float) -> float:
+    """Trek navbati bo'shaguncha kutish; sarflangan vaqt (s)."""
+    t0 = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() - t0 < timeout:
+            async with session.get(f"{base}/api/trek_queue") as r:
+                q = await r.json()
+            if q["queued"] == 0 and q["processing"] == 0:
+                break
+            await asyncio.sleep(0.2)
+    return time.perf_counter() - t0
+
+async def main_async(args):
+    tmp = tempfile.mkdtemp(prefix="territory_load_")
+    db_path = os.path.join(tmp, "load.db")
+    api_port, bot_port = free_port(), free_port()
+
+    fake = FakeTelegramAPI(args.api_latency_ms)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", api_port).start()
+
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "BOT_API_URL": f"http://127.0.0.1:{api_port}",
+        "DB_PATH": db_path,
+        "PORT": str(bot_port),
+    }
+    log_path = os.path.join(tmp, "bot.log")
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "territory_bot.py")],
+                                env=env, stdout=log, stderr=subprocess.STDOUT)
+    base = f"http://127.0.0.1:{bot_port}"
+    try:
+        await wait_http(f"{base}/health", 30)
+        before = db_footprint(db_path)
+
+        mix = dict((k, float(v)) for k, v in (p.split("=") for p in args.mix.split(",")))
+        load = LoadRunner(base, args.users, mix, args.points, args.seed)
+        elapsed = await load.run(args.concurrency, args.duration)
+        drain = await wait_drain(base, 120)
+        after = db_footprint(db_path)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+        await runner.cleanup()
+
+    print(f"{args.duration:.0f}s, concurrency={args.concurrency}, users={args.users}, "
+          f"trek={args.points} nuqta, seed={args.seed}")
+    print(f"{'endpoint':<10}{'req':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}  statuses")
+    total = 0
+    for name, lat in load.latencies.items():
+        lat.sort()
+        total += len(lat)
+        statuses = " ".join(f"{k}:{v}" for k, v in sorted(load.statuses[name].items(), key=str))
+        print(f"{name:<10}{len(lat):>8}{len(lat) / elapsed:>9.1f}{percentile(lat, .5) * 1000:>9.1f}"
+              f"{percentile(lat, .95) * 1000:>9.1f}{percentile(lat, .99) * 1000:>9.1f}  {statuses}")
+    print(f"{'total':<10}{total:>8}{total / elapsed:>9.1f}")
+    print(f"trek navbati bo'shadi: {drain:.1f}s keyin")
+    print("fake Bot API: " + ", ".join(f"{k}={v}" for k, v in sorted(fake.calls.items())))
+    growth = {k: after[k] - before[k] for k in after}
+    print(f"DB: {before['bytes'] / 1e6:.2f}MB -> {after['bytes'] / 1e6:.2f}MB; "
+          + ", ".join(f"{k} +{v}" for k, v in growth.items() if k != "bytes"))
+    print(f"bot log: {log_path}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--points", type=int, default=200, help="bitta trekdagi nuqtalar")
+    parser.add_argument("--mix", default="trek=1,zones=8,action=1")
+    parser.add_argument("--api-latency-ms", type=float, default=30, help="fake Bot API javob kechikishi")
+    parser.add_argument("--seed", type=int, default=42)
+    asyncio.run(main_async(parser.parse_args()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+treks.points: JSON TEXT (eski) vs delta/varint BLOB — DB hajmi va decode vaqti.
+
+Ishga tushirish:
+    python benchmarks/bench_points_encoding.py [--treks 500] [--points 2000]
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="territory_bench_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import territory_bot as tb  # noqa: E402
+
+def random_walk(n: int) -> list:
+    """GPS watchPosition'ga o'xshash yurish: ~1-5 m qadamlar, 1e-5 yaxlitlangan."""
+    lat, lng = 41.2995 + random.uniform(-0.05, 0.05), 69.2401 + random.uniform(-0.05, 0.05)
+    heading = random.uniform(0, 2 * math.pi)
+    points = []
+    for _ in range(n):
+        heading += random.gauss(0, 0.3)
+        step = random.uniform(1, 5) / 111320
+        lat += step * math.cos(heading)
+        lng += step * math.sin(heading) / math.cos(math.radians(lat))
+        points.append({"lat": round(lat, 5), "lng": round(lng, 5)})
+    return points
+
+def build_db(path: str, treks: list, encode) -> int:
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE treks (id INTEGER PRIMARY KEY, points TEXT NOT NULL)")
+    conn.executemany("INSERT INTO treks (points) VALUES (?)", [(encode(t),) for t in treks])
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.close()
+    return os.path.getsize(path)
+
+def time_decode(path: str, decode) -> float:
+    conn = sqlite3.connect(path)
+    t0 = time.perf_counter()
+    n = 0
+    for (raw,) in conn.execute("SELECT points FROM treks"):
+        decode(raw)
+        n += 1
+    conn.close()
+    return (time.perf_counter() - t0) / n * 1000
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--treks", type=int, default=500)
+    parser.add_argument("--points", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(42)
+    treks = [random_walk(args.points) for _ in range(args.treks)]
+
+    json_db = os.path.join(TMP_DIR, "json.db")
+    blob_db = os.path.join(TMP_DIR, "blob.db")
+    json_size = build_db(json_db, treks, json.dumps)
+    blob_size = build_db(blob_db, treks, tb.encode_points)
+    json_ms = time_decode(json_db, json.loads)
+    blob_ms = time_decode(blob_db, tb.decode_points)
+
+    print(f"{args.treks} trek x {args.points} nuqta")
+    print(f"{'format':<8}{'DB size':>12}{'bytes/pt':>10}{'decode ms/trek':>16}")
+    total = args.treks * args.points
+    for name, size, ms in (("json", json_size, json_ms), ("blob", blob_size, blob_ms)):
+        print(f"{name:<8}{size / 1e6:>10.2f}MB{size / total:>10.1f}{ms:>16.3f}")
+    print(f"hajm: {json_size / blob_size:.1f}x kichikroq")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Update qabul qilish: long polling (getUpdates) vs webhook (/api/* bilan bitta aiohttp server).
+
+Ikkala rejimda ham update'lar bir xil Application.update_queue'ga tushadi va
+trivial TypeHandler qayta ishlaydi — faqat qabul qilish yo'li o'lchanadi.
+Lokal fake Bot API getUpdates'ni long-poll qiladi; webhook rejimida "Telegram"
+update'larni tb.api_telegram_webhook route'iga secret token bilan POST qiladi.
+Tarmoq kechikishi har ikki yo'nalishda --rtt-ms / 2 sifatida modellanadi.
+
+1. burst: N ta update birdaniga keladi → hammasi qayta ishlanguncha update/s.
+2. paced: --rate update/s oqimi → keldi→handler kechikishi p50/p99.
+
+Yozib olingan update'larni qayta yuborish (har qatorda bitta Update JSON):
+    python benchmarks/bench_updates.py --updates-file updates.jsonl
+
+Ishga tushirish:
+    python benchmarks/bench_updates.py [--updates 5000] [--rate 200] [--rtt-ms 60] [--connections 100]
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="territory_bench_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "bench.db")
+os.environ.setdefault("WEBHOOK_URL", "https://bench.invalid")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+import territory_bot as tb  # noqa: E402
+from aiohttp import TCPConnector, web  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, TypeHandler  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+# ── Update'lar ────────────────────────────────────────
+
+def synthetic_update(update_id: int) -> dict:
+    """Xususiy chatdagi matn yoki joylashuv xabari (Telegram formatida)."""
+    uid = random.randint(1, 5000)
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": uid, "type": "private", "first_name": f"User{uid}"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"User{uid}"},
+    }
+    if random.random() < 0.3:
+        message["location"] = {"latitude": 41.2995 + random.uniform(-0.05, 0.05),
+                               "longitude": 69.2401 + random.uniform(-0.05, 0.05)}
+    else:
+        message["text"] = random.choice(("/stats", "/zones", "/coins", "📊 Statistika"))
+    return {"update_id": update_id, "message": message}
+
+def load_updates(path: str, n: int) -> list:
+    """JSONL'dagi yozib olingan update'larni n tagacha takrorlab, update_id'larni qayta raqamlaydi."""
+    with open(path, encoding="utf-8") as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+    return [{**recorded[i % len(recorded)], "update_id": i + 1} for i in range(n)]
+
+# ── Fake Telegram ─────────────────────────────────────
+
+class FakeTelegramAPI:
+    """getUpdates long-poll'ini va webhook'ni sozlash chaqiruvlarini o'ynaydi."""
+
+    def __init__(self, rtt_s: float):
+        self.half_rtt = rtt_s / 2
+        self.pending: list = []
+        self.arrived = asyncio.Event()
+        self.calls = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        return app
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.json() if request.content_type == "application/json" else dict(await request.post())
+        if method == "getMe":
+            return self.ok({"id": 123456789, "is_bot": True, "first_name": "Bench", "username": "bench_bot"})
+        if method != "getUpdates":
+            return self.ok(True)
+        self.calls += 1
+        await asyncio.sleep(self.half_rtt)  # so'rov Telegram'ga yetib borishi
+        offset = int(data.get("offset") or 0)
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending:
+            self.arrived.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.arrived.wait(), float(data.get("timeout") or 0))
+        batch = self.pending[:int(data.get("limit") or 100)]
+        await asyncio.sleep(self.half_rtt)  # javob botga qaytishi
+        return self.ok(batch)
+
+    def push(self, update: dict) -> None:
+        self.pending.append(update)
+        self.arrived.set()
+
+# ── O'lchash ──────────────────────────────────────────
+
+class Recorder:
+    def __init__(self):
+        self.sent: dict = {}
+        self.latencies: list = []
+        self.done = asyncio.Event()
+        self.expected = 0
+        self.last_id = 0
+
+    def reset(self, expected: int) -> None:
+        self.sent.clear()
+        self.latencies.clear()
+        self.done.clear()
+        self.expected = expected
+
+    async def handle(self, update: Update, ctx) -> None:
+        t0 = self.sent.pop(update.update_id, None)
+        if t0 is not None:
+            self.latencies.append(time.perf_counter() - t0)
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+async def produce(updates: list, rate: float, deliver, recorder: Recorder) -> float:
+    """Update'larni rate/s (0 — birdaniga) tezlikda yetkazadi; hammasi qayta ishlanguncha vaqt."""
+    recorder.reset(len(updates))
+    t0 = time.perf_counter()
+    tasks = []
+    for i, u in enumerate(updates):
+        if rate:
+            delay = t0 + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        recorder.last_id += 1  # getUpdates offset'i bosqichlar orasida ham o'sib borishi kerak
+        u = {**u, "update_id": recorder.last_id}
+        recorder.sent[u["update_id"]] = time.perf_counter()
+        tasks.append(deliver(u))
+    await asyncio.gather(*(t for t in tasks if t is not None))
+    await recorder.done.wait()
+    return time.perf_counter() - t0
+
+def report(mode: str, kind: str, n: int, elapsed: float, recorder: Recorder) -> None:
+    lat = sorted(recorder.latencies)
+    p99 = lat[min(len(lat) - 1, int(len(lat) * 0.99))]
+    print(f"{mode:<8}{kind:<7}{n:>7} update: {n / elapsed:8.0f} update/s, "
+          f"kechikish p50 {statistics.median(lat) * 1e3:7.1f} ms, p99 {p99 * 1e3:7.1f} ms")
+
+def build_app(api_url: str, recorder: Recorder, polling: bool) -> Application:
+    builder = Application.builder().token(tb.BOT_TOKEN).base_url(f"{api_url}/bot")
+    app = (builder if polling else builder.updater(None)).build()
+    app.add_handler(TypeHandler(Update, recorder.handle))
+    return app
+
+async def bench_polling(updates: list, args, recorder: Recorder, fake: FakeTelegramAPI, api_url: str) -> None:
+    app = build_app(api_url, recorder, polling=True)
+    async with app:
+        await app.updater.start_polling(poll_interval=0, timeout=10)
+        await app.start()
+
+        def deliver(u):
+            fake.push(u)
+
+        for kind, rate in (("burst", 0), ("paced", args.rate)):
+            batch = updates[:args.updates] if rate == 0 else updates[:int(args.rate * args.seconds)]
+            elapsed = await produce(batch, rate, deliver, recorder)
+            report("polling", kind, len(batch), elapsed, recorder)
+        await app.updater.stop()
+        await app.stop()
+    print(f"         getUpdates chaqiruvlari: {fake.calls}")
+
+async def bench_webhook(updates: list, args, recorder: Recorder, api_url: str) -> None:
+    app = build_app(api_url, recorder, polling=False)
+    tb._app = app
+    headers = {"X-Telegram-Bot-Api-Secret-Token": tb.WEBHOOK_SECRET}
+    async with app, TestClient(TestServer(tb.build_web_app()), connector=TCPConnector(limit=0)) as client:
+        await app.start()
+        r = await client.post(tb.WEBHOOK_PATH, json=updates[0], headers={"X-Telegram-Bot-Api-Secret-Token": "x"})
+        assert r.status == 403, r.status
+        r = await client.post(tb.WEBHOOK_PATH, data=b"{", headers=headers)
+        assert r.status == 400, r.status
+
+        # Telegram bir vaqtda ko'pi bilan max_connections ta so'rov yuboradi
+        slots = asyncio.Semaphore(args.connections)
+        half_rtt = args.rtt_ms / 2000
+
+        async def post(u):
+            async with slots:
+                await asyncio.sleep(half_rtt)
+                async with client.post(tb.WEBHOOK_PATH, json=u, headers=headers) as resp:
+                    assert resp.status == 200, resp.status
+                await asyncio.sleep(half_rtt)  # 200 javobi Telegram'ga qaytishi
+
+        def deliver(u):
+            return asyncio.ensure_future(post(u))
+
+        for kind, rate in (("burst", 0), ("paced", args.rate)):
+            batch = updates[:args.updates] if rate == 0 else updates[:int(args.rate * args.seconds)]
+            elapsed = await produce(batch, rate, deliver, recorder)
+            report("webhook", kind, len(batch), elapsed, recorder)
+        await app.stop()
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--updates-file", help="yozib olingan Update JSON'lar (JSONL)")
+    parser.add_argument("--rate", type=float, default=200, help="paced rejimda update/s")
+    parser.add_argument("--seconds", type=float, default=5, help="paced rejim davomiyligi")
+    parser.add_argument("--rtt-ms", type=float, default=60, help="bot ↔ Telegram round-trip")
+    parser.add_argument("--connections", type=int, default=100, help="webhook max_connections (set_webhook bilan bir xil)")
+    args = parser.parse_args()
+
+    random.seed(3)
+    count = max(args.updates, int(args.rate * args.seconds))
+    if args.updates_file:
+        updates = load_updates(args.updates_file, count)
+    else:
+        updates = [synthetic_update(i + 1) for i in range(count)]
+    recorder = Recorder()
+    print(f"rtt {args.rtt_ms:.0f} ms, webhook max_connections {args.connections}")
+    fake = FakeTelegramAPI(args.rtt_ms / 1000)
+    async with TestServer(fake.app()) as server:
+        api_url = str(server.make_url("")).rstrip("/")
+        await bench_polling(updates, args, recorder, fake, api_url)
+        await bench_webhook(updates, args, recorder, api_url)
+    tb.shutdown_db_executors()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Zona o'zgarishlari fan-out'i: ZoneEventHub ko'p jim obunachilar bilan.
+
+1. hub: _dispatch() narxi N ta obunachi (tasodifiy viewport'lar) uchun.
+2. e2e: /api/zones/stream'ga C ta haqiqiy SSE ulanish, health o'zgarishi
+   publish qilingandan barcha clientlarga yetib borguncha kechikish.
+3. polling: xuddi shu C ta client bitta REFRESH_MS aylanishida
+   /api/zones?since= (o'zgarishsiz, 304) yuborsa serverga tushadigan yuk.
+
+Ishga tushirish:
+    python benchmarks/bench_zone_stream.py [--zones 2000] [--clients 300] [--events 20]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+TMP_DIR = tempfile.mkdtemp(prefix="territory_bench_")
+os.environ["DB_PATH"] = os.path.join(TMP_DIR, "bench.db")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging  # noqa: E402
+
+import territory_bot as tb  # noqa: E402
+from aiohttp import TCPConnector, web  # noqa: E402
+from aiohttp.test_utils import TestClient, TestServer  # noqa: E402
+
+logging.getLogger().setLevel(logging.WARNING)
+
+LAT0, LNG0 = 41.2995, 69.2401
+
+def random_viewport() -> tuple:
+    """~2x3 km viewport Toshkent ichida: (min_lat, max_lat, min_lng, max_lng)"""
+    lat = LAT0 + random.uniform(-0.08, 0.08)
+    lng = LNG0 + random.uniform(-0.1, 0.1)
+    return lat - 0.009, lat + 0.009, lng - 0.018, lng + 0.018
+
+def seed_zones(n: int) -> list:
+    tb.init_db()
+    tb.migrate_db()
+    for uid in range(1, 51):
+        tb.upsert_user(uid, f"u{uid}", f"User {uid}")
+        tb.set_team(uid, random.choice(list(tb.TEAMS)))
+    ids = []
+    for _ in range(n):
+        uid = random.randint(1, 50)
+        ids.append(tb.create_zone_circle(uid, "red", LAT0 + random.uniform(-0.08, 0.08),
+                                         LNG0 + random.uniform(-0.1, 0.1), random.choice((50, 100, 200))))
+    with tb.get_db() as conn:  # har bir health o'zgarishi coin yechadi
+        conn.execute("UPDATE users SET coins = 1000000")
+    tb.backfill_coin_ledger()
+    tb.zone_cache.rebuild()
+    return ids
+
+def pct(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def bench_hub(zone_ids: list, subscribers: int, events: int):
+    hub = tb.ZoneEventHub(queue_size=events + 1)
+    subs = [hub.subscribe(None if random.random() < 0.1 else random_viewport()) for _ in range(subscribers)]
+    entries = [tb.zone_cache.get_many([zid]) for zid in random.sample(zone_ids, events)]
+    t0 = time.perf_counter()
+    for e in entries:
+        hub._dispatch("health", e)
+    elapsed = (time.perf_counter() - t0) / events
+    delivered = hub.delivered / events
+    print(f"hub      {subscribers:>6} obunachi: {elapsed * 1e3:8.3f} ms/hodisa, "
+          f"{elapsed / subscribers * 1e6:6.2f} µs/obunachi, {delivered:7.1f} yetkazildi/hodisa")
+    for s in subs:
+        hub.unsubscribe(s)
+
+async def read_events(response, expected: int, received: list):
+    count = 0
+    while count < expected:
+        line = await response.content.readline()
+        if not line:
+            return
+        if line.startswith(b"data:"):
+            received.append(time.perf_counter())
+            count += 1
+
+async def bench_e2e(zone_ids: list, clients: int, events: int):
+    app = web.Application(middlewares=[tb.metrics_middleware, tb.cors_middleware])
+    app.router.add_get("/api/zones", tb.api_zones)
+    app.router.add_get("/api/zones/stream", tb.api_zones_stream)
+    async with TestClient(TestServer(app), connector=TCPConnector(limit=0)) as c:
+        streams = [await c.get("/api/zones/stream") for _ in range(clients)]
+        for r in streams:
+            await r.content.readline()  # "retry: ..."
+            await r.content.readline()
+        received: list = []
+        readers = [asyncio.create_task(read_events(r, events, received)) for r in streams]
+        latencies, fanout = [], []
+        for zone_id in random.sample(zone_ids, events):
+            zone = tb.zone_cache.get_many([zone_id])[0].row
+            target = len(received) + clients
+            t0 = time.perf_counter()
+            await tb.db_write(tb.change_zone_health, zone["owner_id"], zone_id, "strengthen", 10)
+            while len(received) < target:
+                await asyncio.sleep(0.001)
+            latencies.extend(t - t0 for t in received[-clients:])
+            fanout.append(max(received[-clients:]) - t0)
+        await asyncio.gather(*readers)
+        print(f"e2e      {clients:>6} SSE client: fan-out p50 {statistics.median(fanout) * 1e3:6.1f} ms, "
+              f"yetkazish p50 {statistics.median(latencies) * 1e3:6.1f} ms, p99 {pct(latencies, 0.99) * 1e3:6.1f} ms")
+        for r in streams:
+            r.close()
+
+        version = tb.zone_cache.version
+        t0 = time.perf_counter()
+        responses = await asyncio.gather(*(c.get(f"/api/zones?since={version}") for _ in range(clients)))
+        elapsed = time.perf_counter() - t0
+        statuses = {r.status for r in responses}
+        print(f"polling  {clients:>6} client: bitta aylanish {elapsed * 1e3:6.1f} ms "
+              f"(status {sorted(statuses)}), REFRESH_MS=15s'da doimiy {clients / 15:.0f} so'rov/s")
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--zones", type=int, default=2000)
+    parser.add_argument("--clients", type=int, default=300)
+    parser.add_argument("--events", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(7)
+    zone_ids = seed_zones(args.zones)
+    for n in (100, 1000, 10000, 50000):
+        await bench_hub(zone_ids, n, args.events)
+    await bench_e2e(zone_ids, args.clients, args.events)
+    tb.shutdown_db_executors()
+
+if __name__ == "__main__":
+    asyncio.run(main())
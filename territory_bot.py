@@ -17,23 +17,54 @@
     5. Clock skew tolerance (60s)
     
 🔧 Yangi environment variables:
-    - INIT_DATA_MAX_AGE (default: 3600 soniya)
+    - INIT_DATA_MAX_AGE (default: 3600 soniya), INIT_DATA_CACHE_SIZE (default: 10000)
+    - DB_POOL_SIZE (default: 8), DB_BUSY_TIMEOUT_MS (default: 5000)
+    - DB_READ_WORKERS (default: 4)
+    - OUTBOX_GLOBAL_RATE (default: 25 xabar/s), OUTBOX_CHAT_INTERVAL (default: 1.0 s)
+    - OUTBOX_MAX_ATTEMPTS (default: 5)
+    - TREK_WORKERS (default: 2)
+    - UPDATE_WORKERS (default: 16), UPDATE_MAX_PENDING (default: 512)
+    - LIVE_TREK_IDLE_S (default: 7200), LIVE_TREK_MAX_POINTS (default: 20000)
+    - PRESENCE_TTL_S (default: 180), PRESENCE_TAIL (default: 60), PRESENCE_LIMIT (default: 500)
+    - ZONE_STREAM_QUEUE (default: 256), ZONE_STREAM_PING_S (default: 25)
+    - PHOTO_CACHE_TTL (default: 3000 s), PHOTO_CACHE_SIZE (default: 5000)
+    - TREK_MIN_STEP_M (default: 5), TREK_MAX_JUMP_M (default: 200), TREK_SIMPLIFY_M (default: 2)
+    - BOT_API_URL (default: https://api.telegram.org) — load test'da lokal fake API
+    - WEBHOOK_URL (default: bo'sh — polling), WEBHOOK_PATH (default: /telegram/webhook),
+      WEBHOOK_SECRET (default: BOT_TOKEN'dan hosil qilinadi), PORT (default: 8080)
     
 📅 Last updated: 2026-03-04
 """
 
 import asyncio
+import bisect
+import functools
 import logging
 import os
 import json
 import math
 import hmac
 import hashlib
+import queue
+import signal
+import struct
+import sys
+import threading
 import time
+from array import array
+from collections import Counter, OrderedDict
+from itertools import accumulate
+from typing import NamedTuple
 from urllib.parse import unquote
 from datetime import datetime, timedelta
-from contextlib import contextmanager
-from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from aiohttp import WSMsgType, web
+
+try:
+    import numpy as np
+except ImportError:  # NumPy ixtiyoriy — geometriya sof Python'da ishlaydi
+    np = None
 
 import sqlite3
 from telegram import (
@@ -41,10 +72,12 @@ from telegram import (
     KeyboardButton, ReplyKeyboardMarkup, WebAppInfo
 )
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
+    Application, BaseUpdateProcessor, CommandHandler, MessageHandler,
     CallbackQueryHandler, ContextTypes, filters
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
 
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
@@ -61,12 +94,64 @@ if not BOT_TOKEN or BOT_TOKEN == "YOUR_BOT_TOKEN_HERE":
 logger.info(f"✅ BOT_TOKEN sozlangan: {BOT_TOKEN[:20]}...")
 
 DB_PATH      = os.getenv("DB_PATH", "/data/territory.db")
+BOT_API_URL  = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
 MINI_APP_URL = os.getenv("MINI_APP_URL", "https://iyusuf1-lang.github.io/my_territory_tash_bot/")
+PORT         = int(os.getenv("PORT", "8080"))
+
+# 🪝 Webhook: WEBHOOK_URL berilsa update'lar /api/* bilan bitta aiohttp serverga POST qilinadi
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH   = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+# 🗄 SQLite connection pool sozlamalari
+DB_POOL_SIZE       = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_READ_WORKERS    = int(os.getenv("DB_READ_WORKERS", "4"))
 
 # ✅ initData max age (default: 1 hour = 3600 seconds)
 INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", "3600"))
+# Tekshirilgan initData keshi (bitta sessiya davomida bir xil satr keladi)
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))
+
+# 🗺 Xarita: shu zoom'dan past bo'lsa polygonlar soddalashtiriladi
+ZONES_FULL_DETAIL_ZOOM = int(os.getenv("ZONES_FULL_DETAIL_ZOOM", "16"))
+# Viewport so'rovida maksimal zonalar soni (kattalari birinchi)
+ZONES_VIEWPORT_LIMIT   = int(os.getenv("ZONES_VIEWPORT_LIMIT", "2000"))
+# /api/zones/stream: obunachi navbati (to'lsa qayta ulanadi) va keep-alive oralig'i
+ZONE_STREAM_QUEUE     = int(os.getenv("ZONE_STREAM_QUEUE", "256"))
+ZONE_STREAM_PING_S    = float(os.getenv("ZONE_STREAM_PING_S", "25"))
 logger.info(f"⏰ initData max age: {INIT_DATA_MAX_AGE} soniya")
 
+# 📬 Bildirishnomalar navbati: Telegram limitlari (~30 xabar/s, 1 xabar/s har chatga)
+OUTBOX_GLOBAL_RATE   = float(os.getenv("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_INTERVAL = float(os.getenv("OUTBOX_CHAT_INTERVAL", "1.0"))
+OUTBOX_MAX_ATTEMPTS  = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+
+# 🏃 /api/trek_submit navbatini qayta ishlovchi worker'lar soni
+TREK_WORKERS = int(os.getenv("TREK_WORKERS", "2"))
+
+# 🧵 Telegram update'lari: parallel handler'lar soni va qabul qilingan (kutayotgan) update'lar chegarasi
+UPDATE_WORKERS     = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "512"))
+
+# 📡 Live trek (WebSocket): xotiradagi trek shuncha soniya jim tursa bekor qilinadi
+LIVE_TREK_IDLE_S     = float(os.getenv("LIVE_TREK_IDLE_S", "7200"))
+LIVE_TREK_MAX_POINTS = int(os.getenv("LIVE_TREK_MAX_POINTS", "20000"))
+
+# 👥 Xaritadagi faol o'yinchilar: oxirgi joylashuv shuncha soniya ko'rinadi
+PRESENCE_TTL_S  = float(os.getenv("PRESENCE_TTL_S", "180"))
+PRESENCE_TAIL   = int(os.getenv("PRESENCE_TAIL", "60"))      # xaritada trekning oxirgi N nuqtasi
+PRESENCE_LIMIT  = int(os.getenv("PRESENCE_LIMIT", "500"))    # bitta javobda maksimal o'yinchi/trek
+
+# 🖼 Profil rasmi URL keshi (Telegram fayl havolasi kamida 1 soat amal qiladi)
+PHOTO_CACHE_TTL  = float(os.getenv("PHOTO_CACHE_TTL", "3000"))
+PHOTO_CACHE_SIZE = int(os.getenv("PHOTO_CACHE_SIZE", "5000"))
+
+# 🧹 GPS trekni tozalash: turib qolish shovqini, sakrashlar, polygon soddalashtirish (metr)
+TREK_MIN_STEP_M = float(os.getenv("TREK_MIN_STEP_M", "5"))
+TREK_MAX_JUMP_M = float(os.getenv("TREK_MAX_JUMP_M", "200"))
+TREK_SIMPLIFY_M = float(os.getenv("TREK_SIMPLIFY_M", "2"))
+
 TEAMS = {
     "red":    {"name": "🔴 Qizil",   "emoji": "🔴"},
     "blue":   {"name": "🔵 Ko'k",    "emoji": "🔵"},
@@ -76,27 +161,31 @@ TEAMS = {
 
 MODE_IDLE   = "idle"
 MODE_CIRCLE = "circle"
-notif_cache: dict = {}
 
 _app: Application = None
-background_tasks = set()
 
 # ══════════════════════════════════════════════════════
 # ACHIEVEMENTS TIZIMI
 # ══════════════════════════════════════════════════════
 
+# "stat"/"min": users jadvalidagi ustun va yutuq uchun minimal qiymat
 ACHIEVEMENT_LIST = {
-    "first_zone":    {"title": "🏁 Birinchi zona",      "desc": "Birinchi zona yaratdingiz!"},
-    "walker_1km":    {"title": "🚶 1 km yurish",         "desc": "Jami 1 km yurdingiz"},
-    "walker_5km":    {"title": "🏃 5 km yurish",         "desc": "Jami 5 km yurdingiz"},
-    "walker_10km":   {"title": "🏅 10 km yurish",        "desc": "Jami 10 km yurdingiz"},
-    "conqueror_5":   {"title": "⚔️ 5 zona egallash",     "desc": "5 ta zona egalladingiz"},
-    "conqueror_10":  {"title": "🏰 10 zona egallash",    "desc": "10 ta zona egalladingiz"},
-    "landlord_3":    {"title": "🗺 3 zonaga egalik",     "desc": "3 ta zonaga ega bo'ldingiz"},
-    "landlord_10":   {"title": "👑 10 zonaga egalik",    "desc": "10 ta zonaga ega bo'ldingiz"},
-    "referral_3":    {"title": "👥 3 ta referral",       "desc": "3 ta do'stni taklif qildingiz"},
+    "first_zone":    {"title": "🏁 Birinchi zona",      "desc": "Birinchi zona yaratdingiz!",     "stat": "zones_owned",    "min": 1},
+    "walker_1km":    {"title": "🚶 1 km yurish",         "desc": "Jami 1 km yurdingiz",            "stat": "total_km",       "min": 1},
+    "walker_5km":    {"title": "🏃 5 km yurish",         "desc": "Jami 5 km yurdingiz",            "stat": "total_km",       "min": 5},
+    "walker_10km":   {"title": "🏅 10 km yurish",        "desc": "Jami 10 km yurdingiz",           "stat": "total_km",       "min": 10},
+    "conqueror_5":   {"title": "⚔️ 5 zona egallash",     "desc": "5 ta zona egalladingiz",         "stat": "zones_taken",    "min": 5},
+    "conqueror_10":  {"title": "🏰 10 zona egallash",    "desc": "10 ta zona egalladingiz",        "stat": "zones_taken",    "min": 10},
+    "landlord_3":    {"title": "🗺 3 zonaga egalik",     "desc": "3 ta zonaga ega bo'ldingiz",     "stat": "zones_owned",    "min": 3},
+    "landlord_10":   {"title": "👑 10 zonaga egalik",    "desc": "10 ta zonaga ega bo'ldingiz",    "stat": "zones_owned",    "min": 10},
+    "referral_3":    {"title": "👥 3 ta referral",       "desc": "3 ta do'stni taklif qildingiz",  "stat": "referral_count", "min": 3},
 }
 
+# (code, stat, min) — check_and_award() shu jadval bo'yicha bir o'tishda tekshiradi
+ACHIEVEMENT_RULES = tuple(
+    (code, a["stat"], a["min"]) for code, a in ACHIEVEMENT_LIST.items()
+)
+
 # ══════════════════════════════════════════════════════
 # CORS HEADERS
 # ══════════════════════════════════════════════════════
@@ -104,7 +193,8 @@ ACHIEVEMENT_LIST = {
 CORS_HEADERS = {
     "Access-Control-Allow-Origin":  "*",
     "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
-    "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Init-Data",
+    "Access-Control-Allow-Headers": "Content-Type, X-Telegram-Init-Data, If-None-Match",
+    "Access-Control-Expose-Headers": "ETag, X-Zone-Version",
 }
 
 @web.middleware
@@ -116,12 +206,207 @@ async def cors_middleware(request, handler):
         response.headers[k] = v
     return response
 
+# ══════════════════════════════════════════════════════
+# METRICS (Prometheus text format)
+# ══════════════════════════════════════════════════════
+# /metrics — route va handler'lar, DB chaqiruvlari (funksiya nomi bo'yicha),
+# capture o'lchamlari va Bot API so'rovlari uchun hisoblagich/histogramlar.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS    = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape_label(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _format_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._lock = threading.Lock()
+        self._values: dict = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}" for k, v in items]
+        return lines
+
+class HistogramMetric:
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self._lock = threading.Lock()
+        self._values: dict = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            row = self._values.get(label_values)
+            if row is None:
+                row = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *label_values)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        for k, row in items:
+            for bound, n in zip(self.buckets, row):
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, k, le)} {n}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, k, le)} {row[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, k)} {_format_value(row[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, k)} {row[-1]}")
+        return lines
+
+class GaugeMetric:
+    """
+    Qiymati render paytida fn() dan olinadi: float yoki {label_values: float}.
+    kind="counter" — boshqa obyekt ichida yuritiladigan o'suvchi hisoblagichlar uchun.
+    """
+
+    def __init__(self, name: str, help_text: str, fn, labels: tuple = (), kind: str = "gauge"):
+        self.name, self.help, self.fn, self.labels, self.kind = name, help_text, fn, labels, kind
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn()
+        items = sorted(value.items()) if isinstance(value, dict) else [((), value)]
+        lines += [f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}" for k, v in items]
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: tuple = ()) -> CounterMetric:
+        return self.register(CounterMetric(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> HistogramMetric:
+        return self.register(HistogramMetric(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, fn, labels: tuple = (), kind: str = "gauge") -> GaugeMetric:
+        return self.register(GaugeMetric(name, help_text, fn, labels, kind))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines += metric.render()
+            except Exception as e:
+                logger.warning(f"📈 Metrika {metric.name} render xatosi: {e}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+HTTP_REQUESTS = metrics.counter(
+    "http_requests_total", "HTTP so'rovlar soni", ("route", "method", "status"))
+HTTP_LATENCY = metrics.histogram(
+    "http_request_duration_seconds", "HTTP so'rov vaqti", ("route", "method"))
+HANDLER_LATENCY = metrics.histogram(
+    "bot_handler_duration_seconds", "Telegram handler vaqti", ("handler",))
+HANDLER_ERRORS = metrics.counter(
+    "bot_handler_errors_total", "Telegram handler xatolari", ("handler",))
+DB_CALL_LATENCY = metrics.histogram(
+    "db_call_duration_seconds", "DB funksiyasi bajarilish vaqti (thread ichida)", ("site", "pool"))
+DB_QUEUE_WAIT = metrics.histogram(
+    "db_executor_wait_seconds", "DB executor navbatida kutish vaqti", ("pool",))
+DB_CALL_ERRORS = metrics.counter(
+    "db_call_errors_total", "DB funksiyasi xatolari", ("site", "pool"))
+CAPTURE_CANDIDATES = metrics.histogram(
+    "capture_scan_candidates", "Trek bbox'idagi nomzod zonalar soni", buckets=SIZE_BUCKETS)
+CAPTURE_SIZE = metrics.histogram(
+    "capture_zones_captured", "Bitta trekda egallangan zonalar soni", buckets=SIZE_BUCKETS)
+BOT_API_LATENCY = metrics.histogram(
+    "bot_api_request_duration_seconds", "Bot API so'rov vaqti", ("method",))
+BOT_API_ERRORS = metrics.counter(
+    "bot_api_errors_total", "Bot API xatolari (HTTP kod yoki exception nomi)", ("method", "error"))
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    route = request.match_info.route.resource
+    route = route.canonical if route is not None else "unmatched"
+    status = 500
+    t0 = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_LATENCY.observe(time.perf_counter() - t0, route, request.method)
+        HTTP_REQUESTS.inc(route, request.method, status)
+
+def instrumented(fn):
+    """Telegram handler'ni vaqt va xato metrikalari bilan o'rash."""
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(update, ctx):
+        t0 = time.perf_counter()
+        try:
+            return await fn(update, ctx)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - t0, name)
+    return wrapper
+
+class InstrumentedRequest(HTTPXRequest):
+    """Bot API so'rovlari: method bo'yicha vaqt va xatolar."""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception as e:
+            BOT_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            BOT_API_LATENCY.observe(time.perf_counter() - t0, api_method)
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
 # ══════════════════════════════════════════════════════
 # DATABASE
 # ══════════════════════════════════════════════════════
 
 def init_db():
     with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             user_id        INTEGER PRIMARY KEY,
@@ -151,6 +436,7 @@ def init_db():
             active      INTEGER DEFAULT 1,
             photo_url   TEXT DEFAULT NULL,
             created_at  TEXT DEFAULT (datetime('now')),
+            version     INTEGER DEFAULT 0,
             FOREIGN KEY (owner_id) REFERENCES users(user_id)
         );
         CREATE TABLE IF NOT EXISTS zone_history (
@@ -180,6 +466,71 @@ def init_db():
             earned_at TEXT DEFAULT (datetime('now')),
             UNIQUE(user_id, code)
         );
+        -- Haftalik reyting uchun kunlik yig'indilar (process_trek yangilaydi)
+        CREATE TABLE IF NOT EXISTS user_daily_stats (
+            user_id     INTEGER NOT NULL,
+            day         TEXT NOT NULL,
+            trek_count  INTEGER DEFAULT 0,
+            distance_m  REAL DEFAULT 0,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_daily_stats_day ON user_daily_stats(day);
+        CREATE INDEX IF NOT EXISTS idx_treks_user_status ON treks(user_id, status, finished_at);
+        CREATE INDEX IF NOT EXISTS idx_users_zones_owned ON users(zones_owned DESC);
+        -- /api/trek_submit navbati (TrekJobQueue qayta ishlaydi)
+        CREATE TABLE IF NOT EXISTS trek_jobs (
+            id          INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id     INTEGER NOT NULL,
+            team        TEXT,
+            points      BLOB NOT NULL,
+            distance_m  REAL DEFAULT 0,
+            closed      INTEGER DEFAULT 0,
+            status      TEXT DEFAULT 'queued',
+            message     TEXT,
+            error       TEXT,
+            created_at  REAL NOT NULL,
+            started_at  REAL,
+            finished_at REAL,
+            trek_id     INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_trek_jobs_status ON trek_jobs(status, id);
+        -- Profil rasmi URL keshi (photo_url NULL — rasm yo'q)
+        CREATE TABLE IF NOT EXISTS user_photos (
+            user_id    INTEGER PRIMARY KEY,
+            photo_url  TEXT,
+            fetched_at REAL NOT NULL
+        );
+        -- Yuborilmagan bildirishnomalar (NotificationOutbox yuboradi va o'chiradi)
+        CREATE TABLE IF NOT EXISTS outbox (
+            id              INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id         INTEGER NOT NULL,
+            kind            TEXT NOT NULL,
+            payload         TEXT NOT NULL,
+            attempts        INTEGER DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error      TEXT,
+            created_at      TEXT DEFAULT (datetime('now'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(next_attempt_at);
+        -- Coin harakatlari: har foydalanuvchi uchun SUM(delta) = users.coins (audit_coin_ledger)
+        CREATE TABLE IF NOT EXISTS coin_ledger (
+            id         INTEGER PRIMARY KEY,
+            user_id    INTEGER NOT NULL,
+            delta      INTEGER NOT NULL,
+            balance    INTEGER NOT NULL,
+            reason     TEXT NOT NULL,
+            ref_id     INTEGER,
+            created_at TEXT DEFAULT (datetime('now'))
+        );
+        CREATE INDEX IF NOT EXISTS idx_coin_ledger_user ON coin_ledger(user_id, id);
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        -- Zonalar bbox'i uchun fazoviy indeks (+owner_id — yordamchi ustun)
+        CREATE VIRTUAL TABLE IF NOT EXISTS zones_rtree USING rtree(
+            id, min_lat, max_lat, min_lng, max_lng, +owner_id
+        );
         """)
         conn.commit()
     logger.info("✅ DB initialized")
@@ -189,6 +540,8 @@ def migrate_db():
     migrations = [
         "ALTER TABLE users ADD COLUMN coins INTEGER DEFAULT 0",
         "ALTER TABLE zones ADD COLUMN health INTEGER DEFAULT 100",
+        "ALTER TABLE zones ADD COLUMN version INTEGER DEFAULT 0",
+        "ALTER TABLE trek_jobs ADD COLUMN trek_id INTEGER",
     ]
     with sqlite3.connect(DB_PATH) as conn:
         for sql in migrations:
@@ -198,19 +551,155 @@ def migrate_db():
                 logger.info(f"✅ Migration: {sql[:50]}")
             except sqlite3.OperationalError:
                 pass  # Column already exists
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_zones_version ON zones(version)")
+        # Eski DB: zonalar bor, lekin zone_version yo'q — 0 versiya since=0 bilan adashadi
+        conn.execute("""
+            INSERT OR IGNORE INTO meta (key, value)
+            SELECT 'zone_version', MAX(1, COALESCE(MAX(version), 0)) FROM zones HAVING COUNT(*) > 0
+        """)
+        conn.commit()
+    indexed = index_missing_zones()
+    if indexed:
+        logger.info(f"✅ Migration: {indexed} ta zona R*Tree indeksiga qo'shildi")
+    backfilled = backfill_daily_stats()
+    if backfilled:
+        logger.info(f"✅ Migration: {backfilled} ta kunlik statistika qatori treks'dan tiklandi")
+    converted = migrate_trek_points()
+    if converted:
+        logger.info(f"✅ Migration: {converted} ta trek nuqtalari BLOB formatga o'tkazildi")
+    opened = backfill_coin_ledger()
+    if opened:
+        logger.info(f"✅ Migration: {opened} ta foydalanuvchi balansi coin_ledger'ga 'opening' sifatida yozildi")
+    mismatched = audit_coin_ledger()
+    if mismatched:
+        logger.warning(f"⚠️ coin_ledger: {len(mismatched)} ta balans mos emas, masalan {mismatched[:5]}")
+
+# WAL: o'quvchilar (/api/zones) yozuvchini (trek) kutmaydi.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",        # WAL bilan xavfsiz, fsync kamroq
+    "PRAGMA cache_size=-16000",         # ~16 MB page cache
+    "PRAGMA mmap_size=134217728",       # 128 MB memory-mapped I/O
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+def open_db_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,   # pool ulanishlarni thread'lar orasida beradi
+        cached_statements=256,     # prepared statement'lar qayta ishlatiladi
+    )
+    conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+class ConnectionPool:
+    """
+    Uzoq yashovchi SQLite ulanishlar pool'i.
+
+    Ulanishlar kerak bo'lganda ochiladi (max `size` ta) va yopilmasdan
+    qaytariladi — har bir so'rov uchun connect/close qilinmaydi.
+    """
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return open_db_connection()
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get()
+
+    def release(self, conn: sqlite3.Connection, broken: bool = False):
+        if broken:
+            with self._lock:
+                self._created -= 1
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            return
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            conn.close()
+
+db_pool = ConnectionPool(max(DB_POOL_SIZE, DB_READ_WORKERS + 1))
 
 @contextmanager
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.acquire()
+    broken = False
     try:
         yield conn
         conn.commit()
     except Exception:
-        conn.rollback()
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            broken = True
         raise
     finally:
-        conn.close()
+        db_pool.release(conn, broken)
+
+# ══════════════════════════════════════════════════════
+# ASYNC DB QATLAMI
+# ══════════════════════════════════════════════════════
+# sqlite3 chaqiruvlari event loop'ni to'xtatmasligi uchun thread'larda
+# bajariladi: o'qishlar parallel, yozuvlar esa bitta writer thread
+# navbatida (SQLite baribir bitta yozuvchiga ruxsat beradi).
+
+_db_reader = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db-read")
+_db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+def _timed_db_call(pool: str, submitted: float, fn, args, kwargs):
+    started = time.perf_counter()
+    DB_QUEUE_WAIT.observe(started - submitted, pool)
+    site = getattr(fn, "__qualname__", None) or getattr(fn, "__name__", "unknown")
+    try:
+        return fn(*args, **kwargs)
+    except Exception:
+        DB_CALL_ERRORS.inc(site, pool)
+        raise
+    finally:
+        DB_CALL_LATENCY.observe(time.perf_counter() - started, site, pool)
+
+async def db_read(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _db_reader, _timed_db_call, "read", time.perf_counter(), fn, args, kwargs)
+
+async def db_write(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _db_writer, _timed_db_call, "write", time.perf_counter(), fn, args, kwargs)
+
+def shutdown_db_executors():
+    _db_reader.shutdown(wait=True)
+    _db_writer.shutdown(wait=True)
+    db_pool.close_all()
 
 def get_user(user_id: int) -> dict | None:
     with get_db() as conn:
@@ -218,17 +707,26 @@ def get_user(user_id: int) -> dict | None:
         return dict(row) if row else None
 
 def upsert_user(user_id: int, username: str, first_name: str):
+    """Ism o'zgarmagan bo'lsa hech narsa yozilmaydi — reyting versiyasi (ETag) o'zgarmaydi."""
     with get_db() as conn:
-        conn.execute("""
+        written = conn.execute("""
             INSERT INTO users (user_id, username, first_name)
             VALUES (?, ?, ?)
             ON CONFLICT(user_id) DO UPDATE SET
                 username=excluded.username, first_name=excluded.first_name
-        """, (user_id, username or "", first_name or "Nomsiz"))
+            WHERE username IS NOT excluded.username OR first_name IS NOT excluded.first_name
+        """, (user_id, username or "", first_name or "Nomsiz")).rowcount
+        changed = ranked_users(conn, [user_id]) if written else []
+    if written:
+        weekly_top.invalidate()
+        user_rankings.update(changed)
 
 def set_team(user_id: int, team: str):
     with get_db() as conn:
         conn.execute("UPDATE users SET team=? WHERE user_id=?", (team, user_id))
+        changed = ranked_users(conn, [user_id])
+    weekly_top.invalidate()
+    user_rankings.update(changed)
 
 # ══════════════════════════════════════════════════════
 # REFERRAL TIZIMI
@@ -259,135 +757,250 @@ def process_referral(new_user_id: int, referrer_id: int):
 # ✅ TELEGRAM INIT DATA PARSER — TO'G'RILANDI!
 # ══════════════════════════════════════════════════════
 
-def parse_init_data(init_data: str) -> dict | None:
+# secret_key = HMAC_SHA256(key=BOT_TOKEN, msg="WebAppData") — bir marta hisoblanadi
+WEBAPP_SECRET_KEY = hmac.new(BOT_TOKEN.encode(), b"WebAppData", hashlib.sha256).digest()
+
+class InitDataResult(NamedTuple):
+    """
+    verify_init_data() natijasi: user yoki reason (xato kodi).
+
+    reason: EMPTY, NO_HASH, NO_AUTH_DATE, BAD_AUTH_DATE, SESSION_EXPIRED,
+    FUTURE_AUTH_DATE, BAD_HASH, NO_USER, BAD_USER.
+    """
+    user: dict | None
+    reason: str | None = None
+    age: int | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.user is not None
+
+class VerifiedInitDataCache:
+    """Tekshirilgan initData satri -> (user, amal qilish muddati). LRU, max_size gacha."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, init_data: str):
+        with self._lock:
+            entry = self._entries.get(init_data)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(init_data)
+            self.hits += 1
+            return entry
+
+    def put(self, init_data: str, user: dict, auth_date: int):
+        with self._lock:
+            self._entries[init_data] = (user, auth_date)
+            self._entries.move_to_end(init_data)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, init_data: str):
+        with self._lock:
+            self._entries.pop(init_data, None)
+
+init_data_cache = VerifiedInitDataCache(INIT_DATA_CACHE_SIZE)
+
+def check_auth_age(auth_date: int, now: int) -> InitDataResult | None:
+    """Muddati o'tgan yoki kelajakdagi auth_date uchun xato natija, aks holda None."""
+    age = now - auth_date
+    if age > INIT_DATA_MAX_AGE:
+        return InitDataResult(None, "SESSION_EXPIRED", age)
+    if age < -60:  # 60 soniya clock skew'ga ruxsat
+        return InitDataResult(None, "FUTURE_AUTH_DATE", age)
+    return None
+
+def verify_init_data(init_data: str, now: int | None = None) -> InitDataResult:
     """
     Telegram WebApp initData ni xavfsiz tekshirish.
-    
+
     ✅ CHECKS:
         1. HMAC signature validation
         2. Expiration check (auth_date < INIT_DATA_MAX_AGE)
         3. User data presence
-    
+
     ✅ TO'G'RI HMAC tartib:
-        secret_key = HMAC_SHA256(key=BOT_TOKEN, msg="WebAppData")
+        secret_key = HMAC_SHA256(key=BOT_TOKEN, msg="WebAppData")  — WEBAPP_SECRET_KEY
         hash       = HMAC_SHA256(key=secret_key, msg=data_check_string)
+
+    Muvaffaqiyatli tekshirilgan satr init_data_cache'da auth_date +
+    INIT_DATA_MAX_AGE gacha saqlanadi — takroriy so'rovlar HMAC'siz o'tadi.
     """
     if not init_data:
-        logger.error("❌ initData BO'SH keldi!")
-        return None
-    
+        return InitDataResult(None, "EMPTY")
+    now = int(time.time()) if now is None else now
+
+    cached = init_data_cache.get(init_data)
+    if cached is not None:
+        user, auth_date = cached
+        failed = check_auth_age(auth_date, now)
+        if failed:
+            init_data_cache.discard(init_data)
+            return failed
+        return InitDataResult(user, None, now - auth_date)
+
+    # Manual parsing — URL encoding muammolarini oldini oladi
+    params = {}
+    for pair in init_data.split("&"):
+        key, sep, val = pair.partition("=")
+        if sep:
+            params[unquote(key)] = unquote(val)
+
+    hash_val = params.pop("hash", None)
+    if not hash_val:
+        return InitDataResult(None, "NO_HASH")
+
+    # Muddat HMAC'dan oldin tekshiriladi (arzonroq)
+    if "auth_date" not in params:
+        return InitDataResult(None, "NO_AUTH_DATE")
     try:
-        logger.info(f"📥 initData uzunligi: {len(init_data)}")
-
-        # 1. Manual parsing — URL encoding muammolarini oldini oladi
-        params = {}
-        for pair in init_data.split("&"):
-            idx = pair.find("=")
-            if idx == -1:
-                continue
-            key = unquote(pair[:idx])
-            val = unquote(pair[idx + 1:])
-            params[key] = val
-
-        # 2. Extract hash
-        hash_val = params.pop("hash", None)
-        if not hash_val:
-            logger.error("❌ hash topilmadi initData'da!")
-            return None
-
-        # ✅ 3. NEW: Check expiration BEFORE HMAC validation (faster)
-        auth_date = params.get("auth_date")
-        if not auth_date:
-            logger.error("❌ auth_date topilmadi initData'da!")
-            return None
-        
-        try:
-            auth_timestamp = int(auth_date)
-            current_timestamp = int(time.time())
-            age_seconds = current_timestamp - auth_timestamp
-            
-            logger.info(f"⏰ initData age: {age_seconds}s (max: {INIT_DATA_MAX_AGE}s)")
-            
-            # Check if expired
-            if age_seconds > INIT_DATA_MAX_AGE:
-                logger.error(f"❌ initData EXPIRE BO'LGAN! Age: {age_seconds}s > {INIT_DATA_MAX_AGE}s")
-                logger.error("   💡 Foydalanuvchi botni qayta ochishi kerak!")
-                return None
-            
-            # Check if auth_date is in future (clock skew)
-            if age_seconds < -60:  # Allow 60 seconds clock skew
-                logger.error(f"❌ auth_date kelajakda! {auth_date}")
-                return None
-                
-        except ValueError as e:
-            logger.error(f"❌ auth_date noto'g'ri format: {auth_date}, error: {e}")
-            return None
-
-        # 4. Build data_check_string — sorted, \n bilan ajratilgan
-        data_check_string = "\n".join(
-            f"{k}={v}" for k, v in sorted(params.items())
-        )
+        auth_date = int(params["auth_date"])
+    except ValueError:
+        return InitDataResult(None, "BAD_AUTH_DATE")
+    failed = check_auth_age(auth_date, now)
+    if failed:
+        return failed
+
+    # data_check_string — sorted, \n bilan ajratilgan
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    calculated_hash = hmac.new(WEBAPP_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
+    # constant-time comparison
+    if not hmac.compare_digest(calculated_hash, hash_val):
+        return InitDataResult(None, "BAD_HASH", now - auth_date)
+
+    user_str = params.get("user")
+    if not user_str:
+        return InitDataResult(None, "NO_USER", now - auth_date)
+    try:
+        user = json.loads(user_str)
+    except json.JSONDecodeError:
+        return InitDataResult(None, "BAD_USER", now - auth_date)
+    if not isinstance(user, dict):
+        return InitDataResult(None, "BAD_USER", now - auth_date)
 
-        # 5. ✅ HMAC VALIDATION (Telegram docs bo'yicha):
-        #    Step 1: secret_key = HMAC_SHA256(key=BOT_TOKEN, msg="WebAppData")
-        secret_key = hmac.new(
-            BOT_TOKEN.encode(),  # ← key: bot token
-            b"WebAppData",       # ← msg: "WebAppData" string
-            hashlib.sha256
-        ).digest()
-
-        #    Step 2: hash = HMAC_SHA256(key=secret_key, msg=data_check_string)
-        calculated_hash = hmac.new(
-            secret_key,
-            data_check_string.encode(),
-            hashlib.sha256
-        ).hexdigest()
-
-        logger.info(f"🔐 Hash received:    {hash_val[:16]}...")
-        logger.info(f"🔐 Hash calculated:  {calculated_hash[:16]}...")
-
-        # 6. Compare hashes (constant-time comparison for security)
-        if not hmac.compare_digest(calculated_hash, hash_val):
-            logger.error("❌ HMAC MISMATCH!")
-            logger.error("   💡 Possible reasons:")
-            logger.error("      1. BOT_TOKEN noto'g'ri")
-            logger.error("      2. initData buzilgan")
-            logger.error("      3. initData boshqa botdan")
-            logger.debug(f"   data_check_string: {repr(data_check_string[:200])}")
-            return None
+    init_data_cache.put(init_data, user, auth_date)
+    logger.debug(f"✅ initData OK: user_id={user.get('id')}, age={now - auth_date}s")
+    return InitDataResult(user, None, now - auth_date)
 
-        logger.info("✅ HMAC tekshiruvi muvaffaqiyatli!")
-        
-        # 7. Extract user data
-        user_str = params.get("user")
-        if not user_str:
-            logger.error("❌ 'user' maydoni topilmadi!")
-            return None
-        
-        user_data = json.loads(user_str)
-        logger.info(f"✅ User authenticated: {user_data.get('id')} - {user_data.get('first_name')}")
-        
-        return user_data
-
-    except json.JSONDecodeError as e:
-        logger.error(f"❌ JSON parse xatosi: {e}")
-        return None
-    except Exception as e:
-        logger.error(f"❌ initData parse xatosi: {e}", exc_info=True)
-        return None
+def parse_init_data(init_data: str) -> dict | None:
+    """verify_init_data() ning qisqa shakli: user yoki None (sababi log qilinadi)."""
+    result = verify_init_data(init_data)
+    if not result.ok:
+        logger.warning(f"❌ initData rad etildi: {result.reason} (age={result.age})")
+    return result.user
 
 # ══════════════════════════════════════════════════════
 # GEOMETRY
 # ══════════════════════════════════════════════════════
 
+EARTH_RADIUS_M = 6371000
+TREK_CLOSE_M   = 50   # oxirgi nuqta boshlang'ichga shuncha yaqin bo'lsa trek yopiq
+
 def haversine(lat1, lon1, lat2, lon2) -> float:
-    R = 6371000
+    R = EARTH_RADIUS_M
     phi1, phi2 = math.radians(lat1), math.radians(lat2)
     dphi = math.radians(lat2 - lat1)
     dlam = math.radians(lon2 - lon1)
     a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlam / 2) ** 2
     return 2 * R * math.asin(math.sqrt(a))
 
+class TrekGeometry:
+    """
+    Trek/polygon koordinatalari bir marta uzluksiz massivlarga o'tkaziladi
+    (NumPy bo'lsa float64 array, aks holda list) va uzunlik, maydon,
+    markaz hamda ko'p nuqtali point-in-polygon shu massivlar ustida
+    hisoblanadi. NumPy yo'q bo'lsa — xuddi shu formulalar sof Python'da.
+    """
+
+    __slots__ = ("lats", "lngs", "n")
+
+    def __init__(self, points: list):
+        self.n = len(points)
+        if np is not None:
+            self.lats = np.fromiter((p["lat"] for p in points), dtype=np.float64, count=self.n)
+            self.lngs = np.fromiter((p["lng"] for p in points), dtype=np.float64, count=self.n)
+        else:
+            self.lats = [p["lat"] for p in points]
+            self.lngs = [p["lng"] for p in points]
+
+    def path_length_m(self) -> float:
+        """Ketma-ket nuqtalar orasidagi haversine masofalar yig'indisi."""
+        if self.n < 2:
+            return 0.0
+        if np is None:
+            lats, lngs = self.lats, self.lngs
+            return sum(map(haversine, lats[:-1], lngs[:-1], lats[1:], lngs[1:]))
+        phi = np.radians(self.lats)
+        lam = np.radians(self.lngs)
+        a = (np.sin(np.diff(phi) / 2) ** 2
+             + np.cos(phi[:-1]) * np.cos(phi[1:]) * np.sin(np.diff(lam) / 2) ** 2)
+        return float(2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0))).sum())
+
+    def area_m2(self) -> float:
+        """
+        Birinchi nuqtaga nisbatan metrlarga proyeksiya + shoelace.
+        dx — lat0 paralleli bo'ylab haversine, dy — meridian bo'ylab
+        (polygon_area_m2 ning avvalgi natijasi bilan bir xil).
+        """
+        if self.n < 3:
+            return 0
+        R = EARTH_RADIUS_M
+        lat0, lng0 = self.lats[0], self.lngs[0]
+        cos0 = math.cos(math.radians(lat0))
+        if np is None:
+            xs = [math.copysign(2 * R * math.asin(min(1.0, cos0 * abs(math.sin(math.radians(lng - lng0) / 2)))),
+                                lng - lng0)
+                  for lng in self.lngs]
+            ys = [R * math.radians(lat - lat0) for lat in self.lats]
+            n = self.n
+            area = sum(xs[i] * ys[(i + 1) % n] - xs[(i + 1) % n] * ys[i] for i in range(n))
+            return abs(area) / 2
+        dlng = self.lngs - lng0
+        xs = np.copysign(2 * R * np.arcsin(np.minimum(1.0, cos0 * np.abs(np.sin(np.radians(dlng) / 2)))), dlng)
+        ys = R * np.radians(self.lats - lat0)
+        area = np.dot(xs, np.roll(ys, -1)) - np.dot(np.roll(xs, -1), ys)
+        return float(abs(area) / 2)
+
+    def centroid(self) -> tuple:
+        """Uchlar o'rtachasi (lat, lng)."""
+        if np is None:
+            return sum(self.lats) / self.n, sum(self.lngs) / self.n
+        return float(self.lats.mean()), float(self.lngs.mean())
+
+    def contains(self, lats: list, lngs: list) -> list:
+        """Har bir (lat, lng) nuqta polygon ichidami — ray casting (point_in_polygon bilan bir xil)."""
+        if self.n == 0 or not len(lats):
+            return [False] * len(lats)
+        if np is None:
+            # i-qirra: (xi, yi) -> (xj, yj), j = i - 1 (aylana)
+            edges = list(zip(self.lngs, self.lats, self.lngs[-1:] + self.lngs[:-1], self.lats[-1:] + self.lats[:-1]))
+            result = []
+            for py, px in zip(lats, lngs):
+                inside = False
+                for xi, yi, xj, yj in edges:
+                    if ((yi > py) != (yj > py)) and (px < (xj - xi) * (py - yi) / (yj - yi) + xi):
+                        inside = not inside
+                result.append(inside)
+            return result
+        xi, yi = self.lngs, self.lats
+        xj, yj = np.roll(xi, 1), np.roll(yi, 1)
+        dy = yj - yi
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(dy != 0, (xj - xi) / dy, 0.0)
+        result = []
+        for py, px in zip(lats, lngs):
+            crosses = (yi > py) != (yj > py)
+            hit = crosses & (px < slope * (py - yi) + xi)
+            result.append(bool(np.count_nonzero(hit) & 1))
+        return result
+
 def point_in_polygon(lat, lng, polygon: list) -> bool:
     n = len(polygon)
     inside = False
@@ -401,123 +1014,660 @@ def point_in_polygon(lat, lng, polygon: list) -> bool:
         j = i
     return inside
 
-def polygon_centroid(points: list) -> tuple:
-    lat = sum(p["lat"] for p in points) / len(points)
-    lng = sum(p["lng"] for p in points) / len(points)
-    return lat, lng
+def points_in_polygon(centers: list, polygon: list) -> list:
+    """Ko'p (lat, lng) nuqta uchun bitta o'tishda point_in_polygon."""
+    return TrekGeometry(polygon).contains([c[0] for c in centers], [c[1] for c in centers])
 
 def polygon_area_m2(points: list) -> float:
-    if len(points) < 3:
-        return 0
-    lat0, lng0 = points[0]["lat"], points[0]["lng"]
-    coords = []
-    for p in points:
-        dx = haversine(lat0, lng0, lat0, p["lng"])
-        if p["lng"] < lng0:
-            dx = -dx
-        dy = haversine(lat0, lng0, p["lat"], lng0)
-        if p["lat"] < lat0:
-            dy = -dy
-        coords.append((dx, dy))
-    n = len(coords)
-    area = 0
-    for i in range(n):
-        j = (i + 1) % n
-        area += coords[i][0] * coords[j][1]
-        area -= coords[j][0] * coords[i][1]
-    return abs(area) / 2
+    return TrekGeometry(points).area_m2()
+
+def path_length_m(points: list) -> float:
+    return TrekGeometry(points).path_length_m()
+
+def points_bbox(points: list) -> tuple:
+    """(min_lat, max_lat, min_lng, max_lng)"""
+    lats = [p["lat"] for p in points]
+    lngs = [p["lng"] for p in points]
+    return min(lats), max(lats), min(lngs), max(lngs)
+
+def radius_bbox(lat, lng, radius_m) -> tuple:
+    """Doira (markaz + radius) atrofidagi bbox: (min_lat, max_lat, min_lng, max_lng)"""
+    dlat = radius_m / 111320
+    dlng = radius_m / (111320 * max(0.01, math.cos(math.radians(lat))))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+def bbox_intersects(a: tuple, b: tuple) -> bool:
+    return a[1] >= b[0] and a[0] <= b[1] and a[3] >= b[2] and a[2] <= b[3]
+
+def zone_bbox(zone: dict) -> tuple:
+    if zone["zone_type"] == "circle":
+        return radius_bbox(zone["center_lat"], zone["center_lng"], zone["radius_m"] or 0)
+    return points_bbox(json.loads(zone["geometry"]))
+
+def simplify_polygon(points: list, tolerance_m: float) -> list:
+    """
+    Douglas-Peucker: chiziqdan `tolerance_m` metrdan yaqin nuqtalarni tashlash.
+    Birinchi va oxirgi nuqta saqlanadi (yopiq polygon yopiqligicha qoladi).
+    """
+    n = len(points)
+    if n <= 4 or tolerance_m <= 0:
+        return list(points)
+    lat0 = points[0]["lat"]
+    kx = 111320 * math.cos(math.radians(lat0))
+    xy = [(p["lng"] * kx, p["lat"] * 111320) for p in points]
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    tol2 = tolerance_m * tolerance_m
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        ax, ay = xy[a]
+        dx, dy = xy[b][0] - ax, xy[b][1] - ay
+        seg2 = dx * dx + dy * dy
+        best, idx = 0.0, -1
+        for i in range(a + 1, b):
+            px, py = xy[i][0] - ax, xy[i][1] - ay
+            t = 0.0 if seg2 == 0 else max(0.0, min(1.0, (px * dx + py * dy) / seg2))
+            ex, ey = px - t * dx, py - t * dy
+            d2 = ex * ex + ey * ey
+            if d2 > best:
+                best, idx = d2, i
+        if best > tol2:
+            keep[idx] = True
+            stack.append((a, idx))
+            stack.append((idx, b))
+    return [p for p, k in zip(points, keep) if k]
+
+def clean_trek(points: list, min_step_m: float = TREK_MIN_STEP_M,
+               max_jump_m: float = TREK_MAX_JUMP_M) -> list:
+    """
+    Xom GPS nuqtalarini tozalash:
+      1. Noto'g'ri koordinatalar (NaN, diapazondan tashqari) tashlanadi.
+      2. Bitta nuqtali sakrash — ikkala qo'shnisidan max_jump_m dan uzoq,
+         qo'shnilari esa bir-biriga yaqin bo'lgan nuqta — tashlanadi.
+      3. Oxirgi qoldirilgan nuqtadan min_step_m dan yaqin nuqtalar
+         (takrorlar, turib qolgandagi titrash) tashlanadi.
+    """
+    valid = [
+        p for p in points
+        if math.isfinite(p["lat"]) and math.isfinite(p["lng"])
+        and -90 <= p["lat"] <= 90 and -180 <= p["lng"] <= 180
+    ]
+
+    def dist(a, b):
+        return haversine(a["lat"], a["lng"], b["lat"], b["lng"])
+
+    steady = []
+    for i, p in enumerate(valid):
+        if steady and i + 1 < len(valid):
+            prev, nxt = steady[-1], valid[i + 1]
+            if dist(prev, p) > max_jump_m and dist(p, nxt) > max_jump_m and dist(prev, nxt) <= max_jump_m:
+                continue
+        steady.append(p)
+
+    kept = []
+    for p in steady:
+        if kept and dist(kept[-1], p) < min_step_m:
+            continue
+        kept.append(p)
+    return kept
+
+def meters_per_pixel(zoom: int, lat: float) -> float:
+    """Web Mercator (Leaflet) tile o'lchamida 1 piksel necha metr."""
+    return 156543.03 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+# ══════════════════════════════════════════════════════
+# TREK NUQTALARI — KOMPAKT FORMAT
+# ══════════════════════════════════════════════════════
+# treks.points BLOB: [versiya][typecode][lat0, lng0: int32][dlat, dlng, ...].
+# Koordinatalar 1e-5 aniqlikdagi butun sonlar (client ham shunday
+# yaxlitlaydi); keyingi nuqtalar oldingisiga nisbatan delta. Deltalar
+# odatda int16 ('h', 4 bayt/nuqta), sig'masa int32 ('i'). Decode array +
+# accumulate orqali C tezligida. Eski qatorlar JSON TEXT bo'lishi mumkin —
+# decode_points ikkalasini o'qiydi.
+
+POINTS_FORMAT_V1 = 1
+POINTS_SCALE     = 100000
+_POINTS_HEADER   = struct.Struct("<BBii")
+
+def encode_points(points: list) -> bytes:
+    if not points:
+        return bytes([POINTS_FORMAT_V1])
+    coords = [(round(p["lat"] * POINTS_SCALE), round(p["lng"] * POINTS_SCALE)) for p in points]
+    deltas = []
+    for (lat0, lng0), (lat1, lng1) in zip(coords, coords[1:]):
+        deltas.append(lat1 - lat0)
+        deltas.append(lng1 - lng0)
+    typecode = "h" if all(-32768 <= d <= 32767 for d in deltas) else "i"
+    body = array(typecode, deltas)
+    if sys.byteorder != "little":
+        body.byteswap()
+    header = _POINTS_HEADER.pack(POINTS_FORMAT_V1, ord(typecode), *coords[0])
+    return header + body.tobytes()
+
+def decode_points(data) -> list:
+    if not data:
+        return []
+    if isinstance(data, str):
+        return json.loads(data)
+    if data[0] != POINTS_FORMAT_V1:
+        raise ValueError(f"Noma'lum points format: {data[0]}")
+    if len(data) < _POINTS_HEADER.size:
+        return []
+    _, typecode, lat0, lng0 = _POINTS_HEADER.unpack_from(data)
+    body = array(chr(typecode))
+    body.frombytes(data[_POINTS_HEADER.size:])
+    if sys.byteorder != "little":
+        body.byteswap()
+    lats = accumulate(body[0::2], initial=lat0)
+    lngs = accumulate(body[1::2], initial=lng0)
+    return [{"lat": la / POINTS_SCALE, "lng": ln / POINTS_SCALE} for la, ln in zip(lats, lngs)]
+
+def migrate_trek_points(batch_size: int = 500) -> int:
+    """JSON TEXT ko'rinishidagi eski treks.points qatorlarini BLOB'ga o'tkazish."""
+    converted = 0
+    while True:
+        with get_db() as conn:
+            rows = conn.execute(
+                "SELECT id, points FROM treks WHERE typeof(points)='text' LIMIT ?",
+                (batch_size,)
+            ).fetchall()
+            if not rows:
+                return converted
+            conn.executemany(
+                "UPDATE treks SET points=? WHERE id=?",
+                [(encode_points(json.loads(r["points"] or "[]")), r["id"]) for r in rows]
+            )
+        converted += len(rows)
+
+# ══════════════════════════════════════════════════════
+# ZONE CACHE
+# ══════════════════════════════════════════════════════
+
+class CachedZone(NamedTuple):
+    row: dict            # zones qatori (SELECT * ko'rinishida)
+    points: list | None  # polygon nuqtalari (doira uchun None)
+    bbox: tuple          # (min_lat, max_lat, min_lng, max_lng)
+    json: bytes          # /api/zones uchun tayyor JSON
+
+def make_cached_zone(row: dict) -> CachedZone:
+    points = json.loads(row["geometry"]) if row["zone_type"] == "polygon" else None
+    bbox = points_bbox(points) if points else zone_bbox(row)
+    return CachedZone(row, points, bbox, json.dumps(row, default=str).encode())
+
+class ZoneCache:
+    """
+    Faol zonalarning jarayon ichidagi nusxasi.
+
+    Birinchi murojaatda DB'dan quriladi, keyin zona yozuv yo'llari
+    (create_zone_*, capture_zones, update_user_zone_photos, change_zone_health)
+    commit'dan keyin o'zgargan qatorlarni put_rows() qiladi — qayta SELECT
+    qilinmaydi. Yozuvlar versiya tartibida saqlanadi, shuning uchun
+    changed_since() faqat oxirgi o'zgarishlar bo'ylab yuradi.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries: dict = {}    # id -> CachedZone (version bo'yicha tartiblangan)
+        self._removed: dict = {}    # id -> version (active=0 bo'lganlar)
+        self._full_json: bytes | None = None
+        self.loaded = False
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        self.last_rebuild_ms = 0.0
+
+    def rebuild(self):
+        t0 = time.perf_counter()
+        with self._lock:
+            with get_db() as conn:
+                conn.execute("BEGIN")  # versiya va qatorlar bitta snapshot'dan
+                row = conn.execute("SELECT value FROM meta WHERE key='zone_version'").fetchone()
+                rows = conn.execute("SELECT * FROM zones WHERE active=1 ORDER BY version").fetchall()
+            self._entries = {r["id"]: make_cached_zone(dict(r)) for r in rows}
+            self._removed = {}
+            self._full_json = None
+            self.version = row[0] if row else 0
+            self.loaded = True
+            self.rebuilds += 1
+            self.last_rebuild_ms = (time.perf_counter() - t0) * 1000
+        logger.info(f"🗺 Zona keshi qurildi: {len(rows)} ta zona, {self.last_rebuild_ms:.1f} ms")
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.rebuild()
+
+    def put_rows(self, rows: list) -> list:
+        """
+        Commit qilingan zona qatorlarini keshga yozish (write-through).
+        Qaytaradi: CachedZone'lar (zone_hub.publish uchun).
+        """
+        entries = [make_cached_zone(r) for r in rows]
+        with self._lock:
+            if not self.loaded:
+                return entries  # keyingi murojaatda to'liq quriladi
+            for e in entries:
+                zone_id = e.row["id"]
+                self._entries.pop(zone_id, None)
+                if e.row["active"]:
+                    self._entries[zone_id] = e
+                    self._removed.pop(zone_id, None)
+                else:
+                    self._removed[zone_id] = e.row["version"]
+                self.version = max(self.version, e.row["version"])
+            self._full_json = None
+        return entries
+
+    def current_version(self) -> int:
+        with self._lock:
+            self._ensure_loaded()
+            return self.version
+
+    def entries(self) -> list:
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._entries.values())
+
+    def get_many(self, ids) -> list:
+        with self._lock:
+            self._ensure_loaded()
+            return [e for e in map(self._entries.get, ids) if e is not None]
+
+    def full_json(self) -> tuple:
+        """(version, barcha faol zonalar JSON massivi) — keyingi yozuvgacha memo."""
+        with self._lock:
+            self._ensure_loaded()
+            if self._full_json is None:
+                self._full_json = b"[" + b",".join(e.json for e in self._entries.values()) + b"]"
+            return self.version, self._full_json
+
+    def changed_since(self, since: int) -> tuple:
+        """(version, since'dan keyin o'zgargan zonalar, o'chirilgan id'lar)"""
+        with self._lock:
+            self._ensure_loaded()
+            changed = []
+            for e in reversed(self._entries.values()):
+                if e.row["version"] <= since:
+                    break
+                changed.append(e)
+            removed = [zid for zid, v in self._removed.items() if v > since]
+            return self.version, changed[::-1], removed
+
+    def stats(self) -> dict:
+        return {
+            "zones": len(self._entries),
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "rebuilds": self.rebuilds,
+            "last_rebuild_ms": round(self.last_rebuild_ms, 2),
+        }
+
+zone_cache = ZoneCache()
+
+# ══════════════════════════════════════════════════════
+# ZONA HODISALARI (PUB/SUB)
+# ══════════════════════════════════════════════════════
+# Zona yozuv yo'llari commit'dan keyin zone_hub.publish() qiladi (DB
+# thread'idan — call_soon_threadsafe orqali event loop'ga o'tadi).
+# /api/zones/stream obunachilariga faqat viewport'iga tushgan
+# o'zgarishlar yuboriladi; xabar bir marta kodlanib hammaga ulashiladi.
+
+def sse_chunk(version: int, body: bytes, event: str = "zones") -> bytes:
+    return b"id: %d\nevent: %s\ndata: %s\n\n" % (version, event.encode(), body)
+
+def zone_event_body(event: str, entries: list, zoom: int | None) -> tuple:
+    """(version, /api/zones?since= ko'rinishidagi JSON + "event")"""
+    version = max(e.row["version"] for e in entries)
+    active = [e for e in entries if e.row["active"]]
+    removed = [e.row["id"] for e in entries if not e.row["active"]]
+    return version, (
+        b'{"event":"' + event.encode() + b'","version":' + str(version).encode()
+        + b',"zones":' + zones_json_array(active, zoom)
+        + b',"removed":' + json.dumps(removed).encode() + b"}"
+    )
+
+class ZoneSubscriber:
+    __slots__ = ("bbox", "zoom", "queue")
+
+    def __init__(self, bbox: tuple | None, zoom: int | None, maxsize: int):
+        self.bbox = bbox
+        self.zoom = zoom
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+
+class ZoneEventHub:
+    """
+    Zona o'zgarishlari uchun jarayon ichidagi pub/sub. Navbati to'lgan
+    (sekin) obunachiga None yuboriladi — u qayta ulanib, Last-Event-ID
+    orqali o'tkazib yuborilganlarni keshdan oladi.
+    """
+
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._subs: set = set()
+        self._loop = None
+        self.published = 0
+        self.delivered = 0
+        self.overflows = 0
+
+    def subscribe(self, bbox: tuple | None = None, zoom: int | None = None) -> ZoneSubscriber:
+        self._loop = asyncio.get_running_loop()
+        sub = ZoneSubscriber(bbox, zoom, self.queue_size)
+        self._subs.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: ZoneSubscriber):
+        self._subs.discard(sub)
+
+    def publish(self, event: str, entries: list):
+        """Istalgan thread'dan chaqirish mumkin."""
+        if not entries or not self._subs or self._loop is None:
+            return
+        with suppress(RuntimeError):  # loop yopilgan
+            self._loop.call_soon_threadsafe(self._dispatch, event, entries)
+
+    def _dispatch(self, event: str, entries: list):
+        self.published += 1
+        shared: dict = {}  # zoom -> barcha entries uchun tayyor chunk
+        for sub in list(self._subs):
+            if sub.bbox is None:
+                matched = entries
+            else:
+                matched = [e for e in entries if bbox_intersects(e.bbox, sub.bbox)]
+                if not matched:
+                    continue
+            if len(matched) == len(entries):
+                chunk = shared.get(sub.zoom)
+                if chunk is None:
+                    chunk = shared[sub.zoom] = sse_chunk(*zone_event_body(event, entries, sub.zoom))
+            else:
+                chunk = sse_chunk(*zone_event_body(event, matched, sub.zoom))
+            try:
+                sub.queue.put_nowait(chunk)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                self.overflows += 1
+                self.unsubscribe(sub)
+                while not sub.queue.empty():
+                    sub.queue.get_nowait()
+                sub.queue.put_nowait(None)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subs),
+            "published": self.published,
+            "delivered": self.delivered,
+            "overflows": self.overflows,
+        }
+
+zone_hub = ZoneEventHub(ZONE_STREAM_QUEUE)
+
+# ══════════════════════════════════════════════════════
+# COIN LEDGER
+# ══════════════════════════════════════════════════════
+# users.coins — joriy balans, coin_ledger — har bir o'zgarish (reason:
+# opening | trek | strengthen | weaken, ref_id: treks.id yoki zones.id).
+# Ikkalasi bitta tranzaksiyada yoziladi; yechish shartli UPDATE bilan —
+# balans tekshiruvi va yechish bitta statement, parallel so'rovlar minusga
+# tushira olmaydi.
+
+def append_ledger(conn, entries: list):
+    """entries: [(user_id, delta, balance, reason, ref_id)] — chaqiruvchi tranzaksiyasi ichida."""
+    conn.executemany(
+        "INSERT INTO coin_ledger (user_id, delta, balance, reason, ref_id) VALUES (?, ?, ?, ?, ?)", entries
+    )
 
-def zone_is_captured_by_trek(trek_points: list, zone: dict) -> bool:
-    return point_in_polygon(zone["center_lat"], zone["center_lng"], trek_points)
+def spend_coins(conn, user_id: int, amount: int, reason: str, ref_id: int | None) -> sqlite3.Row | None:
+    """Balans yetsa yechadi va (coins, team, first_name) qaytaradi; yetmasa yoki user yo'q — None."""
+    row = conn.execute(
+        "UPDATE users SET coins = coins - ? WHERE user_id=? AND coins >= ? RETURNING coins, team, first_name",
+        (amount, user_id, amount)
+    ).fetchone()
+    if row is not None:
+        append_ledger(conn, [(user_id, -amount, row["coins"], reason, ref_id)])
+    return row
+
+def backfill_coin_ledger() -> int:
+    """Ledger'gacha yig'ilgan balanslar: yozuvi yo'q foydalanuvchilarga bitta 'opening' qatori."""
+    with get_db() as conn:
+        return conn.execute("""
+            INSERT INTO coin_ledger (user_id, delta, balance, reason)
+            SELECT user_id, coins, coins, 'opening' FROM users
+            WHERE COALESCE(coins, 0) != 0
+              AND NOT EXISTS (SELECT 1 FROM coin_ledger l WHERE l.user_id = users.user_id)
+        """).rowcount
+
+def audit_coin_ledger() -> list:
+    """SUM(delta) users.coins bilan mos kelmagan foydalanuvchilar: [(user_id, coins, ledger_sum)]."""
+    with get_db() as conn:
+        return [tuple(r) for r in conn.execute("""
+            SELECT u.user_id, COALESCE(u.coins, 0) AS coins, COALESCE(SUM(l.delta), 0) AS ledger_sum
+            FROM users u LEFT JOIN coin_ledger l ON l.user_id = u.user_id
+            GROUP BY u.user_id HAVING coins != ledger_sum
+        """).fetchall()]
 
 # ══════════════════════════════════════════════════════
 # ZONE OPERATIONS
 # ══════════════════════════════════════════════════════
 
-def create_zone_circle(user_id, team, lat, lng, radius) -> int:
+def bump_zone_version(conn) -> int:
+    """
+    Global zona versiyasini oshirish (yaratish, egallash, health, foto).
+
+    O'zgargan zonalar qatoriga shu qiymat yoziladi — /api/zones?since=
+    shu bo'yicha faqat o'zgarganlarni qaytaradi.
+    """
+    return conn.execute("""
+        INSERT INTO meta (key, value) VALUES ('zone_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1
+        RETURNING value
+    """).fetchone()[0]
+
+def get_zone_version() -> int:
+    return zone_cache.current_version()
+
+def index_zone(conn, zone_id: int, owner_id: int, bbox: tuple):
+    """zones_rtree yozuvini qo'shish/yangilash (zones bilan bir tranzaksiyada)."""
+    conn.execute(
+        "INSERT OR REPLACE INTO zones_rtree (id, min_lat, max_lat, min_lng, max_lng, owner_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (zone_id, *bbox, owner_id)
+    )
+
+def index_missing_zones() -> int:
+    """R*Tree'da yo'q faol zonalarni indekslash (eski DB uchun migratsiya)."""
+    with get_db() as conn:
+        rows = conn.execute("""
+            SELECT z.* FROM zones z
+            LEFT JOIN zones_rtree r ON r.id = z.id
+            WHERE z.active=1 AND r.id IS NULL
+        """).fetchall()
+        for z in rows:
+            index_zone(conn, z["id"], z["owner_id"], zone_bbox(dict(z)))
+    return len(rows)
+
+def create_zone_circle(user_id, team, lat, lng, radius, photo_url=None) -> int:
     geom = json.dumps({"lat": lat, "lng": lng, "radius": radius})
     area = math.pi * radius ** 2
     with get_db() as conn:
-        cur = conn.execute("""
-            INSERT INTO zones (owner_id, team, zone_type, geometry, center_lat, center_lng, radius_m, area_m2)
-            VALUES (?, ?, 'circle', ?, ?, ?, ?, ?)
-        """, (user_id, team, geom, lat, lng, radius, area))
-        zone_id = cur.lastrowid
+        version = bump_zone_version(conn)
+        row = dict(conn.execute("""
+            INSERT INTO zones (owner_id, team, zone_type, geometry, center_lat, center_lng, radius_m, area_m2,
+                               photo_url, version)
+            VALUES (?, ?, 'circle', ?, ?, ?, ?, ?, ?, ?)
+            RETURNING *
+        """, (user_id, team, geom, lat, lng, radius, area, photo_url, version)).fetchall()[0])
+        zone_id = row["id"]
+        index_zone(conn, zone_id, user_id, radius_bbox(lat, lng, radius))
         conn.execute(
             "INSERT INTO zone_history (zone_id, to_user, to_team, action) VALUES (?, ?, ?, 'created')",
             (zone_id, user_id, team)
         )
         conn.execute("UPDATE users SET zones_owned = zones_owned + 1 WHERE user_id=?", (user_id,))
+        changed = ranked_users(conn, [user_id])
+    zone_hub.publish("created", zone_cache.put_rows([row]))
+    user_rankings.update(changed)
     return zone_id
 
-async def create_zone_circle_with_photo(bot, user_id, team, lat, lng, radius) -> int:
-    zone_id = create_zone_circle(user_id, team, lat, lng, radius)
-    photo_url = await get_user_photo_url(bot, user_id)
-    if photo_url:
-        update_zone_photo(zone_id, photo_url)
-    return zone_id
+async def create_zone_circle_with_photo(user_id, team, lat, lng, radius) -> int:
+    """Rasm keshdan olinadi; kesh bo'sh bo'lsa zona keyinroq to'ldiriladi (PhotoUrlCache)."""
+    return await db_write(create_zone_circle, user_id, team, lat, lng, radius, photo_cache.url_for(user_id))
 
-def create_zone_polygon(user_id, team, points) -> int:
+def create_zone_polygon(user_id, team, points, photo_url=None) -> int:
     geom = json.dumps(points)
-    clat, clng = polygon_centroid(points)
-    area = polygon_area_m2(points)
+    shape = TrekGeometry(points)
+    clat, clng = shape.centroid()
+    area = shape.area_m2()
     with get_db() as conn:
-        cur = conn.execute("""
-            INSERT INTO zones (owner_id, team, zone_type, geometry, center_lat, center_lng, area_m2)
-            VALUES (?, ?, 'polygon', ?, ?, ?, ?)
-        """, (user_id, team, geom, clat, clng, area))
-        zone_id = cur.lastrowid
+        version = bump_zone_version(conn)
+        row = dict(conn.execute("""
+            INSERT INTO zones (owner_id, team, zone_type, geometry, center_lat, center_lng, area_m2,
+                               photo_url, version)
+            VALUES (?, ?, 'polygon', ?, ?, ?, ?, ?, ?)
+            RETURNING *
+        """, (user_id, team, geom, clat, clng, area, photo_url, version)).fetchall()[0])
+        zone_id = row["id"]
+        index_zone(conn, zone_id, user_id, points_bbox(points))
         conn.execute(
             "INSERT INTO zone_history (zone_id, to_user, to_team, action) VALUES (?, ?, ?, 'created')",
             (zone_id, user_id, team)
         )
         conn.execute("UPDATE users SET zones_owned = zones_owned + 1 WHERE user_id=?", (user_id,))
+        changed = ranked_users(conn, [user_id])
+    zone_hub.publish("created", zone_cache.put_rows([row]))
+    user_rankings.update(changed)
     return zone_id
 
-async def create_zone_polygon_with_photo(bot, user_id, team, points) -> int:
-    zone_id = create_zone_polygon(user_id, team, points)
-    photo_url = await get_user_photo_url(bot, user_id)
-    if photo_url:
-        update_zone_photo(zone_id, photo_url)
-    return zone_id
+async def create_zone_polygon_with_photo(user_id, team, points) -> int:
+    return await db_write(create_zone_polygon, user_id, team, points, photo_cache.url_for(user_id))
+
+def capture_zones(zone_ids: list, new_owner, new_team) -> list:
+    """
+    Bir nechta zonani bitta tranzaksiyada egallash.
 
-def capture_zone(zone_id, new_owner, new_team) -> dict | None:
+    Zonalar, zone_history va egalar hisoblagichlari set-based so'rovlar
+    bilan yangilanadi. Allaqachon new_owner'niki bo'lgan zonalar o'tkazib
+    yuboriladi. Qaytaradi: egallangan zonalarning eski qatorlari.
+    """
+    ids = list(dict.fromkeys(zone_ids))
+    if not ids:
+        return []
     with get_db() as conn:
-        z = conn.execute("SELECT * FROM zones WHERE id=?", (zone_id,)).fetchone()
-        if not z:
-            return None
-        z = dict(z)
-        conn.execute(
-            "UPDATE zones SET owner_id=?, team=?, photo_url=NULL WHERE id=?",
-            (new_owner, new_team, zone_id)
-        )
-        conn.execute("""
+        marks = ",".join("?" * len(ids))
+        old = [dict(r) for r in conn.execute(
+            f"SELECT * FROM zones WHERE id IN ({marks}) AND active=1 AND owner_id != ?",
+            (*ids, new_owner)
+        ).fetchall()]
+        if not old:
+            return []
+
+        ids = [z["id"] for z in old]
+        marks = ",".join("?" * len(ids))
+        conn.execute(f"""
             INSERT INTO zone_history (zone_id, from_user, from_team, to_user, to_team, action)
-            VALUES (?, ?, ?, ?, ?, 'captured')
-        """, (zone_id, z["owner_id"], z["team"], new_owner, new_team))
-        conn.execute(
-            "UPDATE users SET zones_owned = MAX(0, zones_owned - 1) WHERE user_id=?",
-            (z["owner_id"],)
+            SELECT id, owner_id, team, ?, ?, 'captured' FROM zones WHERE id IN ({marks})
+        """, (new_owner, new_team, *ids))
+        new_rows = [dict(r) for r in conn.execute(
+            f"UPDATE zones SET owner_id=?, team=?, photo_url=NULL, version=? WHERE id IN ({marks}) RETURNING *",
+            (new_owner, new_team, bump_zone_version(conn), *ids)
+        ).fetchall()]
+        conn.execute(f"UPDATE zones_rtree SET owner_id=? WHERE id IN ({marks})", (new_owner, *ids))
+
+        losses = Counter(z["owner_id"] for z in old)
+        conn.executemany(
+            "UPDATE users SET zones_owned = MAX(0, zones_owned - ?) WHERE user_id=?",
+            [(n, owner_id) for owner_id, n in losses.items()]
         )
         conn.execute(
-            "UPDATE users SET zones_owned = zones_owned + 1, zones_taken = zones_taken + 1 WHERE user_id=?",
-            (new_owner,)
+            "UPDATE users SET zones_owned = zones_owned + ?, zones_taken = zones_taken + ? WHERE user_id=?",
+            (len(old), len(old), new_owner)
         )
-    return z
-
-def get_all_zones() -> list:
+        changed = ranked_users(conn, [new_owner, *losses])
+    zone_hub.publish("captured", zone_cache.put_rows(new_rows))
+    user_rankings.update(changed)
+    return old
+
+def zone_ids_in_bbox(min_lat, max_lat, min_lng, max_lng, exclude_owner=None) -> list:
+    """R*Tree: bbox'i berilgan oraliq bilan kesishgan zonalar id'lari."""
+    sql = """
+        SELECT id FROM zones_rtree
+        WHERE max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?
+    """
+    params = [min_lat, max_lat, min_lng, max_lng]
+    if exclude_owner is not None:
+        sql += " AND owner_id != ?"
+        params.append(exclude_owner)
     with get_db() as conn:
-        return [dict(r) for r in conn.execute("SELECT * FROM zones WHERE active=1").fetchall()]
-
-def get_zones_near(lat, lng, radius_m=2000) -> list:
-    zones = get_all_zones()
-    nearby = []
-    for z in zones:
-        d = haversine(lat, lng, z["center_lat"], z["center_lng"])
-        if d <= radius_m:
-            z["distance"] = d
-            nearby.append(z)
-    return sorted(nearby, key=lambda x: x["distance"])
+        return [r[0] for r in conn.execute(sql, params).fetchall()]
+
+def zone_entries_in_bbox(bbox: tuple, limit=None) -> list:
+    """Viewport'dagi keshlangan zonalar; limit — eng katta maydonlilari."""
+    entries = zone_cache.get_many(zone_ids_in_bbox(*bbox))
+    if limit and len(entries) > limit:
+        entries = sorted(entries, key=lambda e: e.row["area_m2"] or 0, reverse=True)[:limit]
+    return entries
+
+def zone_json_for_zoom(entry, zoom: int | None) -> bytes:
+    """
+    Past zoom'da polygon geometriyasini soddalashtirish va koordinatalarni
+    yaxlitlash (~1 piksel aniqlik). zoom=None yoki yuqori zoom — tayyor JSON.
+    """
+    if zoom is None or zoom >= ZONES_FULL_DETAIL_ZOOM or entry.points is None:
+        return entry.json
+    z = entry.row
+    px_m = meters_per_pixel(zoom, z["center_lat"])
+    decimals = max(2, min(5, math.ceil(-math.log10(px_m / 111320))))
+    pts = simplify_polygon(entry.points, px_m)
+    geometry = json.dumps(
+        [{"lat": round(p["lat"], decimals), "lng": round(p["lng"], decimals)} for p in pts]
+    )
+    return json.dumps({**z, "geometry": geometry}, default=str).encode()
+
+def zones_json_array(entries: list, zoom: int | None) -> bytes:
+    return b"[" + b",".join(zone_json_for_zoom(e, zoom) for e in entries) + b"]"
+
+def get_zones_json(bbox: tuple | None = None, zoom: int | None = None) -> tuple:
+    """
+    Faol zonalar: (version, json bytes). Versiya qatorlardan oldin o'qiladi.
+    bbox berilsa — faqat viewport bilan kesishganlar (R*Tree), zoom bo'yicha soddalashtirilgan.
+    """
+    if not bbox and (zoom is None or zoom >= ZONES_FULL_DETAIL_ZOOM):
+        return zone_cache.full_json()
+    version = zone_cache.current_version()
+    entries = zone_entries_in_bbox(bbox, ZONES_VIEWPORT_LIMIT) if bbox else zone_cache.entries()
+    return version, zones_json_array(entries, zoom)
+
+def get_zones_delta_json(since: int, bbox: tuple | None = None, zoom: int | None = None) -> tuple:
+    """
+    `since` versiyadan keyin o'zgargan/o'chirilgan zonalar: (version, json bytes).
+    since <= 0 yoki joriy versiyadan katta (DB tiklangan, meta.zone_version
+    yangidan boshlangan) — to'liq snapshot, "reset": true (client keshini tozalaydi).
+    """
+    if since <= 0 or since > zone_cache.current_version():
+        version = zone_cache.current_version()
+        entries = zone_entries_in_bbox(bbox, ZONES_VIEWPORT_LIMIT) if bbox else zone_cache.entries()
+        return version, (
+            b'{"version":' + str(version).encode()
+            + b',"zones":' + zones_json_array(entries, zoom)
+            + b',"removed":[],"reset":true}'
+        )
+    version, entries, removed = zone_cache.changed_since(since)
+    if bbox:
+        entries = [e for e in entries if bbox_intersects(e.bbox, bbox)]
+    return version, (
+        b'{"version":' + str(version).encode()
+        + b',"zones":' + zones_json_array(entries, zoom)
+        + b',"removed":' + json.dumps(removed).encode() + b"}"
+    )
+
+def get_zones_in_bbox(min_lat, max_lat, min_lng, max_lng, exclude_owner=None) -> list:
+    """bbox'i berilgan oraliq bilan kesishgan faol zonalar (R*Tree + kesh)."""
+    ids = zone_ids_in_bbox(min_lat, max_lat, min_lng, max_lng, exclude_owner)
+    return [dict(e.row) for e in zone_cache.get_many(ids)]
 
 def get_user_zones(user_id) -> list:
     with get_db() as conn:
@@ -526,19 +1676,95 @@ def get_user_zones(user_id) -> list:
         ).fetchall()]
 
 async def get_user_photo_url(bot, user_id: int) -> str | None:
-    try:
-        photos = await bot.get_user_profile_photos(user_id, limit=1)
-        if photos.total_count == 0:
-            return None
-        file_id = photos.photos[0][-1].file_id
-        file = await bot.get_file(file_id)
-        return f"https://api.telegram.org/file/bot{bot.token}/{file.file_path}"
-    except Exception:
+    """Bot API'dan profil rasmi havolasi; rasm yo'q bo'lsa None, xatoda exception."""
+    photos = await bot.get_user_profile_photos(user_id, limit=1)
+    if photos.total_count == 0:
         return None
+    file_id = photos.photos[0][-1].file_id
+    file = await bot.get_file(file_id)
+    return file.file_path  # PTB to'liq havola qaytaradi (base_file_url + yo'l)
 
-def update_zone_photo(zone_id: int, photo_url: str):
+def update_user_zone_photos(user_id: int, photo_url: str | None, old_url: str | None) -> int:
+    """
+    Foydalanuvchi zonalaridagi bo'sh yoki eskirgan photo_url'ni yangilash.
+    Mos zona bo'lmasa zone_version oshirilmaydi (ETag va since o'zgarmaydi).
+    """
+    where = "owner_id=? AND active=1 AND (photo_url IS NULL OR photo_url=?) AND photo_url IS NOT ?"
     with get_db() as conn:
-        conn.execute("UPDATE zones SET photo_url=? WHERE id=?", (photo_url, zone_id))
+        if not conn.execute(f"SELECT 1 FROM zones WHERE {where} LIMIT 1",
+                            (user_id, old_url, photo_url)).fetchone():
+            return 0
+        rows = [dict(r) for r in conn.execute(f"""
+            UPDATE zones SET photo_url=?, version=?
+            WHERE {where}
+            RETURNING *
+        """, (photo_url, bump_zone_version(conn), user_id, old_url, photo_url)).fetchall()]
+    zone_hub.publish("updated", zone_cache.put_rows(rows))
+    return len(rows)
+
+# action -> minimal miqdor va qadam (coin): 10 coin = +10 health, 15 coin = -10 health
+ZONE_ACTION_STEP = {"strengthen": 10, "weaken": 15}
+
+def zone_action_amount_error(action: str, amount: int) -> str | None:
+    """/strengthen, /weaken va /api/zone/action uchun umumiy miqdor qoidasi."""
+    step = ZONE_ACTION_STEP[action]
+    if amount < step:
+        return f"Minimum {step} coin kerak."
+    if amount % step != 0:
+        return f"Miqdor {step} ga karrali bo'lishi kerak ({step}, {step * 2}, {step * 5}...)."
+    return None
+
+def change_zone_health(user_id: int, zone_id: int, action: str, amount: int, notify: bool = False) -> tuple:
+    """
+    Zona health'ini o'zgartirish va coin yechish (bitta tranzaksiya).
+
+    action: "strengthen" (10 coin = +10 health) yoki "weaken" (15 coin = -10 health).
+    Balans tekshiruvi, yechish va coin_ledger yozuvi — spend_coins(); coin
+    yetmasa hech narsa yozilmaydi. notify=True — weaken'da zona egasiga
+    "attack" bildirishnomasi shu tranzaksiyada navbatga qo'yiladi.
+    Qaytaradi: (status, zone, new_health, balance); status — "ok", "not_found",
+    "not_owner" (strengthen), "own_zone" (weaken), "no_user" yoki "no_coins"
+    (balance — joriy balans).
+    """
+    with get_db() as conn:
+        zone = conn.execute("SELECT * FROM zones WHERE id=? AND active=1", (zone_id,)).fetchone()
+        if not zone:
+            return "not_found", None, None, None
+        zone = dict(zone)
+        if action == "strengthen":
+            if zone["owner_id"] != user_id:
+                return "not_owner", zone, None, None
+            new_health = min(300, zone.get("health", 100) + amount)
+        else:
+            if zone["owner_id"] == user_id:
+                return "own_zone", zone, None, None
+            health_loss = (amount // 15) * 10
+            new_health = max(0, zone.get("health", 100) - health_loss)
+        spender = spend_coins(conn, user_id, amount, action, zone_id)
+        if spender is None:
+            row = conn.execute("SELECT coins FROM users WHERE user_id=?", (user_id,)).fetchone()
+            if row is None:
+                return "no_user", zone, None, None
+            return "no_coins", zone, None, row["coins"] or 0
+        rows = [dict(r) for r in conn.execute(
+            "UPDATE zones SET health=?, version=? WHERE id=? RETURNING *",
+            (new_health, bump_zone_version(conn), zone_id)
+        ).fetchall()]
+        if notify and action == "weaken":
+            attacker_team = TEAMS.get(spender["team"] or "", {"emoji": "❓"})
+            enqueue_notifications(conn, [(zone["owner_id"], "attack", {
+                "zone_id": zone_id,
+                "by_emoji": attacker_team["emoji"],
+                "by_name": spender["first_name"],
+                "old_health": zone.get("health", 100),
+                "new_health": new_health,
+            })])
+        changed = ranked_users(conn, [user_id])
+    if notify:
+        outbox.wake()
+    zone_hub.publish("health", zone_cache.put_rows(rows))
+    user_rankings.update(changed)
+    return "ok", zone, new_health, spender["coins"]
 
 def get_zone_history(zone_id) -> list:
     with get_db() as conn:
@@ -548,56 +1774,659 @@ def get_zone_history(zone_id) -> list:
         ).fetchall()]
 
 # ══════════════════════════════════════════════════════
-# ACHIEVEMENTS
+# PROFIL RASMLARI KESHI
 # ══════════════════════════════════════════════════════
 
-async def check_and_award(user_id: int, bot, db_user: dict):
-    if not db_user:
-        return
+def load_user_photos(limit: int) -> list:
+    with get_db() as conn:
+        return conn.execute(
+            "SELECT user_id, photo_url, fetched_at FROM user_photos ORDER BY fetched_at DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
 
-    awards = []
+def save_user_photo(user_id: int, photo_url: str | None, fetched_at: float):
+    with get_db() as conn:
+        conn.execute("""
+            INSERT INTO user_photos (user_id, photo_url, fetched_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET photo_url=excluded.photo_url, fetched_at=excluded.fetched_at
+        """, (user_id, photo_url, fetched_at))
 
-    def try_award(code: str):
-        with get_db() as conn:
+class PhotoUrlCache:
+    """
+    user_id -> profil rasmi URL (LRU, TTL), user_photos jadvali bilan.
+
+    url_for() hech qachon Bot API'ni kutmaydi: keshdagi (hatto eskirgan)
+    qiymatni qaytaradi, yo'q yoki eskirgan bo'lsa foydalanuvchini fon
+    refresher navbatiga qo'yadi. Refresher yangi URL'ni jadvalga yozadi va
+    foydalanuvchi zonalaridagi bo'sh/eski photo_url'ni to'ldiradi.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[int, tuple]" = OrderedDict()  # user_id -> (url, fetched_at)
+        self._pending: set = set()
+        self._queue = None
+        self._loop = None
+        self._task = None
+        self._bot = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.fetches = 0
+        self.errors = 0
+
+    async def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        self._loop = asyncio.get_running_loop()
+        rows = await db_read(load_user_photos, self.max_size)
+        with self._lock:
+            for user_id, url, fetched_at in reversed(rows):
+                self._entries[user_id] = (url, fetched_at)
+            queued, self._pending = self._pending, set()
+        for user_id in queued:
+            self._schedule(user_id)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task, self._loop = self._task, None, None
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+    def url_for(self, user_id: int) -> str | None:
+        """Keshdagi URL yoki None; yo'q/eskirgan bo'lsa fon yangilash rejalashtiriladi."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+        if entry is None:
+            self.misses += 1
+            self._schedule(user_id)
+            return None
+        url, fetched_at = entry
+        if time.time() - fetched_at > self.ttl:
+            self.stale += 1
+            self._schedule(user_id)
+        else:
+            self.hits += 1
+        return url
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "fetches": self.fetches,
+            "errors": self.errors,
+        }
+
+    def _schedule(self, user_id: int):
+        with self._lock:
+            if user_id in self._pending:
+                return
+            self._pending.add(user_id)
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._queue.put_nowait, user_id)
+
+    def _store(self, user_id: int, url: str | None, fetched_at: float):
+        with self._lock:
+            self._entries[user_id] = (url, fetched_at)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
             try:
-                conn.execute(
-                    "INSERT INTO achievements (user_id, code) VALUES (?, ?)",
-                    (user_id, code)
-                )
-                awards.append(code)
-            except sqlite3.IntegrityError:
-                pass
+                await self._refresh(user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.warning(f"🖼 Profil rasmi olinmadi: user_id={user_id}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(user_id)
+
+    async def _refresh(self, user_id: int):
+        with self._lock:
+            old_url = (self._entries.get(user_id) or (None, 0))[0]
+        url = await get_user_photo_url(self._bot, user_id)
+        self.fetches += 1
+        now = time.time()
+        self._store(user_id, url, now)
+        await db_write(save_user_photo, user_id, url, now)
+        if url and url != old_url:
+            await db_write(update_user_zone_photos, user_id, url, old_url)
+
+photo_cache = PhotoUrlCache(PHOTO_CACHE_TTL, PHOTO_CACHE_SIZE)
+
+# ══════════════════════════════════════════════════════
+# REYTING (LEADERBOARD)
+# ══════════════════════════════════════════════════════
+
+LEADERBOARD_SIZE = 10
+
+def weekly_window_start() -> str:
+    """Haftalik oyna: bugun + oldingi 6 kun (UTC, SQLite date('now') bilan bir xil)."""
+    return (datetime.utcnow().date() - timedelta(days=6)).isoformat()
+
+def backfill_daily_stats() -> int:
+    """Eski DB: user_daily_stats bo'sh bo'lsa, tugagan treklardan bir marta yig'ish."""
+    with get_db() as conn:
+        if conn.execute("SELECT 1 FROM user_daily_stats LIMIT 1").fetchone():
+            return 0
+        return conn.execute("""
+            INSERT INTO user_daily_stats (user_id, day, trek_count, distance_m)
+            SELECT user_id, date(finished_at), COUNT(*), SUM(distance_m)
+            FROM treks WHERE status='finished' AND finished_at IS NOT NULL
+            GROUP BY user_id, date(finished_at)
+        """).rowcount
+
+def record_daily_trek(conn, user_id: int, dist_m: float) -> dict:
+    """Kunlik yig'indiga trekni qo'shish; foydalanuvchining yangi haftalik qatorini qaytaradi."""
+    conn.execute("""
+        INSERT INTO user_daily_stats (user_id, day, trek_count, distance_m)
+        VALUES (?, date('now'), 1, ?)
+        ON CONFLICT(user_id, day) DO UPDATE SET
+            trek_count = trek_count + 1,
+            distance_m = distance_m + excluded.distance_m
+    """, (user_id, dist_m))
+    return dict(conn.execute("""
+        SELECT u.user_id, u.first_name, u.team,
+               SUM(d.trek_count) as trek_count,
+               SUM(d.distance_m)/1000 as week_km
+        FROM user_daily_stats d
+        JOIN users u ON u.user_id = d.user_id
+        WHERE d.user_id = ? AND d.day >= ?
+    """, (user_id, weekly_window_start())).fetchone())
+
+def get_weekly_top(limit: int = LEADERBOARD_SIZE) -> list:
+    with get_db() as conn:
+        return [dict(r) for r in conn.execute("""
+            SELECT u.user_id, u.first_name, u.team, w.trek_count, w.week_km
+            FROM (
+                SELECT user_id,
+                       SUM(trek_count) as trek_count,
+                       SUM(distance_m)/1000 as week_km
+                FROM user_daily_stats
+                WHERE day >= ?
+                GROUP BY user_id
+                ORDER BY week_km DESC
+                LIMIT ?
+            ) w
+            JOIN users u ON u.user_id = w.user_id
+            ORDER BY w.week_km DESC
+        """, (weekly_window_start(), limit)).fetchall()]
+
+class TopNCache:
+    """
+    TOP-N reyting natijalari keshi.
+
+    get() natijani `key` (masalan, haftalik oyna boshi) o'zgarmaguncha
+    saqlaydi. offer() — faqat o'sadigan ko'rsatkichlar uchun inkremental
+    yangilash (foydalanuvchi qatorini almashtirib, qayta saralaydi);
+    invalidate() — keyingi get() qayta hisoblaydi.
+    """
+
+    def __init__(self, compute, score_field: str, size: int = LEADERBOARD_SIZE):
+        self._compute = compute
+        self._score_field = score_field
+        self.size = size
+        self._lock = threading.Lock()
+        self._rows: list | None = None
+        self._key = None
+
+    def get(self, key=None) -> list:
+        with self._lock:
+            if self._rows is None or self._key != key:
+                self._rows = self._compute(self.size)
+                self._key = key
+            return list(self._rows)
+
+    def offer(self, row: dict, key=None):
+        with self._lock:
+            if self._rows is None or self._key != key:
+                return  # keyingi get() to'liq hisoblaydi
+            rows = [r for r in self._rows if r["user_id"] != row["user_id"]]
+            rows.append(row)
+            rows.sort(key=lambda r: r[self._score_field] or 0, reverse=True)
+            self._rows = rows[:self.size]
+
+    def invalidate(self):
+        with self._lock:
+            self._rows = None
+
+weekly_top = TopNCache(get_weekly_top, "week_km")
+
+RANKING_FIELDS = ("zones_owned", "total_km", "coins")
+RANKING_BY     = {"zones": "zones_owned", "km": "total_km", "coins": "coins"}
+RANKED_USER_COLUMNS = "user_id, first_name, username, team, zones_owned, zones_taken, total_km, coins"
+
+def ranked_users(conn, user_ids) -> list:
+    """Yozuv tranzaksiyasi ichida o'zgargan foydalanuvchilar (commit'dan keyin user_rankings.update)."""
+    ids = list(dict.fromkeys(user_ids))
+    marks = ",".join("?" * len(ids))
+    return [dict(r) for r in conn.execute(
+        f"SELECT {RANKED_USER_COLUMNS} FROM users WHERE user_id IN ({marks})", ids
+    ).fetchall()]
+
+def public_ranking_row(row: dict) -> dict:
+    """/api/leaderboard va /api/user uchun: ism, jamoa nomi va emojisi bilan."""
+    team = TEAMS.get(row["team"] or "")
+    return {
+        "user_id": row["user_id"],
+        "name": row["first_name"] or row["username"] or "Anonim",
+        "team": row["team"],
+        "team_emoji": team["emoji"] if team else None,
+        "team_name": team["name"] if team else None,
+        "zones_owned": row["zones_owned"] or 0,
+        "total_km": round(row["total_km"] or 0, 3),
+        "coins": row["coins"] or 0,
+    }
+
+class UserRankings:
+    """
+    Barcha foydalanuvchilar reytingi xotirada.
+
+    Har ko'rsatkich (RANKING_FIELDS) uchun (-qiymat, user_id) bo'yicha
+    saralangan ro'yxat saqlanadi. Yozuv yo'llari o'zgargan qatorlarni
+    update() qiladi — eski kalit bisect bilan olinib, yangisi qo'yiladi.
+    top() va rank() users jadvalini skanerlamaydi; JSON javoblar
+    keyingi o'zgarishgacha memo qilinadi (version — ETag uchun).
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rows: dict = {}
+        self._index: dict = {f: [] for f in RANKING_FIELDS}
+        self._json: dict = {}
+        self.loaded = False
+        self.version = 0
+
+    def load(self):
+        with self._lock:
+            with get_db() as conn:
+                rows = [dict(r) for r in conn.execute(f"SELECT {RANKED_USER_COLUMNS} FROM users").fetchall()]
+            self._rows = {r["user_id"]: r for r in rows}
+            self._index = {
+                f: sorted((-(r[f] or 0), r["user_id"]) for r in rows) for f in RANKING_FIELDS
+            }
+            self._json = {}
+            self.loaded = True
+            self.version += 1
+        logger.info(f"🏆 Reyting qurildi: {len(rows)} ta foydalanuvchi")
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def update(self, rows: list):
+        with self._lock:
+            if not self.loaded:
+                return  # load() hammasini DB'dan oladi
+            for row in rows:
+                user_id = row["user_id"]
+                old = self._rows.get(user_id)
+                for f, index in self._index.items():
+                    if old is not None:
+                        key = (-(old[f] or 0), user_id)
+                        i = bisect.bisect_left(index, key)
+                        if i < len(index) and index[i] == key:
+                            del index[i]
+                    bisect.insort(index, (-(row[f] or 0), user_id))
+                self._rows[user_id] = row
+            self._json = {}
+            self.version += 1
+
+    def top(self, field: str, limit: int) -> list:
+        with self._lock:
+            self._ensure_loaded()
+            return [dict(self._rows[uid]) for _, uid in self._index[field][:limit]]
+
+    def get(self, user_id: int) -> dict | None:
+        """Foydalanuvchi qatori + har ko'rsatkich bo'yicha o'rni (1 dan)."""
+        with self._lock:
+            self._ensure_loaded()
+            row = self._rows.get(user_id)
+            if row is None:
+                return None
+            ranks = {
+                by: bisect.bisect_left(self._index[f], (-(row[f] or 0), user_id)) + 1
+                for by, f in RANKING_BY.items()
+            }
+            return {**row, "rank": ranks}
+
+    def leaderboard_json(self, by: str | None, limit: int) -> tuple:
+        """
+        (version, JSON massiv). by=None — har uchala ko'rsatkich TOP-limit
+        birlashmasi (xarita paneli tablarini o'zi saralaydi).
+        """
+        with self._lock:
+            self._ensure_loaded()
+            key = (by, limit)
+            body = self._json.get(key)
+            if body is None:
+                fields = [RANKING_BY[by]] if by else RANKING_FIELDS
+                ids = dict.fromkeys(uid for f in fields for _, uid in self._index[f][:limit])
+                body = self._json[key] = json.dumps(
+                    [public_ranking_row(self._rows[uid]) for uid in ids], ensure_ascii=False
+                ).encode()
+            return self.version, body
+
+    def stats(self) -> dict:
+        return {"users": len(self._rows), "version": self.version}
+
+user_rankings = UserRankings()
+
+def get_weekly_top_cached() -> list:
+    return weekly_top.get(weekly_window_start())
+
+def get_leaderboard_cached() -> list:
+    return user_rankings.top("zones_owned", LEADERBOARD_SIZE)
+
+# ══════════════════════════════════════════════════════
+# NOTIFICATION OUTBOX
+# ══════════════════════════════════════════════════════
+
+def enqueue_notifications(conn, items) -> int:
+    """
+    items: [(chat_id, kind, payload)] — joriy tranzaksiyada outbox'ga yozish.
+    Commit'dan keyin chaqiruvchi outbox.wake() qilishi kerak.
+    """
+    now = time.time()
+    conn.executemany(
+        "INSERT INTO outbox (chat_id, kind, payload, next_attempt_at) VALUES (?, ?, ?, ?)",
+        [(chat_id, kind, json.dumps(payload, ensure_ascii=False), now) for chat_id, kind, payload in items],
+    )
+    return len(items)
+
+def queue_notifications(items) -> int:
+    with get_db() as conn:
+        n = enqueue_notifications(conn, items)
+    outbox.wake()
+    return n
+
+def due_notifications(now: float, limit: int) -> tuple:
+    """Qaytaradi: (vaqti kelgan qatorlar, keyingi navbatdagi next_attempt_at yoki None)"""
+    with get_db() as conn:
+        rows = [dict(r) for r in conn.execute(
+            "SELECT * FROM outbox WHERE next_attempt_at <= ? ORDER BY id LIMIT ?", (now, limit)
+        ).fetchall()]
+        next_due = conn.execute("SELECT MIN(next_attempt_at) FROM outbox").fetchone()[0]
+    return rows, next_due
+
+def finish_notifications(done_ids: list, retries: list):
+    """done_ids — o'chiriladi (yuborildi yoki tashlab yuborildi); retries: [(attempts, next_at, error, id)]"""
+    with get_db() as conn:
+        conn.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in done_ids])
+        conn.executemany(
+            "UPDATE outbox SET attempts=?, next_attempt_at=?, last_error=? WHERE id=?", retries
+        )
+
+def render_capture(payloads: list) -> str:
+    if len(payloads) == 1:
+        p = payloads[0]
+        return (
+            f"⚔️ *Zonangiz egallandi!*\n\n"
+            f"🏴 {p['zone_name']}\n"
+            f"{p['by_emoji']} {p['by_name']} tomonidan!\n\n"
+            f"Qaytarib oling! 💪"
+        )
+    lines = "\n".join(f"🏴 {p['zone_name']} — {p['by_emoji']} {p['by_name']}" for p in payloads)
+    return f"⚔️ *{len(payloads)} ta zonangiz egallandi!*\n\n{lines}\n\nQaytarib oling! 💪"
+
+def render_attack(payloads: list) -> str:
+    weakest = min(p["new_health"] for p in payloads)
+    footer = '🔴 Xavf! Zona zaif!' if weakest < 30 else '💪 Mustahkamlang!'
+    if len(payloads) == 1:
+        p = payloads[0]
+        return (
+            f"⚠️ *Zonangizga hujum!*\n\n"
+            f"📍 Zona #{p['zone_id']}\n"
+            f"{p['by_emoji']} {p['by_name']} hujum qildi!\n"
+            f"💊 Health: {p['old_health']} → {p['new_health']}\n\n"
+            f"{footer}"
+        )
+    lines = "\n".join(
+        f"📍 Zona #{p['zone_id']} — {p['by_emoji']} {p['by_name']}, 💊 {p['old_health']} → {p['new_health']}"
+        for p in payloads
+    )
+    return f"⚠️ *Zonalaringizga {len(payloads)} ta hujum!*\n\n{lines}\n\n{footer}"
+
+def render_award(payloads: list) -> str:
+    achs = [ACHIEVEMENT_LIST[p["code"]] for p in payloads if p["code"] in ACHIEVEMENT_LIST]
+    if not achs:
+        return ""
+    if len(achs) == 1:
+        return f"🏅 *Yangi yutuq!*\n\n{achs[0]['title']}\n{achs[0]['desc']}"
+    lines = "\n\n".join(f"{a['title']}\n{a['desc']}" for a in achs)
+    return f"🏅 *{len(achs)} ta yangi yutuq!*\n\n{lines}"
+
+# kind -> bir chatga tegishli payload'lar ro'yxatidan bitta xabar matni
+NOTIFICATION_RENDERERS = {
+    "capture": render_capture,
+    "attack":  render_attack,
+    "award":   render_award,
+}
 
-    if db_user["zones_owned"] >= 1:
-        try_award("first_zone")
-    if db_user["zones_owned"] >= 3:
-        try_award("landlord_3")
-    if db_user["zones_owned"] >= 10:
-        try_award("landlord_10")
-    if db_user["zones_taken"] >= 5:
-        try_award("conqueror_5")
-    if db_user["zones_taken"] >= 10:
-        try_award("conqueror_10")
-    if db_user["total_km"] >= 1:
-        try_award("walker_1km")
-    if db_user["total_km"] >= 5:
-        try_award("walker_5km")
-    if db_user["total_km"] >= 10:
-        try_award("walker_10km")
-    if db_user["referral_count"] >= 3:
-        try_award("referral_3")
-
-    for code in awards:
-        ach = ACHIEVEMENT_LIST.get(code)
-        if ach:
+class NotificationOutbox:
+    """
+    outbox jadvalini yuboruvchi fon worker.
+
+    Bir partiyadagi bir chat + kind yozuvlari bitta xabarga birlashtiriladi
+    ("3 ta zonangiz egallandi"). Yuborish global (OUTBOX_GLOBAL_RATE) va
+    chat bo'yicha (OUTBOX_CHAT_INTERVAL) cheklanadi; RetryAfter'da Telegram
+    ko'rsatgan vaqtgacha, boshqa xatolarda eksponentsial kutish bilan qayta
+    uriniladi. Forbidden/BadRequest (bot bloklangan va h.k.) — tashlab yuboriladi.
+    """
+
+    def __init__(self, global_rate: float, chat_interval: float, max_attempts: int,
+                 batch_size: int = 200, poll_interval: float = 5.0, max_backoff: float = 300.0):
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._bot = None
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._next_global = 0.0
+        self._next_chat: dict = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def start(self, bot):
+        self._bot = bot
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        task, self._task, self._loop = self._task, None, None
+        if task:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+
+    def wake(self):
+        """Istalgan thread'dan: yangi yozuvlar borligini bildirish."""
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            next_due = None
             try:
-                await bot.send_message(
-                    chat_id=user_id,
-                    text=f"🏅 *Yangi yutuq!*\n\n{ach['title']}\n{ach['desc']}",
-                    parse_mode=ParseMode.MARKDOWN,
-                )
-            except Exception:
-                pass
+                rows, next_due = await db_read(due_notifications, time.time(), self.batch_size)
+                if rows:
+                    await self._dispatch(rows)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Outbox xatosi: {e}")
+            timeout = self.poll_interval
+            if next_due is not None:
+                timeout = min(max(next_due - time.time(), 0.05), self.poll_interval)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+    async def _dispatch(self, rows: list):
+        now = time.monotonic()
+        self._next_chat = {c: t for c, t in self._next_chat.items() if t > now}
+        by_chat: dict = {}
+        for r in rows:
+            by_chat.setdefault(r["chat_id"], {}).setdefault(r["kind"], []).append(r)
+        done_ids, retries = [], []
+        await asyncio.gather(*(
+            self._send_chat(chat_id, groups, done_ids, retries) for chat_id, groups in by_chat.items()
+        ))
+        await db_write(finish_notifications, done_ids, retries)
+
+    async def _throttle(self, chat_id: int):
+        """Global va chat bo'yicha navbatdagi bo'sh vaqtni band qilib, shu vaqtgacha kutish."""
+        now = time.monotonic()
+        slot = max(now, self._next_global)
+        self._next_global = slot + self.global_interval
+        slot = max(slot, self._next_chat.get(chat_id, 0.0))
+        self._next_chat[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _send_chat(self, chat_id: int, groups: dict, done_ids: list, retries: list):
+        for kind, group in groups.items():
+            ids = [r["id"] for r in group]
+            renderer = NOTIFICATION_RENDERERS.get(kind)
+            text = renderer([json.loads(r["payload"]) for r in group]) if renderer else ""
+            if not text:
+                done_ids.extend(ids)
+                continue
+            await self._throttle(chat_id)
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.MARKDOWN)
+            except RetryAfter as e:
+                wait = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self._next_global = max(self._next_global, time.monotonic() + wait)
+                retries.extend((r["attempts"], time.time() + wait, str(e), r["id"]) for r in group)
+                self.retried += len(group)
+                continue
+            except (Forbidden, BadRequest) as e:
+                logger.warning(f"📭 Bildirishnoma tashlandi: chat_id={chat_id}, kind={kind}: {e}")
+                done_ids.extend(ids)
+                self.dropped += len(group)
+                continue
+            except Exception as e:
+                attempts = max(r["attempts"] for r in group) + 1
+                if attempts >= self.max_attempts:
+                    logger.warning(f"📭 Bildirishnoma {attempts} urinishdan keyin tashlandi: chat_id={chat_id}: {e}")
+                    done_ids.extend(ids)
+                    self.dropped += len(group)
+                else:
+                    next_at = time.time() + min(2 ** attempts, self.max_backoff)
+                    retries.extend((attempts, next_at, str(e), i) for i in ids)
+                    self.retried += len(group)
+                continue
+            done_ids.extend(ids)
+            self.sent += 1
+            self.coalesced += len(group) - 1
+
+outbox = NotificationOutbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_INTERVAL, OUTBOX_MAX_ATTEMPTS)
+
+# ══════════════════════════════════════════════════════
+# ACHIEVEMENTS
+# ══════════════════════════════════════════════════════
+
+class EarnedAchievements:
+    """
+    Foydalanuvchi olgan yutuq kodlari keshi (LRU, `max_users` gacha).
+
+    Kesh faqat DB'dan o'qilgan yoki muvaffaqiyatli INSERT qilingan kodlar
+    bilan to'ldiriladi, shuning uchun "olingan" deb hisoblangan kod har
+    doim DB'da bor — bu ortiqcha INSERT'larni tejash uchun yetarli.
+    """
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._codes: "OrderedDict[int, set]" = OrderedDict()
+
+    def get(self, conn, user_id: int) -> set:
+        with self._lock:
+            codes = self._codes.get(user_id)
+            if codes is not None:
+                self._codes.move_to_end(user_id)
+                return set(codes)
+        codes = {r[0] for r in conn.execute(
+            "SELECT code FROM achievements WHERE user_id=?", (user_id,)
+        )}
+        self._store(user_id, codes)
+        return set(codes)
+
+    def add(self, user_id: int, codes):
+        # Keshda yo'q bo'lsa — keyingi get() to'liq to'plamni DB'dan o'qiydi
+        with self._lock:
+            if user_id in self._codes:
+                self._codes[user_id].update(codes)
+
+    def _store(self, user_id: int, codes: set):
+        with self._lock:
+            self._codes[user_id] = codes
+            self._codes.move_to_end(user_id)
+            while len(self._codes) > self.max_users:
+                self._codes.popitem(last=False)
+
+earned_achievements = EarnedAchievements()
+
+def award_achievements(user_id: int, db_user: dict) -> list:
+    """Qoidalardan o'tgan, hali olinmagan yutuqlarni bitta INSERT bilan yozish."""
+    passed = [code for code, stat, minimum in ACHIEVEMENT_RULES
+              if (db_user.get(stat) or 0) >= minimum]
+    if not passed:
+        return []
+    with get_db() as conn:
+        earned = earned_achievements.get(conn, user_id)
+        pending = [code for code in passed if code not in earned]
+        if not pending:
+            return []
+        placeholders = ", ".join("(?, ?)" for _ in pending)
+        params = [v for code in pending for v in (user_id, code)]
+        awarded = [r[0] for r in conn.execute(
+            f"INSERT OR IGNORE INTO achievements (user_id, code) VALUES {placeholders} RETURNING code",
+            params,
+        ).fetchall()]
+        enqueue_notifications(conn, [(user_id, "award", {"code": code}) for code in awarded])
+    earned_achievements.add(user_id, pending)
+    if awarded:
+        outbox.wake()
+    return awarded
+
+async def check_and_award(user_id: int, db_user: dict) -> list:
+    """Yangi yutuqlarni yozish; xabarlar outbox orqali yuboriladi."""
+    if not db_user:
+        return []
+    return await db_write(award_achievements, user_id, db_user)
 
 def get_user_achievements(user_id: int) -> list:
     with get_db() as conn:
@@ -610,11 +2439,98 @@ def get_user_achievements(user_id: int) -> list:
 # TREK PROCESSING
 # ══════════════════════════════════════════════════════
 
-async def process_trek(bot, user_id: int, points: list, team: str, closed: bool, dist_m: float) -> str:
-    if not points or len(points) < 5:
+def save_trek(user_id: int, points: list, dist_m: float, trek_id: int | None = None,
+              job_id: int | None = None) -> int:
+    """
+    Trekni saqlash, masofa va coin qo'shish. Qaytaradi: berilgan coinlar.
+    trek_id berilsa (live trek), o'sha 'active' qator yakunlanadi.
+    job_id berilsa, trek_jobs.trek_id shu tranzaksiyada yoziladi — qayta
+    ishga tushganda bu ish qayta saqlanmaydi (requeue_stale_trek_jobs).
+    """
+    dist_km = dist_m / 1000
+    with get_db() as conn:
+        finished = trek_id is not None and conn.execute(
+            "UPDATE treks SET points=?, distance_m=?, finished_at=datetime('now'), status='finished' "
+            "WHERE id=? AND user_id=? AND status='active'",
+            (encode_points(points), dist_m, trek_id, user_id)
+        ).rowcount == 1
+        conn.execute(
+            "UPDATE treks SET status='cancelled' WHERE user_id=? AND status='active'",
+            (user_id,)
+        )
+        if not finished:
+            trek_id = conn.execute(
+                "INSERT INTO treks (user_id, points, distance_m, started_at, finished_at, status) "
+                "VALUES (?, ?, ?, datetime('now'), datetime('now'), 'finished')",
+                (user_id, encode_points(points), dist_m)
+            ).lastrowid
+        # 🪙 Coin tizimi: 1 km = 10 coin
+        coins_earned = max(1, round(dist_km * 10))
+        balance = conn.execute(
+            "UPDATE users SET total_km = total_km + ?, coins = coins + ? WHERE user_id=? RETURNING coins",
+            (dist_km, coins_earned, user_id)
+        ).fetchone()
+        if balance is not None:
+            append_ledger(conn, [(user_id, coins_earned, balance["coins"], "trek", trek_id)])
+        if job_id is not None:
+            conn.execute("UPDATE trek_jobs SET trek_id=? WHERE id=?", (trek_id, job_id))
+        week_row = record_daily_trek(conn, user_id, dist_m)
+        changed = ranked_users(conn, [user_id])
+    weekly_top.offer(week_row, weekly_window_start())
+    user_rankings.update(changed)
+    return coins_earned
+
+def find_captured_zones(points: list, user_id: int, new_zone_id: int, bbox: tuple | None = None) -> list:
+    """Trek ichida qolgan begona zonalar (markazi polygon ichida)."""
+    min_lat, max_lat, min_lng, max_lng = bbox or points_bbox(points)
+    candidates = [
+        z for z in get_zones_in_bbox(min_lat, max_lat, min_lng, max_lng, exclude_owner=user_id)
+        if z["id"] != new_zone_id
+        and min_lat <= z["center_lat"] <= max_lat
+        and min_lng <= z["center_lng"] <= max_lng
+    ]
+    inside = points_in_polygon([(z["center_lat"], z["center_lng"]) for z in candidates], points)
+    return [z for z, hit in zip(candidates, inside) if hit]
+
+@contextmanager
+def timed(stages: dict, name: str):
+    """stages[name] ga blok vaqtini (ms) qo'shish."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages[name] = stages.get(name, 0.0) + (time.perf_counter() - t0) * 1000
+
+async def process_trek(bot, user_id: int, points: list, team: str, closed: bool, client_dist_m: float,
+                       stages: dict | None = None, job_id: int | None = None) -> str:
+    """
+    Xom nuqtalar clean_trek'dan o'tadi, masofa serverda hisoblanadi
+    (client_dist_m faqat log uchun). Zona va egallash tekshiruvi
+    TREK_SIMPLIFY_M bilan soddalashtirilgan polygon ustida.
+    stages berilsa, bosqichlar vaqti (ms) shu dict'ga yoziladi.
+    """
+    stages = {} if stages is None else stages
+    with timed(stages, "clean"):
+        points = clean_trek(points or [])
+        dist_m = path_length_m(points)
+    if abs(dist_m - client_dist_m) > max(50.0, 0.2 * dist_m):
+        logger.info(f"📏 Trek masofasi: client={client_dist_m:.0f}m, server={dist_m:.0f}m (user_id={user_id})")
+    return await finalize_trek(user_id, points, team, closed, dist_m, stages, job_id=job_id)
+
+async def finalize_trek(user_id: int, points: list, team: str, closed: bool, dist_m: float,
+                        stages: dict | None = None, trek_id: int | None = None,
+                        bbox: tuple | None = None, job_id: int | None = None) -> str:
+    """
+    Tozalangan trekni yakunlash: saqlash, zona, egallash, bildirishnomalar,
+    yutuqlar. trek_id — live trekning 'active' qatori (bo'lsa shu yangilanadi),
+    bbox — oldindan hisoblangan (min_lat, max_lat, min_lng, max_lng),
+    job_id — trek_jobs qatori (save_trek unga trek_id'ni yozadi).
+    """
+    stages = {} if stages is None else stages
+    if len(points) < 5:
         return "❗️ Trek juda qisqa (kamida 5 nuqta kerak)."
 
-    db_user = get_user(user_id)
+    db_user = await db_read(get_user, user_id)
     if not db_user:
         return "❗️ Foydalanuvchi topilmadi. /start bosing."
 
@@ -624,55 +2540,40 @@ async def process_trek(bot, user_id: int, points: list, team: str, closed: bool,
     if not team or team not in TEAMS:
         return "❗️ Jamoa tanlanmagan. /start bosing."
 
-    dist_km = dist_m / 1000
-
-    with get_db() as conn:
-        conn.execute(
-            "UPDATE treks SET status='cancelled' WHERE user_id=? AND status='active'",
-            (user_id,)
-        )
-        conn.execute(
-            "INSERT INTO treks (user_id, points, distance_m, started_at, finished_at, status) "
-            "VALUES (?, ?, ?, datetime('now'), datetime('now'), 'finished')",
-            (user_id, json.dumps(points), dist_m)
-        )
-        conn.execute("UPDATE users SET total_km = total_km + ? WHERE user_id=?", (dist_km, user_id))
-        # 🪙 Coin tizimi: 1 km = 10 coin
-        coins_earned = max(1, round(dist_km * 10))
-        conn.execute("UPDATE users SET coins = coins + ? WHERE user_id=?", (coins_earned, user_id))
-
+    dist_km = dist_m / 1000
+    with timed(stages, "save"):
+        coins_earned = await db_write(save_trek, user_id, points, dist_m, trek_id, job_id)
+
     msg = f"⏹️ *Trek yakunlandi!*\n📏 {dist_km:.3f} km | 📍 {len(points)} nuqta\n🪙 +{coins_earned} coin qo'shildi!\n"
 
     if closed:
-        zone_id = await create_zone_polygon_with_photo(bot, user_id, team, points)
-        area = polygon_area_m2(points)
-        captured = []
+        with timed(stages, "clean"):
+            outline = simplify_polygon(points, TREK_SIMPLIFY_M)
+        logger.debug(f"🧹 Trek (user_id={user_id}): {len(points)} -> {len(outline)} nuqta")
+        with timed(stages, "zone"):
+            zone_id = await create_zone_polygon_with_photo(user_id, team, outline)
+        area = polygon_area_m2(outline)
+        with timed(stages, "capture"):
+            candidates = await db_read(find_captured_zones, outline, user_id, zone_id, bbox)
+            captured = await db_write(capture_zones, [z["id"] for z in candidates], user_id, team)
+        CAPTURE_CANDIDATES.observe(len(candidates))
+        CAPTURE_SIZE.observe(len(captured))
 
-        for z in get_all_zones():
-            if z["owner_id"] == user_id or z["id"] == zone_id:
-                continue
-            if zone_is_captured_by_trek(points, z):
-                old = capture_zone(z["id"], user_id, team)
-                if old:
-                    captured.append(old)
-                    team_info = TEAMS[team]
-                    z_name = old.get("name") or f"Zona #{old['id']}"
-                    try:
-                        await bot.send_message(
-                            chat_id=old["owner_id"],
-                            text=(
-                                f"⚔️ *Zonangiz egallandi!*\n\n"
-                                f"🏴 {z_name}\n"
-                                f"{team_info['emoji']} {db_user['first_name']} tomonidan!\n\n"
-                                f"Qaytarib oling! 💪"
-                            ),
-                            parse_mode=ParseMode.MARKDOWN,
-                        )
-                    except Exception:
-                        pass
-
-        updated_user = get_user(user_id)
-        await check_and_award(user_id, bot, updated_user)
+        if captured:
+            team_info = TEAMS[team]
+            with timed(stages, "notify"):
+                await db_write(queue_notifications, [
+                    (old["owner_id"], "capture", {
+                        "zone_name": old.get("name") or f"Zona #{old['id']}",
+                        "by_emoji": team_info["emoji"],
+                        "by_name": db_user["first_name"],
+                    })
+                    for old in captured
+                ])
+
+        with timed(stages, "achievements"):
+            updated_user = await db_read(get_user, user_id)
+            await check_and_award(user_id, updated_user)
 
         te = TEAMS[team]
         msg += (
@@ -694,11 +2595,582 @@ async def process_trek(bot, user_id: int, points: list, team: str, closed: bool,
         msg += (
             f"\n⚠️ *Trek yopiq emas.*\n"
             f"Boshlang'ich nuqtaga: {d_close:.0f}m qoldi.\n"
-            f"50m yaqinlashganda yopiq hisoblanadi."
+            f"{TREK_CLOSE_M}m yaqinlashganda yopiq hisoblanadi."
         )
 
     return msg
 
+# ══════════════════════════════════════════════════════
+# TREK NAVBATI (ASYNC INGESTION)
+# ══════════════════════════════════════════════════════
+# /api/trek_submit trekni trek_jobs'ga yozib darhol 202 qaytaradi;
+# TrekJobQueue worker'lari process_trek'ni fon rejimida bajaradi.
+# To'xtashda yangi ish olinmaydi va boshlanganlari kutiladi. Shunda ham
+# 'processing'da qolganlari qayta ishga tushganda: trek saqlangan bo'lsa
+# (trek_jobs.trek_id) 'done' qilinadi, aks holda navbatga qaytariladi —
+# coin va masofa ikki marta berilmaydi.
+
+TREK_JOBS_RETENTION_S = 24 * 3600
+TREK_JOB_RESUMED_MSG = "✅ Trek saqlandi (server qayta ishga tushishidan oldin)."
+
+def enqueue_trek_job(user_id: int, team: str, points: list, dist_m: float, closed: bool) -> int:
+    with get_db() as conn:
+        return conn.execute(
+            "INSERT INTO trek_jobs (user_id, team, points, distance_m, closed, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, team, encode_points(points), dist_m, int(bool(closed)), time.time())
+        ).lastrowid
+
+def claim_trek_job() -> dict | None:
+    """Eng eski navbatdagi ishni olish; bitta foydalanuvchining treklari ketma-ket bajariladi."""
+    with get_db() as conn:
+        row = conn.execute("""
+            UPDATE trek_jobs SET status='processing', started_at=?
+            WHERE id = (
+                SELECT id FROM trek_jobs
+                WHERE status='queued'
+                  AND user_id NOT IN (SELECT user_id FROM trek_jobs WHERE status='processing')
+                ORDER BY id LIMIT 1
+            )
+            RETURNING *
+        """, (time.time(),)).fetchone()
+        return dict(row) if row else None
+
+def finish_trek_job(job_id: int, status: str, message: str | None = None, error: str | None = None):
+    with get_db() as conn:
+        conn.execute(
+            "UPDATE trek_jobs SET status=?, message=?, error=?, finished_at=? WHERE id=?",
+            (status, message, error, time.time(), job_id)
+        )
+
+def requeue_stale_trek_jobs() -> tuple:
+    """Qaytaradi: (navbatga qaytarilganlar, trek saqlangani uchun yakunlanganlar)."""
+    with get_db() as conn:
+        finished = conn.execute(
+            "UPDATE trek_jobs SET status='done', message=COALESCE(message, ?), finished_at=? "
+            "WHERE status='processing' AND trek_id IS NOT NULL",
+            (TREK_JOB_RESUMED_MSG, time.time())
+        ).rowcount
+        requeued = conn.execute(
+            "UPDATE trek_jobs SET status='queued', started_at=NULL WHERE status='processing'"
+        ).rowcount
+    return requeued, finished
+
+def purge_trek_jobs(older_than_s: float = TREK_JOBS_RETENTION_S) -> int:
+    with get_db() as conn:
+        return conn.execute(
+            "DELETE FROM trek_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+            (time.time() - older_than_s,)
+        ).rowcount
+
+def get_trek_job(job_id: int) -> dict | None:
+    with get_db() as conn:
+        row = conn.execute("""
+            SELECT id, user_id, status, message, error, created_at, started_at, finished_at,
+                   CASE WHEN status='queued'
+                        THEN (SELECT COUNT(*) FROM trek_jobs q WHERE q.status='queued' AND q.id < j.id)
+                   END as position
+            FROM trek_jobs j WHERE id=?
+        """, (job_id,)).fetchone()
+        return dict(row) if row else None
+
+def trek_queue_depth() -> dict:
+    with get_db() as conn:
+        rows = conn.execute("""
+            SELECT status, COUNT(*) as n, MIN(created_at) as oldest
+            FROM trek_jobs WHERE status IN ('queued', 'processing') GROUP BY status
+        """).fetchall()
+    depth = {"queued": 0, "processing": 0, "oldest_queued_s": 0.0}
+    for r in rows:
+        depth[r["status"]] = r["n"]
+        if r["status"] == "queued":
+            depth["oldest_queued_s"] = round(time.time() - r["oldest"], 3)
+    return depth
+
+TREK_STAGE_LATENCY = metrics.histogram(
+    "trek_stage_duration_seconds", "process_trek bosqichlari vaqti (navbat kechikishi bilan)", ("stage",))
+
+async def send_trek_result(bot, user_id: int, msg: str):
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text=msg,
+            parse_mode=ParseMode.MARKDOWN,
+            reply_markup=main_menu_kb(),
+        )
+        logger.info(f"📤 Bot xabar yuborildi: user_id={user_id}")
+    except Exception as e:
+        logger.error(f"❌ Bot message error: {e}")
+
+class StageStats:
+    """Bosqichlar bo'yicha vaqt statistikasi (ms): count, avg, max."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats: dict = {}
+
+    def record(self, stages: dict):
+        with self._lock:
+            for name, ms in stages.items():
+                count, total, peak = self._stats.get(name, (0, 0.0, 0.0))
+                self._stats[name] = (count + 1, total + ms, max(peak, ms))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                name: {"count": count, "avg_ms": round(total / count, 2), "max_ms": round(peak, 2)}
+                for name, (count, total, peak) in self._stats.items()
+            }
+
+class TrekJobQueue:
+    """trek_jobs jadvalini qayta ishlovchi `workers` ta asyncio worker."""
+
+    def __init__(self, workers: int, poll_interval: float = 5.0, stop_timeout: float = 30.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stop_timeout = stop_timeout
+        self._stopping = False
+        self.stages = StageStats()
+        self.completed = 0
+        self.failed = 0
+        self._bot = None
+        self._wakeup = None
+        self._tasks: list = []
+        self._last_purge = 0.0
+
+    async def start(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        requeued, finished = await db_write(requeue_stale_trek_jobs)
+        if requeued:
+            logger.info(f"🔁 {requeued} ta tugallanmagan trek navbatga qaytarildi")
+        if finished:
+            logger.info(f"✅ {finished} ta trek allaqachon saqlangan — qayta ishlanmadi")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Yangi ish olinmaydi; boshlangan treklar stop_timeout gacha kutiladi, keyin bekor qilinadi."""
+        tasks, self._tasks = self._tasks, []
+        self._stopping = True
+        self.wake()
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=self.stop_timeout)
+            if pending:
+                logger.warning(f"⚠️ {len(pending)} ta trek {self.stop_timeout:.0f}s ichida tugamadi — bekor qilinmoqda")
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with suppress(asyncio.CancelledError):
+                await task
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            **await db_read(trek_queue_depth),
+            "completed": self.completed,
+            "failed": self.failed,
+            "stages": self.stages.snapshot(),
+        }
+
+    async def _worker(self):
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                job = await db_write(claim_trek_job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Trek navbati xatosi: {e}")
+                job = None
+            if job is not None:
+                await self._process(job)
+                continue
+            if time.time() - self._last_purge > 3600:
+                self._last_purge = time.time()
+                with suppress(Exception):
+                    await db_write(purge_trek_jobs)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+
+    async def _process(self, job: dict):
+        stages = {"queue_lag": (job["started_at"] - job["created_at"]) * 1000}
+        user_id = job["user_id"]
+        t0 = time.perf_counter()
+        try:
+            msg = await process_trek(
+                self._bot, user_id, decode_points(job["points"]), job["team"],
+                bool(job["closed"]), job["distance_m"], stages, job["id"],
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"❌ Trek #{job['id']} qayta ishlanmadi: user_id={user_id}")
+            await db_write(finish_trek_job, job["id"], "failed", None, str(e))
+            self.failed += 1
+            return
+        with timed(stages, "reply"):
+            await send_trek_result(self._bot, user_id, msg)
+        await db_write(finish_trek_job, job["id"], "done", msg)
+        stages["total"] = (time.perf_counter() - t0) * 1000
+        self.stages.record(stages)
+        for stage, ms in stages.items():
+            TREK_STAGE_LATENCY.observe(ms / 1000, stage)
+        self.completed += 1
+
+trek_jobs = TrekJobQueue(TREK_WORKERS)
+TREK_JOBS_TOTAL = metrics.gauge(
+    "trek_jobs_processed_total", "Qayta ishlangan treklar (ishga tushgandan beri)",
+    lambda: {("done",): trek_jobs.completed, ("failed",): trek_jobs.failed}, ("status",), kind="counter")
+
+# ══════════════════════════════════════════════════════
+# LIVE TREK (WebSocket)
+# ══════════════════════════════════════════════════════
+# Mini App yurish davomida nuqtalarni /api/trek_live orqali partiyalab
+# yuboradi. Server trekni xotirada saqlaydi va har partiyada tozalash,
+# masofa, bbox va yopiqlikni inkremental yangilaydi; yakunlashda faqat
+# finalize_trek (saqlash, zona, egallash) qoladi.
+
+def start_live_trek(user_id: int) -> int:
+    """Yangi 'active' trek qatori (oldingi tugallanmaganlari bekor qilinadi)."""
+    with get_db() as conn:
+        conn.execute("UPDATE treks SET status='cancelled' WHERE user_id=? AND status='active'", (user_id,))
+        return conn.execute(
+            "INSERT INTO treks (user_id, points, distance_m, status) VALUES (?, ?, 0, 'active') RETURNING id",
+            (user_id, encode_points([]))
+        ).fetchone()[0]
+
+def cancel_live_trek(trek_id: int) -> bool:
+    """'active' qolgan qatorni bekor qilish. Qaytaradi: trek saqlanganmi (status='finished')."""
+    with get_db() as conn:
+        conn.execute("UPDATE treks SET status='cancelled' WHERE id=? AND status='active'", (trek_id,))
+        row = conn.execute("SELECT status FROM treks WHERE id=?", (trek_id,)).fetchone()
+        return row is not None and row["status"] == "finished"
+
+class LiveTrek:
+    """
+    Bitta foydalanuvchining davom etayotgan treki. add() clean_trek
+    qoidalarini (noto'g'ri koordinata, sakrash, TREK_MIN_STEP_M) har
+    nuqtaga qo'llaydi; `received` — qabul qilingan xom nuqtalar soni
+    (client qayta ulanganda shu joydan davom ettiradi).
+    """
+
+    __slots__ = ("user_id", "trek_id", "team", "name", "points", "received", "dist_m", "bbox",
+                 "closed", "updated_at", "lock")
+
+    def __init__(self, user_id: int, trek_id: int, team: str, name: str = ""):
+        self.user_id = user_id
+        self.trek_id = trek_id
+        self.team = team
+        self.name = name
+        self.points: list = []
+        self.received = 0
+        self.dist_m = 0.0
+        self.bbox = None  # (min_lat, max_lat, min_lng, max_lng)
+        self.closed = False
+        self.updated_at = time.time()
+        self.lock = asyncio.Lock()
+
+    def add(self, points: list):
+        pts = self.points
+        for p in points:
+            self.received += 1
+            lat, lng = p["lat"], p["lng"]
+            if not (math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180):
+                continue
+            if pts and haversine(pts[-1]["lat"], pts[-1]["lng"], lat, lng) < TREK_MIN_STEP_M:
+                continue
+            if len(pts) >= 2:
+                # prev -> last -> p: last bitta nuqtali sakrash bo'lsa olib tashlanadi
+                prev, last = pts[-2], pts[-1]
+                d_prev_last = haversine(prev["lat"], prev["lng"], last["lat"], last["lng"])
+                if (d_prev_last > TREK_MAX_JUMP_M
+                        and haversine(last["lat"], last["lng"], lat, lng) > TREK_MAX_JUMP_M
+                        and haversine(prev["lat"], prev["lng"], lat, lng) <= TREK_MAX_JUMP_M):
+                    pts.pop()
+                    self.dist_m -= d_prev_last
+                    self.bbox = points_bbox(pts)
+                    if haversine(prev["lat"], prev["lng"], lat, lng) < TREK_MIN_STEP_M:
+                        continue
+            if pts:
+                self.dist_m += haversine(pts[-1]["lat"], pts[-1]["lng"], lat, lng)
+            pts.append({"lat": lat, "lng": lng})
+            if self.bbox is None:
+                self.bbox = (lat, lat, lng, lng)
+            else:
+                b = self.bbox
+                self.bbox = (min(b[0], lat), max(b[1], lat), min(b[2], lng), max(b[3], lng))
+            if not self.closed and len(pts) >= 8:
+                self.closed = haversine(pts[0]["lat"], pts[0]["lng"], lat, lng) <= TREK_CLOSE_M
+        self.updated_at = time.time()
+
+    def state(self) -> dict:
+        close_m = None
+        if len(self.points) > 1:
+            first, last = self.points[0], self.points[-1]
+            close_m = round(haversine(first["lat"], first["lng"], last["lat"], last["lng"]))
+        return {
+            "trek_id": self.trek_id,
+            "received": self.received,
+            "points": len(self.points),
+            "distance": round(self.dist_m, 1),
+            "closed": self.closed,
+            "close_m": close_m,
+        }
+
+class LiveTrekRegistry:
+    """
+    user_id -> LiveTrek; jim qolgan treklar fonda bekor qilinadi.
+    Saqlangan live trekdan keyin RESUBMIT_S ichida kelgan /api/trek_submit
+    (Mini App fallback'i) qayta ishlanmaydi — recently_finished().
+    """
+
+    RESUBMIT_S = 120.0
+
+    def __init__(self, idle_s: float):
+        self.idle_s = idle_s
+        self._treks: dict = {}
+        self._finished: dict = {}  # user_id -> saqlangan vaqti
+        self._bot = None
+        self._task = None
+        self.events = {"started": 0, "batches": 0, "finished": 0, "cancelled": 0, "expired": 0}
+
+    async def start(self, bot):
+        self._bot = bot
+        self._task = asyncio.create_task(self._sweeper())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def open(self, user_id: int, team: str, name: str = "") -> LiveTrek:
+        trek = self._treks.get(user_id)
+        if trek is None:
+            trek_id = await db_write(start_live_trek, user_id)
+            trek = self._treks.get(user_id)
+            if trek is None:
+                trek = self._treks[user_id] = LiveTrek(user_id, trek_id, team, name)
+                self.events["started"] += 1
+        if team:
+            trek.team = team
+        return trek
+
+    def add(self, trek: LiveTrek, points: list):
+        trek.add(points)
+        self.events["batches"] += 1
+        if trek.points:
+            last = trek.points[-1]
+            presence.update(trek.user_id, last["lat"], last["lng"], trek.team, trek.name,
+                            trek.points[-PRESENCE_TAIL:])
+
+    async def finish(self, trek: LiveTrek) -> str:
+        """
+        Xotiradagi tayyor holatdan trekni yakunlash va bot orqali natija yuborish.
+        Natijadan qat'i nazar trek registry'dan chiqariladi va 'active' qatori
+        yopiladi (erta qaytishda bekor qilinadi). save_trek'dan keyingi xato
+        qayta urinishga sabab bo'lmaydi — trek saqlangan, xabar qaytariladi;
+        saqlanmagan bo'lsa xato ko'tariladi va client /api/trek_submit'ga o'tadi.
+        """
+        stages: dict = {}
+        t0 = time.perf_counter()
+        try:
+            msg = await finalize_trek(trek.user_id, list(trek.points), trek.team, trek.closed, trek.dist_m,
+                                      stages, trek.trek_id, trek.bbox)
+            failed = False
+        except Exception:
+            logger.exception(f"❌ Live trek #{trek.trek_id} yakunlanmadi: user_id={trek.user_id}")
+            msg = "⏹️ *Trek saqlandi*, lekin zonani yakunlashda xato yuz berdi."
+            failed = True
+        finally:
+            self._discard(trek)
+        saved = await db_write(cancel_live_trek, trek.trek_id)
+        if failed and not saved:
+            self.events["cancelled"] += 1
+            raise RuntimeError(f"live trek #{trek.trek_id} saqlanmadi")
+        stages["total"] = (time.perf_counter() - t0) * 1000
+        if saved:
+            self._finished[trek.user_id] = time.time()
+        self.events["finished" if saved else "cancelled"] += 1
+        for stage, ms in stages.items():
+            TREK_STAGE_LATENCY.observe(ms / 1000, f"live_{stage}")
+        if self._bot is not None:
+            await send_trek_result(self._bot, trek.user_id, msg)
+        return msg
+
+    async def cancel(self, trek: LiveTrek):
+        self._discard(trek)
+        self.events["cancelled"] += 1
+        await db_write(cancel_live_trek, trek.trek_id)
+
+    def is_open(self, trek: LiveTrek) -> bool:
+        return self._treks.get(trek.user_id) is trek
+
+    def recently_finished(self, user_id: int) -> bool:
+        finished_at = self._finished.get(user_id)
+        return finished_at is not None and time.time() - finished_at < self.RESUBMIT_S
+
+    def _discard(self, trek: LiveTrek):
+        if self._treks.get(trek.user_id) is trek:
+            del self._treks[trek.user_id]
+            presence.end_trek(trek.user_id)
+
+    async def _sweeper(self):
+        while True:
+            await asyncio.sleep(min(300.0, self.idle_s))
+            now = time.time()
+            self._finished = {u: t for u, t in self._finished.items() if now - t < self.RESUBMIT_S}
+            cutoff = now - self.idle_s
+            for trek in [t for t in self._treks.values() if t.updated_at < cutoff]:
+                self._discard(trek)
+                self.events["expired"] += 1
+                with suppress(Exception):
+                    await db_write(cancel_live_trek, trek.trek_id)
+
+    def stats(self) -> dict:
+        return {"active": len(self._treks), **self.events}
+
+live_treks = LiveTrekRegistry(LIVE_TREK_IDLE_S)
+LIVE_TREKS_ACTIVE = metrics.gauge(
+    "live_treks_active", "Xotirada davom etayotgan live treklar", lambda: live_treks.stats()["active"])
+LIVE_TREK_EVENTS = metrics.gauge(
+    "live_trek_events_total", "Live trek hodisalari",
+    lambda: {(k,): v for k, v in live_treks.events.items()}, ("event",), kind="counter")
+
+# ══════════════════════════════════════════════════════
+# PRESENCE (faol o'yinchilar va treklar)
+# ══════════════════════════════════════════════════════
+# Har GPS partiyasi / Telegram location xabari faqat xotiraga yoziladi.
+# Yozuvlar PRESENCE_CELL_DEG kataklarga bo'lingan — viewport so'rovi faqat
+# o'ziga tushgan kataklarni ko'radi. TTL o'tganlar yangilanish tartibidagi
+# OrderedDict boshidan olib tashlanadi (alohida fon vazifasi kerak emas).
+
+PRESENCE_CELL_DEG = 0.01  # ~1.1 km
+
+class PresenceEntry:
+    __slots__ = ("user_id", "lat", "lng", "team", "name", "tail", "seen_at", "cell")
+
+    def public(self) -> dict:
+        team = TEAMS.get(self.team or "")
+        return {
+            "user_id": self.user_id,
+            "lat": self.lat,
+            "lng": self.lng,
+            "team": self.team,
+            "team_emoji": team["emoji"] if team else None,
+            "name": self.name,
+        }
+
+    def public_trek(self) -> dict:
+        return {"user_id": self.user_id, "points": self.tail, "team": self.team, "owner_name": self.name}
+
+def presence_cell(lat: float, lng: float) -> tuple:
+    return math.floor(lat / PRESENCE_CELL_DEG), math.floor(lng / PRESENCE_CELL_DEG)
+
+class PresenceTracker:
+    """
+    user_id -> PresenceEntry; cells: katak -> {user_id}. update() O(1),
+    query() viewport kataklari bilan chegaralangan. Faqat event loop'dan.
+    """
+
+    def __init__(self, ttl_s: float):
+        self.ttl_s = ttl_s
+        self._entries: OrderedDict = OrderedDict()  # seen_at bo'yicha tartiblangan
+        self._cells: dict = {}
+        self.updates = 0
+        self.expired = 0
+
+    def update(self, user_id: int, lat: float, lng: float, team: str | None, name: str,
+               tail: list | None = None, now: float | None = None):
+        """tail — davom etayotgan trekning oxirgi nuqtalari (None — trek yo'q, eskisi saqlanadi)."""
+        now = time.monotonic() if now is None else now
+        cell = presence_cell(lat, lng)
+        entry = self._entries.pop(user_id, None)
+        if entry is None:
+            entry = PresenceEntry()
+            entry.user_id, entry.name, entry.tail, entry.cell = user_id, None, None, None
+        if entry.cell != cell:
+            self._cell_discard(entry)
+            self._cells.setdefault(cell, set()).add(user_id)
+            entry.cell = cell
+        entry.lat, entry.lng, entry.team, entry.seen_at = lat, lng, team, now
+        entry.name = name or entry.name or "O'yinchi"
+        if tail is not None:
+            entry.tail = tail
+        self._entries[user_id] = entry
+        self.updates += 1
+        self._expire(now)
+
+    def end_trek(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.tail = None
+
+    def _cell_discard(self, entry: PresenceEntry):
+        users = self._cells.get(entry.cell)
+        if users is not None:
+            users.discard(entry.user_id)
+            if not users:
+                del self._cells[entry.cell]
+
+    def _expire(self, now: float):
+        cutoff = now - self.ttl_s
+        while self._entries:
+            user_id, entry = next(iter(self._entries.items()))
+            if entry.seen_at >= cutoff:
+                break
+            del self._entries[user_id]
+            self._cell_discard(entry)
+            self.expired += 1
+
+    def query(self, bbox: tuple | None, limit: int, treks_only: bool = False,
+              now: float | None = None) -> list:
+        """bbox (min_lat, max_lat, min_lng, max_lng) ichidagi faol yozuvlar, yangilari birinchi."""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        cutoff = now - self.ttl_s
+        if bbox is None:
+            candidates = (self._entries[uid] for uid in reversed(self._entries))
+        else:
+            (i0, j0), (i1, j1) = presence_cell(bbox[0], bbox[2]), presence_cell(bbox[1], bbox[3])
+            if (i1 - i0 + 1) * (j1 - j0 + 1) <= len(self._cells):
+                cells = ((i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1))
+            else:  # juda katta viewport — mavjud kataklar kamroq
+                cells = (c for c in self._cells if i0 <= c[0] <= i1 and j0 <= c[1] <= j1)
+            candidates = sorted(
+                (self._entries[uid] for c in cells for uid in self._cells.get(c, ())),
+                key=lambda e: e.seen_at, reverse=True,
+            )
+        result = []
+        for e in candidates:
+            if e.seen_at < cutoff or (treks_only and not e.tail):
+                continue
+            if bbox is not None and not (bbox[0] <= e.lat <= bbox[1] and bbox[2] <= e.lng <= bbox[3]):
+                continue
+            result.append(e)
+            if len(result) >= limit:
+                break
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "players": len(self._entries),
+            "cells": len(self._cells),
+            "updates": self.updates,
+            "expired": self.expired,
+        }
+
+presence = PresenceTracker(PRESENCE_TTL_S)
+PRESENCE_STATS = metrics.gauge(
+    "presence", "Faol o'yinchilar: soni, kataklar, yangilanishlar, muddati o'tganlar",
+    lambda: {(k,): v for k, v in presence.stats().items()}, ("stat",))
+
 # ══════════════════════════════════════════════════════
 # KEYBOARDS
 # ══════════════════════════════════════════════════════
@@ -776,19 +3248,19 @@ async def send_onboarding_miniapp(chat_id: int, bot):
 
 async def cmd_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    upsert_user(user.id, user.username or "", user.first_name or "")
+    await db_write(upsert_user, user.id, user.username or "", user.first_name or "")
 
     if ctx.args and len(ctx.args) > 0:
         arg = ctx.args[0]
         if arg.startswith("ref_"):
             try:
                 referrer_id = int(arg.replace("ref_", ""))
-                process_referral(user.id, referrer_id)
+                await db_write(process_referral, user.id, referrer_id)
                 logger.info(f"👥 Referral: {user.id} -> {referrer_id}")
             except ValueError:
                 pass
 
-    db_user = get_user(user.id)
+    db_user = await db_read(get_user, user.id)
     if not db_user or not db_user["team"]:
         await send_onboarding_miniapp(user.id, ctx.bot)
     else:
@@ -833,7 +3305,7 @@ async def cmd_team(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db_user = get_user(user_id)
+    db_user = await db_read(get_user, user_id)
     if not db_user:
         return await update.message.reply_text("❗️ /start bosing.")
     team = TEAMS.get(db_user["team"] or "", {"emoji": "❓", "name": "Tanlanmagan"})
@@ -855,7 +3327,7 @@ async def cmd_stats(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_coins(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db_user = get_user(user_id)
+    db_user = await db_read(get_user, user_id)
     if not db_user:
         return await update.message.reply_text("❗️ /start bosing.")
     coins = db_user.get("coins", 0)
@@ -878,10 +3350,6 @@ async def cmd_coins(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_strengthen(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db_user = get_user(user_id)
-    if not db_user:
-        return await update.message.reply_text("❗️ /start bosing.")
-
     args = ctx.args
     if not args or len(args) < 2:
         return await update.message.reply_text(
@@ -893,43 +3361,31 @@ async def cmd_strengthen(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         return await update.message.reply_text("❗️ Zone ID va miqdor raqam bo'lishi kerak.")
 
-    if amount < 10:
-        return await update.message.reply_text("❗️ Minimum 10 coin kerak.")
-    if amount % 10 != 0:
-        return await update.message.reply_text("❗️ Miqdor 10 ga karrali bo'lishi kerak (10, 20, 50...).")
+    error = zone_action_amount_error("strengthen", amount)
+    if error:
+        return await update.message.reply_text(f"❗️ {error}")
 
-    coins = db_user.get("coins", 0)
-    if coins < amount:
+    status, zone, new_health, coins = await db_write(change_zone_health, user_id, zone_id, "strengthen", amount)
+    if status == "not_found":
+        return await update.message.reply_text(f"❗️ Zona #{zone_id} topilmadi.")
+    if status == "not_owner":
+        return await update.message.reply_text("❗️ Bu zona sizniki emas! Faqat o'z zonangizni mustahkamlay olasiz.")
+    if status == "no_user":
+        return await update.message.reply_text("❗️ /start bosing.")
+    if status == "no_coins":
         return await update.message.reply_text(f"❗️ Yetarli coin yo'q. Balans: {coins} coin.")
 
-    with get_db() as conn:
-        zone = conn.execute("SELECT * FROM zones WHERE id=? AND active=1", (zone_id,)).fetchone()
-        if not zone:
-            return await update.message.reply_text(f"❗️ Zona #{zone_id} topilmadi.")
-        zone = dict(zone)
-        if zone["owner_id"] != user_id:
-            return await update.message.reply_text("❗️ Bu zona sizniki emas! Faqat o'z zonangizni mustahkamlay olasiz.")
-
-        health_gain = amount  # 10 coin = +10 health
-        new_health = min(300, zone.get("health", 100) + health_gain)
-        conn.execute("UPDATE zones SET health=? WHERE id=?", (new_health, zone_id))
-        conn.execute("UPDATE users SET coins = coins - ? WHERE user_id=?", (amount, user_id))
-
     await update.message.reply_text(
         f"🛡 *Zona mustahkamlandi!*\n\n"
         f"📍 Zona #{zone_id}\n"
         f"💊 Health: {zone.get('health', 100)} → {new_health}\n"
         f"🪙 Sarflandi: {amount} coin\n"
-        f"💰 Qolgan: {coins - amount} coin",
+        f"💰 Qolgan: {coins} coin",
         parse_mode="Markdown",
     )
 
 async def cmd_weaken(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db_user = get_user(user_id)
-    if not db_user:
-        return await update.message.reply_text("❗️ /start bosing.")
-
     args = ctx.args
     if not args or len(args) < 2:
         return await update.message.reply_text(
@@ -941,69 +3397,35 @@ async def cmd_weaken(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         return await update.message.reply_text("❗️ Zone ID va miqdor raqam bo'lishi kerak.")
 
-    if amount < 15:
-        return await update.message.reply_text("❗️ Minimum 15 coin kerak.")
-
-    coins = db_user.get("coins", 0)
-    if coins < amount:
+    error = zone_action_amount_error("weaken", amount)
+    if error:
+        return await update.message.reply_text(f"❗️ {error}")
+
+    # 15 coin = -10 health; zona egasi shu tranzaksiyada xabardor qilinadi
+    status, zone, new_health, coins = await db_write(
+        change_zone_health, user_id, zone_id, "weaken", amount, notify=True)
+    if status == "not_found":
+        return await update.message.reply_text(f"❗️ Zona #{zone_id} topilmadi.")
+    if status == "own_zone":
+        return await update.message.reply_text("❗️ O'z zonangizni zaiflatib bo'lmaydi!")
+    if status == "no_user":
+        return await update.message.reply_text("❗️ /start bosing.")
+    if status == "no_coins":
         return await update.message.reply_text(f"❗️ Yetarli coin yo'q. Balans: {coins} coin.")
 
-    with get_db() as conn:
-        zone = conn.execute("SELECT * FROM zones WHERE id=? AND active=1", (zone_id,)).fetchone()
-        if not zone:
-            return await update.message.reply_text(f"❗️ Zona #{zone_id} topilmadi.")
-        zone = dict(zone)
-        if zone["owner_id"] == user_id:
-            return await update.message.reply_text("❗️ O'z zonangizni zaiflatib bo'lmaydi!")
-
-        # 15 coin = -10 health
-        health_loss = (amount // 15) * 10
-        new_health = max(0, zone.get("health", 100) - health_loss)
-        conn.execute("UPDATE zones SET health=? WHERE id=?", (new_health, zone_id))
-        conn.execute("UPDATE users SET coins = coins - ? WHERE user_id=?", (amount, user_id))
-
-        # Zona egasini xabardor qilish
-        try:
-            attacker_team = TEAMS.get(db_user.get("team", ""), {"emoji": "❓"})
-            await ctx.bot.send_message(
-                chat_id=zone["owner_id"],
-                text=(
-                    f"⚠️ *Zonangizga hujum!*\n\n"
-                    f"📍 Zona #{zone_id}\n"
-                    f"{attacker_team['emoji']} {db_user['first_name']} hujum qildi!\n"
-                    f"💊 Health: {zone.get('health', 100)} → {new_health}\n\n"
-                    f"{'🔴 Xavf! Zona zaif!' if new_health < 30 else '💪 Mustahkamlang!'}"
-                ),
-                parse_mode="Markdown",
-            )
-        except Exception:
-            pass
-
     await update.message.reply_text(
         f"⚔️ *Hujum muvaffaqiyatli!*\n\n"
         f"📍 Zona #{zone_id}\n"
         f"💊 Health: {zone.get('health', 100)} → {new_health}\n"
         f"🪙 Sarflandi: {amount} coin\n"
-        f"💰 Qolgan: {coins - amount} coin\n\n"
+        f"💰 Qolgan: {coins} coin\n\n"
         f"{'🔴 Zona endi juda zaif!' if new_health < 30 else ''}",
         parse_mode="Markdown",
     )
 
 async def cmd_weekly(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     """Haftalik reyting"""
-    with get_db() as conn:
-        rows = conn.execute("""
-            SELECT u.first_name, u.team, 
-                   COUNT(t.id) as trek_count,
-                   COALESCE(SUM(t.distance_m)/1000, 0) as week_km
-            FROM users u
-            LEFT JOIN treks t ON t.user_id = u.user_id
-                AND t.finished_at >= datetime('now', '-7 days')
-                AND t.status = 'finished'
-            GROUP BY u.user_id
-            ORDER BY week_km DESC
-            LIMIT 10
-        """).fetchall()
+    rows = await db_read(get_weekly_top_cached)
 
     if not rows:
         return await update.message.reply_text("📋 Bu hafta hali trek yo'q.")
@@ -1015,11 +3437,7 @@ async def cmd_weekly(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode="Markdown", reply_markup=main_menu_kb())
 
 async def cmd_leaderboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    with get_db() as conn:
-        rows = conn.execute(
-            "SELECT first_name, username, team, zones_owned, zones_taken, total_km, coins "
-            "FROM users ORDER BY zones_owned DESC LIMIT 10"
-        ).fetchall()
+    rows = await db_read(get_leaderboard_cached)
     if not rows:
         return await update.message.reply_text("📋 Hali o'yinchilar yo'q.")
     text = "🏆 *TOP-10 O'yinchilar*\n\n"
@@ -1031,7 +3449,7 @@ async def cmd_leaderboard(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(text, parse_mode="Markdown", reply_markup=main_menu_kb())
 
 async def cmd_zones(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
-    zones = get_user_zones(update.effective_user.id)
+    zones = await db_read(get_user_zones, update.effective_user.id)
     if not zones:
         return await update.message.reply_text("🗺 Hali zona yo'q.", reply_markup=main_menu_kb())
     text = f"🗺 *Zonalar ({len(zones)} ta)*\n\n"
@@ -1043,7 +3461,7 @@ async def cmd_zones(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     try:
         zone_id = int(update.message.text.split("_")[1])
-        history = get_zone_history(zone_id)
+        history = await db_read(get_zone_history, zone_id)
         if not history:
             return await update.message.reply_text("Tarix topilmadi.")
         text = f"📜 *Zona #{zone_id} tarixi*\n\n"
@@ -1055,7 +3473,7 @@ async def cmd_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_achievements(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    user_achs = get_user_achievements(user_id)
+    user_achs = await db_read(get_user_achievements, user_id)
 
     if not user_achs:
         return await update.message.reply_text(
@@ -1081,7 +3499,7 @@ async def cmd_achievements(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def cmd_referral(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db_user = get_user(user_id)
+    db_user = await db_read(get_user, user_id)
     bot_info = await ctx.bot.get_me()
     link = get_referral_link(user_id, bot_info.username)
     ref_count = db_user["referral_count"] if db_user else 0
@@ -1099,10 +3517,11 @@ async def cmd_referral(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
 async def handle_location(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    db_user = get_user(user_id)
+    db_user = await db_read(get_user, user_id)
     if not db_user or not db_user["team"]:
         return await update.message.reply_text("❗️ Avval jamoa tanlang!", reply_markup=team_kb())
     lat, lng = update.message.location.latitude, update.message.location.longitude
+    presence.update(user_id, lat, lng, db_user["team"], db_user["first_name"])
     if ctx.user_data.get("mode") == MODE_CIRCLE:
         ctx.user_data.update({"circle_lat": lat, "circle_lng": lng})
         return await update.message.reply_text("📍 Radius tanlang:", reply_markup=radius_kb())
@@ -1116,7 +3535,7 @@ async def handle_text(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
 
     if text == "▶️ Trek boshlash":
-        db_user = get_user(user_id)
+        db_user = await db_read(get_user, user_id)
         if not db_user or not db_user["team"]:
             return await update.message.reply_text("Avval jamoa tanlang!", reply_markup=team_kb())
         await update.message.reply_text(
@@ -1147,7 +3566,7 @@ async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 
     if q.data.startswith("team:"):
         team_key = q.data.split(":")[1]
-        set_team(user_id, team_key)
+        await db_write(set_team, user_id, team_key)
         await q.edit_message_text(f"✅ Jamoa tanlandi: {TEAMS[team_key]['name']}")
         await q.message.reply_text("Asosiy menyu:", reply_markup=main_menu_kb())
 
@@ -1164,15 +3583,15 @@ async def handle_callback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         lng = ctx.user_data.get("circle_lng")
         if not lat or not lng:
             return await q.edit_message_text("❗️ Markaz topilmadi. Avval joylashuvni yuboring.")
-        db_user = get_user(user_id)
+        db_user = await db_read(get_user, user_id)
         if not db_user or not db_user["team"]:
             return await q.edit_message_text("❗️ Avval jamoa tanlang!")
         radius = float(q.data.split(":")[1])
-        zone_id = await create_zone_circle_with_photo(ctx.bot, user_id, db_user["team"], lat, lng, radius)
+        zone_id = await create_zone_circle_with_photo(user_id, db_user["team"], lat, lng, radius)
         ctx.user_data["mode"] = MODE_IDLE
 
-        updated_user = get_user(user_id)
-        await check_and_award(user_id, ctx.bot, updated_user)
+        updated_user = await db_read(get_user, user_id)
+        await check_and_award(user_id, updated_user)
 
         area = math.pi * radius ** 2
         await q.edit_message_text(
@@ -1209,33 +3628,16 @@ async def api_trek_submit(request: web.Request) -> web.Response:
             headers=CORS_HEADERS,
         )
 
-    init_data = body.get("init_data", "")
-    user_info = parse_init_data(init_data)
+    auth = verify_init_data(body.get("init_data", ""))
 
-    if not user_info:
-        # ✅ Determine specific error reason
-        error_msg = "Unauthorized — Yaroqsiz yoxud soxta initData"
-        error_code = "AUTH_FAILED"
-        
-        # Check if it was an expiration issue
-        if init_data:
-            try:
-                params = dict(
-                    pair.split("=", 1) 
-                    for pair in init_data.split("&") 
-                    if "=" in pair
-                )
-                auth_date = params.get("auth_date")
-                if auth_date:
-                    age = int(time.time()) - int(auth_date)
-                    if age > INIT_DATA_MAX_AGE:
-                        error_msg = "⏰ Sessiya tugadi. Botni yoping va qayta oching."
-                        error_code = "SESSION_EXPIRED"
-                        logger.error(f"   Session age: {age}s, expired {age - INIT_DATA_MAX_AGE}s ago")
-            except Exception as parse_err:
-                logger.debug(f"   Error parsing auth_date: {parse_err}")
-        
-        logger.error(f"❌ Auth failed! Error code: {error_code}")
+    if not auth.ok:
+        if auth.reason == "SESSION_EXPIRED":
+            error_msg = "⏰ Sessiya tugadi. Botni yoping va qayta oching."
+            error_code = "SESSION_EXPIRED"
+        else:
+            error_msg = "Unauthorized — Yaroqsiz yoxud soxta initData"
+            error_code = "AUTH_FAILED"
+        logger.warning(f"❌ Auth failed: {auth.reason} (age={auth.age}) -> {error_code}")
         return web.Response(
             text=json.dumps({
                 "ok": False, 
@@ -1248,45 +3650,283 @@ async def api_trek_submit(request: web.Request) -> web.Response:
             headers=CORS_HEADERS,
         )
 
-    user_id    = user_info.get("id")
-    first_name = user_info.get("first_name", "")
-    username   = user_info.get("username", "")
+    user_id    = auth.user.get("id")
+    first_name = auth.user.get("first_name", "")
+    username   = auth.user.get("username", "")
 
     logger.info(f"✅ Auth OK: user_id={user_id}, name={first_name}")
-    upsert_user(user_id, username, first_name)
 
-    points = body.get("points", [])
+    try:
+        points = [{"lat": float(p["lat"]), "lng": float(p["lng"])} for p in body.get("points") or []]
+        dist_m = float(body.get("distance") or 0)
+    except (TypeError, KeyError, ValueError):
+        return web.Response(
+            text=json.dumps({"ok": False, "error": "points: [{lat, lng}], distance: number",
+                             "error_code": "INVALID_TREK"}),
+            status=400,
+            content_type="application/json",
+            headers=CORS_HEADERS,
+        )
     team   = body.get("team", "")
     closed = body.get("closed", False)
-    dist_m = body.get("distance", 0)
 
-    msg = await process_trek(_app.bot, user_id, points, team, closed, dist_m)
+    if live_treks.recently_finished(user_id):
+        # Live finish trekni saqlagan — fallback yuborilishi km/coin'ni ikki marta bermasin
+        logger.info(f"↩️ Trek allaqachon live saqlangan: user_id={user_id}")
+        return web.Response(
+            text=json.dumps({"ok": False, "error": "Trek allaqachon saqlangan", "error_code": "TREK_CLOSED"}),
+            status=409,
+            content_type="application/json",
+            headers=CORS_HEADERS,
+        )
+
+    await db_write(upsert_user, user_id, username, first_name)
+    job_id = await db_write(enqueue_trek_job, user_id, team, points, dist_m, closed)
+    trek_jobs.wake()
+    logger.info(f"📥 Trek #{job_id} navbatga qo'yildi: user_id={user_id}, {len(points)} nuqta")
+
+    return web.Response(
+        text=json.dumps({
+            "ok": True,
+            "message": "Trek qabul qilindi!",
+            "job_id": job_id,
+            "status_url": f"/api/trek_status?job_id={job_id}",
+        }),
+        status=202,
+        content_type="application/json",
+        headers=CORS_HEADERS,
+    )
 
+async def api_trek_status(request: web.Request) -> web.Response:
+    """
+    Trek navbatdagi ish holati: queued | processing | done | failed.
+    initData — X-Telegram-Init-Data header'ida yoki ?init_data= da.
+    """
+    init_data = request.headers.get("X-Telegram-Init-Data") or request.query.get("init_data", "")
+    user_info = parse_init_data(init_data)
+    if not user_info:
+        return web.Response(text=json.dumps({"ok": False, "error": "Unauthorized", "error_code": "AUTH_FAILED"}),
+                            status=401, content_type="application/json", headers=CORS_HEADERS)
     try:
-        await _app.bot.send_message(
-            chat_id=user_id,
-            text=msg,
-            parse_mode=ParseMode.MARKDOWN,
-            reply_markup=main_menu_kb(),
-        )
-        logger.info(f"📤 Bot xabar yuborildi: user_id={user_id}")
-    except Exception as e:
-        logger.error(f"❌ Bot message error: {e}")
+        job_id = int(request.query["job_id"])
+    except (KeyError, ValueError):
+        return web.Response(text=json.dumps({"ok": False, "error": "job_id must be int"}), status=400,
+                            content_type="application/json", headers=CORS_HEADERS)
+
+    job = await db_read(get_trek_job, job_id)
+    if not job or job["user_id"] != user_info.get("id"):
+        return web.Response(text=json.dumps({"ok": False, "error": "Job topilmadi"}), status=404,
+                            content_type="application/json", headers=CORS_HEADERS)
 
     return web.Response(
-        text=json.dumps({"ok": True, "message": "Trek qabul qilindi!"}),
+        text=json.dumps({
+            "ok": True,
+            "job_id": job_id,
+            "status": job["status"],
+            "position": job["position"],
+            "message": job["message"],
+            "error": job["error"],
+        }),
         content_type="application/json",
         headers=CORS_HEADERS,
     )
 
-async def api_zones(request: web.Request) -> web.Response:
-    zones = get_all_zones()
+def ws_error(error_code: str, error: str) -> dict:
+    return {"type": "error", "error_code": error_code, "error": error}
+
+async def api_trek_live(request: web.Request) -> web.WebSocketResponse:
+    """
+    Live trek WebSocket. Xabarlar (JSON):
+      → {"type": "start", "init_data", "team"}        ← {"type": "ready", ...LiveTrek.state()}
+      → {"type": "points", "from": N, "points": [...]} ← {"type": "ack", ...} | {"type": "resync", "received"}
+      → {"type": "finish"}                             ← {"type": "done", "message"}
+      → {"type": "cancel"}                             ← {"type": "cancelled"}
+    "from" — partiyadagi birinchi nuqtaning trekdagi indeksi; allaqachon
+    qabul qilingan qismi tashlanadi, bo'shliq bo'lsa resync qaytadi.
+    finish bir martalik: keyingi finish — TREK_CLOSED; trek saqlanmagan
+    bo'lsa FINISH_FAILED (client /api/trek_submit'ga o'tadi).
+    """
+    ws = web.WebSocketResponse(heartbeat=30, max_msg_size=1 << 20)
+    await ws.prepare(request)
+    trek = None
+    async for frame in ws:
+        if frame.type != WSMsgType.TEXT:
+            continue
+        try:
+            data = json.loads(frame.data)
+            kind = data.get("type")
+        except (ValueError, AttributeError):
+            await ws.send_json(ws_error("INVALID_JSON", "Invalid JSON"))
+            continue
+
+        if trek is None:
+            if kind != "start":
+                await ws.send_json(ws_error("AUTH_FAILED", "Avval start yuboring"))
+                break
+            auth = verify_init_data(data.get("init_data", ""))
+            if not auth.ok:
+                code = "SESSION_EXPIRED" if auth.reason == "SESSION_EXPIRED" else "AUTH_FAILED"
+                await ws.send_json(ws_error(code, "Unauthorized — Yaroqsiz yoxud soxta initData"))
+                break
+            user_id = auth.user.get("id")
+            await db_write(upsert_user, user_id, auth.user.get("username", ""), auth.user.get("first_name", ""))
+            trek = await live_treks.open(user_id, data.get("team", ""), auth.user.get("first_name", ""))
+            await ws.send_json({"type": "ready", **trek.state()})
+
+        elif kind == "points":
+            try:
+                points = [{"lat": float(p["lat"]), "lng": float(p["lng"])} for p in data.get("points") or []]
+                start = int(data.get("from", trek.received))
+                if start < 0:
+                    raise ValueError(start)
+            except (TypeError, KeyError, ValueError):
+                await ws.send_json(ws_error("INVALID_TREK", "points: [{lat, lng}], from: int"))
+                continue
+            async with trek.lock:
+                if not live_treks.is_open(trek):
+                    await ws.send_json(ws_error("TREK_CLOSED", "Trek allaqachon yakunlangan"))
+                    break
+                if start > trek.received:
+                    await ws.send_json({"type": "resync", "received": trek.received})
+                    continue
+                if start + len(points) > LIVE_TREK_MAX_POINTS:
+                    await ws.send_json(ws_error("TREK_TOO_LONG", f"Ko'pi bilan {LIVE_TREK_MAX_POINTS} nuqta"))
+                    continue
+                live_treks.add(trek, points[trek.received - start:])
+                await ws.send_json({"type": "ack", **trek.state()})
+
+        elif kind == "finish":
+            async with trek.lock:
+                if not live_treks.is_open(trek):
+                    await ws.send_json(ws_error("TREK_CLOSED", "Trek allaqachon yakunlangan"))
+                    break
+                if len(trek.points) < 5:
+                    await ws.send_json(ws_error("TREK_TOO_SHORT", "Trek juda qisqa (kamida 5 nuqta kerak)"))
+                    continue
+                try:
+                    msg = await live_treks.finish(trek)
+                except Exception:
+                    await ws.send_json(ws_error("FINISH_FAILED", "Trek saqlanmadi, qayta urinib ko'ring"))
+                    break
+            await ws.send_json({"type": "done", "message": msg, **trek.state()})
+            break
+
+        elif kind == "cancel":
+            async with trek.lock:
+                if live_treks.is_open(trek):
+                    await live_treks.cancel(trek)
+            await ws.send_json({"type": "cancelled"})
+            break
+
+    await ws.close()
+    return ws
+
+async def api_trek_queue(request: web.Request) -> web.Response:
+    """Navbat chuqurligi, kechikish va bosqichlar vaqti (sig'imni rejalash uchun)."""
     return web.Response(
-        text=json.dumps(zones, default=str),
+        text=json.dumps(await trek_jobs.stats()),
         content_type="application/json",
         headers=CORS_HEADERS,
     )
 
+def zones_etag(version: int) -> str:
+    return f'"zones-{version}"'
+
+def parse_bbox(value: str) -> tuple:
+    """Leaflet toBBoxString(): "west,south,east,north" -> (min_lat, max_lat, min_lng, max_lng)"""
+    west, south, east, north = (float(v) for v in value.split(","))
+    if not (-90 <= south <= north <= 90 and -180 <= west <= east <= 180):
+        raise ValueError(f"bbox noto'g'ri: {value}")
+    return south, north, west, east
+
+async def api_zones(request: web.Request) -> web.Response:
+    """
+    Zonalar ro'yxati.
+
+    ?since=<version> — faqat shu versiyadan keyingi o'zgarishlar
+    ({"version", "zones", "removed"}); since joriy versiyadan katta bo'lsa —
+    to'liq snapshot ("reset": true). If-None-Match yoki since == version — 304;
+    since <= 0 — har doim to'liq yuklash (304 qaytarilmaydi).
+    ?bbox=west,south,east,north&zoom=<z> — faqat viewport'dagi zonalar,
+    past zoom'da soddalashtirilgan polygonlar bilan (since bilan birga ham ishlaydi).
+    """
+    since = request.query.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return web.Response(text=json.dumps({"ok": False, "error": "since must be int"}), status=400,
+                                content_type="application/json", headers=CORS_HEADERS)
+    try:
+        bbox = parse_bbox(request.query["bbox"]) if "bbox" in request.query else None
+        zoom = int(request.query["zoom"]) if "zoom" in request.query else None
+    except ValueError:
+        return web.Response(text=json.dumps({"ok": False, "error": "bbox=west,south,east,north va zoom=int"}),
+                            status=400, content_type="application/json", headers=CORS_HEADERS)
+
+    version = await db_read(get_zone_version)
+    etag = zones_etag(version)
+    headers = {**CORS_HEADERS, "ETag": etag, "X-Zone-Version": str(version)}
+    reload = since is not None and since <= 0
+    if not reload and (request.headers.get("If-None-Match") == etag or since == version):
+        return web.Response(status=304, headers=headers)
+
+    if since is not None:
+        version, body = await db_read(get_zones_delta_json, since, bbox, zoom)
+    else:
+        version, body = await db_read(get_zones_json, bbox, zoom)
+    headers["ETag"] = zones_etag(version)
+    headers["X-Zone-Version"] = str(version)
+    return web.Response(
+        body=body,
+        content_type="application/json",
+        headers=headers,
+    )
+
+async def api_zones_stream(request: web.Request) -> web.StreamResponse:
+    """
+    Zona o'zgarishlari oqimi (Server-Sent Events): created | captured | health | updated.
+    ?bbox=&zoom= — faqat shu viewport, /api/zones kabi soddalashtirilgan.
+    ?since= yoki Last-Event-ID — shu versiyadan keyingi o'tkazib yuborilganlar
+    avval keshdan yuboriladi. Har xabar: id: <version>, data: /api/zones?since= JSON'i.
+    """
+    try:
+        since = request.headers.get("Last-Event-ID") or request.query.get("since")
+        since = int(since) if since is not None else None
+        bbox = parse_bbox(request.query["bbox"]) if "bbox" in request.query else None
+        zoom = int(request.query["zoom"]) if "zoom" in request.query else None
+    except ValueError:
+        return web.Response(text=json.dumps({"ok": False, "error": "since=int, bbox=west,south,east,north, zoom=int"}),
+                            status=400, content_type="application/json", headers=CORS_HEADERS)
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        **CORS_HEADERS,
+    })
+    await response.prepare(request)
+    sub = zone_hub.subscribe(bbox, zoom)  # catch-up'dan oldin — oradagi o'zgarish yo'qolmaydi
+    try:
+        await response.write(b"retry: 3000\n\n")
+        if since is not None:
+            version, body = await db_read(get_zones_delta_json, since, bbox, zoom)
+            if since <= 0 or version != since:
+                await response.write(sse_chunk(version, body))
+        while True:
+            try:
+                chunk = await asyncio.wait_for(sub.queue.get(), ZONE_STREAM_PING_S)
+            except asyncio.TimeoutError:
+                chunk = b": ping\n\n"
+            if chunk is None:  # navbat to'ldi — client Last-Event-ID bilan qayta ulanadi
+                break
+            await response.write(chunk)
+    except ConnectionResetError:
+        pass
+    finally:
+        zone_hub.unsubscribe(sub)
+    return response
+
 async def api_user_me(request: web.Request) -> web.Response:
     """Foydalanuvchi ma'lumotlari (coins, stats)"""
     try:
@@ -1302,7 +3942,7 @@ async def api_user_me(request: web.Request) -> web.Response:
                             content_type="application/json", headers=CORS_HEADERS)
 
     user_id = user_info.get("id")
-    db_user = get_user(user_id)
+    db_user = await db_read(get_user, user_id)
     if not db_user:
         return web.Response(text=json.dumps({"ok": False, "error": "User not found"}), status=404,
                             content_type="application/json", headers=CORS_HEADERS)
@@ -1334,45 +3974,40 @@ async def api_zone_action(request: web.Request) -> web.Response:
                             status=401, content_type="application/json", headers=CORS_HEADERS)
 
     user_id = user_info.get("id")
-    db_user = get_user(user_id)
-    zone_id = body.get("zone_id")
-    coins_spend = int(body.get("coins", 0))
     action = body.get("action", "")  # "strengthen" or "weaken"
+    try:
+        zone_id = int(body["zone_id"])
+        coins_spend = int(body.get("coins", 0))
+    except (KeyError, TypeError, ValueError):
+        return web.Response(text=json.dumps({"ok": False, "error": "zone_id va coins butun son bo'lishi kerak"}),
+                            status=400, content_type="application/json", headers=CORS_HEADERS)
 
-    if action not in ("strengthen", "weaken"):
+    if action not in ZONE_ACTION_STEP:
         return web.Response(text=json.dumps({"ok": False, "error": "action must be strengthen or weaken"}),
                             status=400, content_type="application/json", headers=CORS_HEADERS)
 
-    if coins_spend <= 0:
-        return web.Response(text=json.dumps({"ok": False, "error": "coins must be > 0"}),
+    error = zone_action_amount_error(action, coins_spend)
+    if error:
+        return web.Response(text=json.dumps({"ok": False, "error": error}),
                             status=400, content_type="application/json", headers=CORS_HEADERS)
 
-    user_coins = db_user.get("coins", 0)
-    if user_coins < coins_spend:
+    status, zone, new_health, user_coins = await db_write(
+        change_zone_health, user_id, zone_id, action, coins_spend, notify=action == "weaken")
+    if status == "no_user":
+        return web.Response(text=json.dumps({"ok": False, "error": "User not found"}), status=404,
+                            content_type="application/json", headers=CORS_HEADERS)
+    if status == "no_coins":
         return web.Response(text=json.dumps({"ok": False, "error": f"Yetarli coin yo'q. Balans: {user_coins}"}),
                             status=400, content_type="application/json", headers=CORS_HEADERS)
-
-    with get_db() as conn:
-        zone = conn.execute("SELECT * FROM zones WHERE id=? AND active=1", (zone_id,)).fetchone()
-        if not zone:
-            return web.Response(text=json.dumps({"ok": False, "error": "Zona topilmadi"}),
-                                status=404, content_type="application/json", headers=CORS_HEADERS)
-        zone = dict(zone)
-
-        if action == "strengthen":
-            if zone["owner_id"] != user_id:
-                return web.Response(text=json.dumps({"ok": False, "error": "Bu zona sizniki emas!"}),
-                                    status=403, content_type="application/json", headers=CORS_HEADERS)
-            new_health = min(300, zone.get("health", 100) + coins_spend)
-        else:  # weaken
-            if zone["owner_id"] == user_id:
-                return web.Response(text=json.dumps({"ok": False, "error": "O'z zonangizni zaiflatib bo'lmaydi!"}),
-                                    status=403, content_type="application/json", headers=CORS_HEADERS)
-            health_loss = (coins_spend // 15) * 10
-            new_health = max(0, zone.get("health", 100) - health_loss)
-
-        conn.execute("UPDATE zones SET health=? WHERE id=?", (new_health, zone_id))
-        conn.execute("UPDATE users SET coins = coins - ? WHERE user_id=?", (coins_spend, user_id))
+    if status == "not_found":
+        return web.Response(text=json.dumps({"ok": False, "error": "Zona topilmadi"}),
+                            status=404, content_type="application/json", headers=CORS_HEADERS)
+    if status == "not_owner":
+        return web.Response(text=json.dumps({"ok": False, "error": "Bu zona sizniki emas!"}),
+                            status=403, content_type="application/json", headers=CORS_HEADERS)
+    if status == "own_zone":
+        return web.Response(text=json.dumps({"ok": False, "error": "O'z zonangizni zaiflatib bo'lmaydi!"}),
+                            status=403, content_type="application/json", headers=CORS_HEADERS)
 
     return web.Response(
         text=json.dumps({
@@ -1381,49 +4016,321 @@ async def api_zone_action(request: web.Request) -> web.Response:
             "old_health": zone.get("health", 100),
             "new_health": new_health,
             "coins_spent": coins_spend,
-            "coins_remaining": user_coins - coins_spend,
+            "coins_remaining": user_coins,
         }),
         content_type="application/json",
         headers=CORS_HEADERS,
     )
 
+async def api_leaderboard(request: web.Request) -> web.Response:
+    """
+    Xarita reyting paneli: [{user_id, name, team, team_emoji, team_name, zones_owned, total_km, coins}].
+    ?by=zones|km|coins — bitta ko'rsatkich bo'yicha tartiblangan; berilmasa uchala TOP birlashmasi.
+    ?limit= (default 20, max 100). ETag — reyting versiyasi.
+    """
+    by = request.query.get("by") or None
+    try:
+        limit = max(1, min(100, int(request.query.get("limit", "20"))))
+        if by is not None and by not in RANKING_BY:
+            raise ValueError(by)
+    except ValueError:
+        return web.Response(text=json.dumps({"ok": False, "error": "by=zones|km|coins, limit=int"}),
+                            status=400, content_type="application/json", headers=CORS_HEADERS)
+
+    version, body = await db_read(user_rankings.leaderboard_json, by, limit)
+    etag = f'"lb-{version}"'
+    headers = {**CORS_HEADERS, "ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("If-None-Match") == etag:
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+async def api_user(request: web.Request) -> web.Response:
+    """Xarita foydalanuvchi kartasi: public_ranking_row + rank {zones, km, coins}."""
+    try:
+        user_id = int(request.query["user_id"])
+    except (KeyError, ValueError):
+        return web.Response(text=json.dumps({"ok": False, "error": "user_id must be int"}), status=400,
+                            content_type="application/json", headers=CORS_HEADERS)
+    row = await db_read(user_rankings.get, user_id)
+    if row is None:
+        return web.Response(text=json.dumps({"ok": False, "error": "User not found"}), status=404,
+                            content_type="application/json", headers=CORS_HEADERS)
+    return web.Response(
+        text=json.dumps({**public_ranking_row(row), "rank": row["rank"]}, ensure_ascii=False),
+        content_type="application/json",
+        headers=CORS_HEADERS,
+    )
+
+def presence_query(request: web.Request) -> tuple:
+    """?bbox=west,south,east,north (ixtiyoriy) va ?limit= -> (bbox, limit); xato bo'lsa ValueError."""
+    bbox = parse_bbox(request.query["bbox"]) if "bbox" in request.query else None
+    limit = max(1, min(PRESENCE_LIMIT, int(request.query.get("limit", PRESENCE_LIMIT))))
+    return bbox, limit
+
+async def api_active_players(request: web.Request) -> web.Response:
+    """Oxirgi PRESENCE_TTL_S ichida joylashuvi kelgan o'yinchilar: [{user_id, lat, lng, team, team_emoji, name}]."""
+    try:
+        bbox, limit = presence_query(request)
+    except ValueError:
+        return web.Response(text=json.dumps({"ok": False, "error": "bbox=west,south,east,north, limit=int"}),
+                            status=400, content_type="application/json", headers=CORS_HEADERS)
+    return web.Response(
+        text=json.dumps([e.public() for e in presence.query(bbox, limit)], ensure_ascii=False),
+        content_type="application/json",
+        headers=CORS_HEADERS,
+    )
+
+async def api_active_treks(request: web.Request) -> web.Response:
+    """Davom etayotgan live treklarning oxirgi PRESENCE_TAIL nuqtasi: [{user_id, points, team, owner_name}]."""
+    try:
+        bbox, limit = presence_query(request)
+    except ValueError:
+        return web.Response(text=json.dumps({"ok": False, "error": "bbox=west,south,east,north, limit=int"}),
+                            status=400, content_type="application/json", headers=CORS_HEADERS)
+    return web.Response(
+        text=json.dumps([e.public_trek() for e in presence.query(bbox, limit, treks_only=True)],
+                        ensure_ascii=False),
+        content_type="application/json",
+        headers=CORS_HEADERS,
+    )
+
 async def api_health(request: web.Request) -> web.Response:
     return web.Response(text="OK", headers=CORS_HEADERS)
 
-async def start_web_server():
-    app_web = web.Application(middlewares=[cors_middleware])
+_trek_queue_depth: dict = {}
+TREK_QUEUE_DEPTH = metrics.gauge(
+    "trek_queue_depth", "trek_jobs navbatidagi ishlar",
+    lambda: {(k,): v for k, v in _trek_queue_depth.items() if k != "oldest_queued_s"}, ("status",))
+TREK_QUEUE_LAG = metrics.gauge(
+    "trek_queue_oldest_seconds", "Eng eski navbatdagi trek yoshi",
+    lambda: _trek_queue_depth.get("oldest_queued_s", 0))
+CACHE_STATS = metrics.gauge(
+    "cache_events", "Keshlar: hit/miss va o'lcham",
+    lambda: {
+        **{("zone", k): v for k, v in zone_cache.stats().items() if k in ("zones", "hits", "misses", "rebuilds")},
+        **{("photo", k): v for k, v in photo_cache.stats().items()},
+        ("rankings", "users"): user_rankings.stats()["users"],
+        ("init_data", "hits"): init_data_cache.hits,
+        ("init_data", "misses"): init_data_cache.misses,
+    },
+    ("cache", "stat"))
+ZONE_STREAM_STATS = metrics.gauge(
+    "zone_stream_events", "Zona hodisalari: obunachilar, e'lon qilingan/yetkazilgan xabarlar, to'lib qolishlar",
+    lambda: {(k,): v for k, v in zone_hub.stats().items()}, ("stat",))
+OUTBOX_STATS = metrics.gauge(
+    "outbox_messages_total", "Bildirishnomalar navbati statistikasi",
+    lambda: {(k,): v for k, v in outbox.stats().items()}, ("stat",), kind="counter")
+
+async def api_metrics(request: web.Request) -> web.Response:
+    """Prometheus text exposition format (0.0.4)."""
+    _trek_queue_depth.update(await db_read(trek_queue_depth))
+    return web.Response(
+        text=metrics.render(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+UPDATE_QUEUE_SIZE = metrics.gauge(
+    "bot_update_queue_size", "Application.update_queue'da qayta ishlanishini kutayotgan update'lar",
+    lambda: _app.update_queue.qsize() if _app is not None else 0)
+
+async def api_telegram_webhook(request: web.Request) -> web.Response:
+    """Telegram update'ini qabul qilib to'g'ridan-to'g'ri Application.update_queue'ga qo'yadi."""
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        logger.warning(f"⚠️ Webhook: noto'g'ri secret token ({request.remote})")
+        return web.Response(status=403)
+    try:
+        update = Update.de_json(await request.json(), _app.bot)
+    except Exception as e:
+        logger.warning(f"⚠️ Webhook: yaroqsiz update: {e}")
+        return web.Response(status=400)
+    if update is None:
+        return web.Response(status=400)
+    await _app.update_queue.put(update)
+    return web.Response(status=200)
+
+def build_web_app() -> web.Application:
+    app_web = web.Application(middlewares=[metrics_middleware, cors_middleware])
     app_web.router.add_route(
         "OPTIONS", "/api/trek_submit",
         lambda r: web.Response(status=200, headers=CORS_HEADERS),
     )
     app_web.router.add_post("/api/trek_submit", api_trek_submit)
+    app_web.router.add_get("/api/trek_status", api_trek_status)
+    app_web.router.add_get("/api/trek_queue", api_trek_queue)
+    app_web.router.add_get("/api/trek_live", api_trek_live)
     app_web.router.add_get("/api/zones", api_zones)
+    app_web.router.add_get("/api/zones/stream", api_zones_stream)
     app_web.router.add_post("/api/user/me", api_user_me)
+    app_web.router.add_get("/api/user", api_user)
+    app_web.router.add_get("/api/leaderboard", api_leaderboard)
+    app_web.router.add_get("/api/active_players", api_active_players)
+    app_web.router.add_get("/api/active_treks", api_active_treks)
     app_web.router.add_post("/api/zone/action", api_zone_action)
     app_web.router.add_get("/health", api_health)
+    app_web.router.add_get("/metrics", api_metrics)
+    if WEBHOOK_URL:
+        app_web.router.add_post(WEBHOOK_PATH, api_telegram_webhook)
+    return app_web
 
-    runner = web.AppRunner(app_web)
+async def start_web_server() -> web.AppRunner:
+    runner = web.AppRunner(build_web_app(), shutdown_timeout=5)
     await runner.setup()
-    port = int(os.getenv("PORT", "8080"))
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    site = web.TCPSite(runner, "0.0.0.0", PORT)
     await site.start()
-    logger.info(f"🌐 Web server ishga tushdi: port {port}")
-
-    while True:
-        await asyncio.sleep(3600)
+    logger.info(f"🌐 Web server ishga tushdi: port {PORT}")
+    return runner
 
 async def on_startup(app: Application) -> None:
     global _app
     _app = app
-    task = asyncio.create_task(start_web_server())
-    background_tasks.add(task)
-    task.add_done_callback(background_tasks.discard)
+    await db_read(zone_cache.rebuild)
+    await db_read(user_rankings.load)
+    outbox.start(app.bot)
+    await photo_cache.start(app.bot)
+    await trek_jobs.start(app.bot)
+    await live_treks.start(app.bot)
+    app.bot_data["web_runner"] = await start_web_server()
     logger.info("🚀 Bot ishga tushdi!")
 
+async def on_shutdown(app: Application) -> None:
+    runner = app.bot_data.pop("web_runner", None)
+    if runner is not None:
+        await runner.cleanup()
+    await trek_jobs.stop()
+    await live_treks.stop()
+    await outbox.stop()
+    await photo_cache.stop()
+    shutdown_db_executors()
+    logger.info("🛑 DB executor'lar to'xtatildi")
+
+# ══════════════════════════════════════════════════════
+# UPDATE PROCESSOR (foydalanuvchi bo'yicha tartib)
+# ══════════════════════════════════════════════════════
+# Turli foydalanuvchilarning update'lari parallel, bitta foydalanuvchiniki
+# esa kelish tartibida ketma-ket ishlanadi (circle rejimi ctx.user_data'ni
+# handle_location va handle_callback birgalikda o'zgartiradi). PTB semaforasi
+# UPDATE_MAX_PENDING — qabul qilingan update'lar chegarasi; handler'lar
+# faqat UPDATE_WORKERS slotda ishlaydi, navbat kutayotgan update slot band qilmaydi.
+
+UPDATE_WAIT = metrics.histogram(
+    "bot_update_wait_seconds", "Update navbatda kutish: user — o'sha foydalanuvchining oldingi update'i, "
+    "worker — bo'sh slot", ("stage",))
+UPDATE_DURATION = metrics.histogram(
+    "bot_update_duration_seconds", "Update'ni qayta ishlash vaqti (barcha handler'lar)")
+
+def update_owner(update: object) -> int | None:
+    """Tartib kaliti: foydalanuvchi, bo'lmasa chat; ikkalasi ham yo'q — tartib talab qilinmaydi."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    PTB process_update() update'larni kelish tartibida shu yerga kiritadi;
+    foydalanuvchi lock'i sinxron (await'siz) olinadi/navbatga qo'yiladi,
+    shuning uchun bitta foydalanuvchi update'lari tartibi saqlanadi.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        super().__init__(max(max_pending, workers, 2))  # 1 bo'lsa PTB ketma-ket rejimga o'tadi
+        self.workers = workers
+        self._slots = asyncio.Semaphore(workers)
+        self._users: dict = {}  # owner -> [asyncio.Lock, navbatdagi update'lar soni]
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.failed = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        owner = update_owner(update)
+        self.pending += 1
+        t0 = time.perf_counter()
+        try:
+            if owner is None:
+                await self._run(coroutine, t0)
+                return
+            slot = self._users.get(owner)
+            if slot is None:
+                slot = self._users[owner] = [asyncio.Lock(), 0]
+            slot[1] += 1
+            try:
+                async with slot[0]:
+                    t1 = time.perf_counter()
+                    UPDATE_WAIT.observe(t1 - t0, "user")
+                    await self._run(coroutine, t1)
+            finally:
+                slot[1] -= 1
+                if slot[1] == 0:
+                    del self._users[owner]
+        finally:
+            self.pending -= 1
+
+    async def _run(self, coroutine, t0: float) -> None:
+        async with self._slots:
+            t1 = time.perf_counter()
+            UPDATE_WAIT.observe(t1 - t0, "worker")
+            self.running += 1
+            try:
+                await coroutine
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                raise
+            finally:
+                self.running -= 1
+                UPDATE_DURATION.observe(time.perf_counter() - t1)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers, "waiting": self.pending - self.running, "running": self.running,
+            "users": len(self._users), "processed": self.processed, "failed": self.failed,
+        }
+
+update_processor = UserOrderedUpdateProcessor(UPDATE_WORKERS, UPDATE_MAX_PENDING)
+UPDATE_PROCESSOR_STATS = metrics.gauge(
+    "bot_update_processor", "Update processor: worker'lar, kutayotgan/ishlayotgan update'lar, faol foydalanuvchilar",
+    lambda: {(k,): v for k, v in update_processor.stats().items()}, ("stat",))
+
 # ══════════════════════════════════════════════════════
 # MAIN
 # ══════════════════════════════════════════════════════
 
+async def run_webhook(app: Application) -> None:
+    """Webhook rejimi: bitta event loop va bitta port — /api/* va Telegram update'lari."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.bot.set_webhook(
+        url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        drop_pending_updates=True,
+        max_connections=100,
+    )
+    await app.start()
+    logger.info(f"🪝 Webhook rejimi: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        await app.stop()
+        await app.shutdown()
+        await app.post_shutdown(app)
+
 def main():
     if not BOT_TOKEN:
         logger.error("❌ BOT_TOKEN topilmadi! Railway Variables da sozlang.")
@@ -1431,27 +4338,42 @@ def main():
 
     init_db()
     migrate_db()
-    app = Application.builder().token(BOT_TOKEN).post_init(on_startup).build()
-
-    app.add_handler(CommandHandler("start", cmd_start))
-    app.add_handler(CommandHandler("help", cmd_help))
-    app.add_handler(CommandHandler("team", cmd_team))
-    app.add_handler(CommandHandler("stats", cmd_stats))
-    app.add_handler(CommandHandler("leaderboard", cmd_leaderboard))
-    app.add_handler(CommandHandler("zones", cmd_zones))
-    app.add_handler(CommandHandler("map", cmd_map))
-    app.add_handler(CommandHandler("achievements", cmd_achievements))
-    app.add_handler(CommandHandler("referral", cmd_referral))
-    app.add_handler(CommandHandler("coins", cmd_coins))
-    app.add_handler(CommandHandler("strengthen", cmd_strengthen))
-    app.add_handler(CommandHandler("weaken", cmd_weaken))
-    app.add_handler(CommandHandler("weekly", cmd_weekly))
-
-    app.add_handler(MessageHandler(filters.Regex(r"^/history_\d+"), cmd_history))
-    app.add_handler(MessageHandler(filters.LOCATION, handle_location))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    app.add_handler(CallbackQueryHandler(handle_callback))
-
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(update_processor)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if WEBHOOK_URL:
+        builder = builder.updater(None)  # update'lar aiohttp route orqali keladi
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", instrumented(cmd_start)))
+    app.add_handler(CommandHandler("help", instrumented(cmd_help)))
+    app.add_handler(CommandHandler("team", instrumented(cmd_team)))
+    app.add_handler(CommandHandler("stats", instrumented(cmd_stats)))
+    app.add_handler(CommandHandler("leaderboard", instrumented(cmd_leaderboard)))
+    app.add_handler(CommandHandler("zones", instrumented(cmd_zones)))
+    app.add_handler(CommandHandler("map", instrumented(cmd_map)))
+    app.add_handler(CommandHandler("achievements", instrumented(cmd_achievements)))
+    app.add_handler(CommandHandler("referral", instrumented(cmd_referral)))
+    app.add_handler(CommandHandler("coins", instrumented(cmd_coins)))
+    app.add_handler(CommandHandler("strengthen", instrumented(cmd_strengthen)))
+    app.add_handler(CommandHandler("weaken", instrumented(cmd_weaken)))
+    app.add_handler(CommandHandler("weekly", instrumented(cmd_weekly)))
+
+    app.add_handler(MessageHandler(filters.Regex(r"^/history_\d+"), instrumented(cmd_history)))
+    app.add_handler(MessageHandler(filters.LOCATION, instrumented(handle_location)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(handle_text)))
+    app.add_handler(CallbackQueryHandler(instrumented(handle_callback)))
+
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+        return
     logger.info("🤖 Bot polling boshlandi...")
     app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 